@@ -20,8 +20,13 @@ from libs import cache
 from libs import memory_trace
 from libs import buildtools
 from libs import zeromq
+from nerdwave import catalog
+from nerdwave import leaderboards
 from nerdwave import playlist
 from nerdwave import schedule
+from nerdwave import search_index
+from nerdwave import song_ranks
+from nerdwave.playlist_objects import object_cache
 import nerdwave.request
 
 from .urls import request_classes
@@ -88,8 +93,16 @@ class APIServer:
 
         for sid in config.station_ids:
             cache.update_local_cache_for_sid(sid)
+            catalog.refresh_local(sid)
             playlist.prepare_cooldown_algorithm(sid)
             playlist.update_num_songs()
+            search_index.load(sid)
+        leaderboards.refresh_local()
+        song_ranks.build()
+        cache.setup_local_cache(zeromq.publish)
+        object_cache.set_publisher(zeromq.publish)
+        object_cache.check_catalog_version()
+        object_cache.setup_reporting()
 
         # If we're not in developer, remove development-related URLs
         if not config.get("developer_mode"):
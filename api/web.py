@@ -553,6 +553,18 @@ class NerdwaveHandler(tornado.web.RequestHandler):
             limit += " OFFSET %s" % self.get_argument("page_start")
         return limit
 
+    # For GET output that only changes with a version: sets the ETag and answers 304
+    # if the client already has it.  Returns True if the request is finished.
+    def not_modified(self, version):
+        if getattr(self.request, "method", None) != "GET":
+            return False
+        self.set_header("Etag", '"%s-%s"' % (version, self.locale.code))
+        if self.check_etag_header():
+            self.set_status(304)
+            self.finish()
+            return True
+        return False
+
 
 class APIHandler(NerdwaveHandler):
     content_type = "application/json"
@@ -566,7 +578,8 @@ class APIHandler(NerdwaveHandler):
 
     def finish(self, chunk=None):
         self.set_header("Content-Type", self.content_type)
-        self.write_output()
+        if self.get_status() != 304:
+            self.write_output()
         super(APIHandler, self).finish(chunk)
 
     def write_output(self):
@@ -699,7 +712,8 @@ class PrettyPrintAPIMixin:
 
     def prepare(self):
         super().prepare()  # type: ignore
-        self._real_post()
+        # Tornado awaits whatever prepare returns, which covers async posts
+        return self._real_post()
 
     def get(self, write_header=True):
         if not isinstance(self._output, dict):
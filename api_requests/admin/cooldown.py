@@ -2,6 +2,8 @@ from libs import db
 import api.web
 from api.urls import handle_api_url
 from api import fieldtypes
+from nerdwave.playlist_objects import cooldown
+from nerdwave.playlist_objects import object_cache
 
 
 @handle_api_url("admin/set_song_cooldown")
@@ -64,6 +66,7 @@ class SetSongCooldown(api.web.APIHandler):
                     "text": "Neither multiply or override parameters set.",
                 },
             )
+        object_cache.invalidate([self.get_argument("song_id")])
 
 
 @handle_api_url("admin/reset_song_cooldown")
@@ -80,6 +83,7 @@ class ResetSongCooldown(api.web.APIHandler):
             "UPDATE r4_songs SET song_cool_multiply = 1, song_cool_override = NULL WHERE song_id = %s",
             (self.get_argument("song_id"),),
         )
+        object_cache.invalidate([self.get_argument("song_id")])
         self.append(self.return_name, {"success": True, "text": "Song cooldown reset."})
 
 
@@ -151,6 +155,7 @@ class SetAlbumCooldown(api.web.APIHandler):
                     "text": "Neither multiply or override parameters set.",
                 },
             )
+        cooldown.album_cool_times_changed(self.sid)
 
 
 @handle_api_url("admin/reset_album_cooldown")
@@ -166,6 +171,7 @@ class ResetAlbumCooldown(api.web.APIHandler):
             "UPDATE r4_album_sid SET album_cool_multiply = 1, album_cool_override = NULL WHERE album_id = %s AND sid = %s",
             (self.get_argument("album_id"), self.sid),
         )
+        cooldown.album_cool_times_changed(self.sid)
         self.append(
             self.return_name,
             {"success": True, "text": "Album cooldown multiplier and override reset."},
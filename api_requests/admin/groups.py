@@ -1,6 +1,8 @@
 import api.web
 from api.urls import handle_api_url
 from api import fieldtypes
+from nerdwave import catalog
+from nerdwave.playlist_objects import object_cache
 from nerdwave.playlist import Song
 from nerdwave.playlist import SongGroup
 
@@ -20,6 +22,7 @@ class RemoveGroupFromSong(api.web.APIHandler):
         g = SongGroup.load_from_id(self.get_argument("group_id"))
         s.remove_group_id(g.id)
         g.reconcile_sids()
+        catalog.bump_version()
         self.append(
             self.return_name,
             {"success": "true", "tl_key": "Group removed from song ID."},
@@ -38,6 +41,7 @@ class EditGroup(api.web.APIHandler):
     def post(self):
         g = SongGroup.load_from_id(self.get_argument("group_id"))
         g.set_elec_block(self.get_argument("elec_block"))
+        object_cache.invalidate()
         self.append(
             self.return_name,
             {
@@ -60,6 +64,7 @@ class EditGroupCooldown(api.web.APIHandler):
     def post(self):
         g = SongGroup.load_from_id(self.get_argument("group_id"))
         g.set_cooldown(self.get_argument("cooldown"))
+        object_cache.invalidate()
         self.append(
             self.return_name,
             {
@@ -2,6 +2,7 @@ from libs import db
 import api.web
 from api.urls import handle_api_url
 from api import fieldtypes
+from nerdwave.playlist_objects import object_cache
 
 
 @handle_api_url("admin/set_song_request_only")
@@ -41,3 +42,5 @@ class SetSongRequestOnly(api.web.APIHandler):
                     % self.get_argument("song_id"),
                 },
             )
+        # lets the backends know to reload their song pools
+        object_cache.invalidate([self.get_argument("song_id")])
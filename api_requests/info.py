@@ -1,4 +1,11 @@
 from typing import cast
+from time import time as timestamp
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
 from api.web import APIHandler
 from api.exceptions import APIException
 from api import fieldtypes
@@ -6,10 +13,11 @@ from api.urls import handle_api_url
 import api_requests.vote
 import api_requests.playlist
 import api_requests.tune_in
-from nerdwave.events.event import BaseEvent
+from nerdwave import rating
 
 from libs import cache
 from libs import config
+from libs import log
 
 
 def attach_dj_info_to_request(request):
@@ -91,41 +99,17 @@ def attach_info_to_request(
     sched_current = None
     if request.user and not request.user.is_anonymous():
         request.append("requests", request.user.get_requests(request.sid))
-        sched_current = cache.get_station(request.sid, "sched_current")
-        if not sched_current:
+        schedule = StationSchedule(request.sid)
+        if not schedule.is_ready():
             raise APIException(
                 "server_just_started",
                 "Nerdwave is Rebooting, Please Try Again in a Few Minutes",
                 http_code=500,
             )
-        if request.user.is_tunedin():
-            sched_current.get_song().data["rating_allowed"] = True
-        sched_current = sched_current.to_dict(request.user)
-        sched_next = []
-        sched_next_objects = cast(
-            list[BaseEvent], cache.get_station(request.sid, "sched_next")
-        )
-        for evt in sched_next_objects:
-            sched_next.append(evt.to_dict(request.user))
-        if (
-            len(sched_next) > 0
-            and request.user.is_tunedin()
-            and sched_next_objects[0].is_election
-            and len(sched_next_objects[0].songs) > 1
-        ):
-            sched_next[0]["voting_allowed"] = True
-        if request.user.is_tunedin() and request.user.has_perks():
-            for i in range(1, len(sched_next)):
-                if (
-                    sched_next_objects[i].is_election
-                    and len(sched_next_objects[i].songs) > 1
-                ):
-                    sched_next[i]["voting_allowed"] = True
-        sched_history = []
-        for evt in cast(
-            list[BaseEvent], cache.get_station(request.sid, "sched_history")
-        ):
-            sched_history.append(evt.to_dict(request.user, check_rating_acl=True))
+        user_schedule = schedule.user_schedule(request.user)
+        sched_current = user_schedule["sched_current"]
+        sched_next = user_schedule["sched_next"]
+        sched_history = user_schedule["sched_history"]
     elif request.user:
         sched_current = cache.get_station(request.sid, "sched_current_dict")
         if not sched_current:
@@ -169,6 +153,226 @@ def attach_info_to_request(
         request.append("live_voting", cache.get_station(request.sid, "live_voting"))
 
 
+def _json_members(obj):
+    # Serializes a dict and strips the outer braces, so that the result can be spliced into another object
+    return json.dumps(obj, ensure_ascii=False)[1:-1].encode("utf-8")
+
+
+class StationSchedule:
+    """
+    A station's schedule as the backend published it for display, plus the per-user
+    merge (ratings, rating and voting permissions) to lay over a copy of it.
+    """
+
+    def __init__(self, sid):
+        self.sid = sid
+        self.sched_current = cache.get_station(sid, "sched_current_dict")
+        self.sched_next = cache.get_station(sid, "sched_next_dict") or []
+        self.sched_history = cache.get_station(sid, "sched_history_dict")
+        self.rating_acl = cache.get_station(sid, "user_rating_acl") or {}
+        sched_snapshot = cache.get_station(sid, "sched_snapshot")
+        self.next_votable = [
+            evt.is_election and len(evt.songs) > 1
+            for evt in (sched_snapshot.next if sched_snapshot else ())
+        ]
+
+    def is_ready(self):
+        return self.sched_current is not None
+
+    def _user_song(self, song, user, ratings, rating_allowed=False):
+        song_ratings, album_ratings = ratings
+        song = dict(song)
+        song.update(song_ratings[song["id"]])
+        if rating_allowed or user.data["rate_anything"]:
+            song["rating_allowed"] = True
+        song["albums"] = [
+            dict(album, **album_ratings[album["id"]]) for album in song["albums"]
+        ]
+        return song
+
+    def _get_ratings(self, user):
+        song_ids = []
+        album_ids = []
+        for evt in [self.sched_current] + self.sched_next + (self.sched_history or []):
+            for song in evt.get("songs", ()):
+                song_ids.append(song["id"])
+                album_ids.extend(album["id"] for album in song["albums"])
+        return (
+            rating.get_song_ratings(song_ids, user.id),
+            rating.get_album_ratings(self.sid, album_ids, user.id),
+        )
+
+    def _user_event(self, evt, user, ratings, current=False, history=False):
+        evt = dict(evt)
+        if "songs" in evt:
+            songs = []
+            for i, song in enumerate(evt["songs"]):
+                rating_allowed = False
+                if current:
+                    # only the song playing, as rating.py checks
+                    rating_allowed = i == 0 and user.is_tunedin()
+                elif history:
+                    # Same as Song.check_rating_acl
+                    rating_allowed = (
+                        song["id"] in self.rating_acl
+                        and user.id in self.rating_acl[song["id"]]
+                    )
+                songs.append(self._user_song(song, user, ratings, rating_allowed))
+            evt["songs"] = songs
+        return evt
+
+    def user_schedule(self, user):
+        ratings = self._get_ratings(user)
+        sched_next = []
+        for i, evt in enumerate(self.sched_next):
+            evt = self._user_event(evt, user, ratings)
+            if (
+                user.is_tunedin()
+                and i < len(self.next_votable)
+                and self.next_votable[i]
+                and (i == 0 or user.has_perks())
+            ):
+                evt["voting_allowed"] = True
+            sched_next.append(evt)
+        return {
+            "sched_current": self._user_event(
+                self.sched_current, user, ratings, current=True
+            ),
+            "sched_next": sched_next,
+            "sched_history": [
+                self._user_event(evt, user, ratings, history=True)
+                for evt in (self.sched_history or [])
+            ],
+        }
+
+
+class SyncBroadcast(StationSchedule):
+    """
+    Everything attach_info_to_request would send on a song change that is the same for every
+    session on a station, serialized once.  render() builds the per-user portion (user, requests,
+    ratings, voting) and splices it together with the shared bytes.
+
+    Only covers the default output - sessions that asked for extra lists get the full
+    attach_info_to_request treatment.  See can_render().
+    """
+
+    def __init__(self, sid):
+        start_time = timestamp()
+        super(SyncBroadcast, self).__init__(sid)
+
+        self.shared = _json_members(
+            {
+                "album_diff": cache.get_station(sid, "album_diff"),
+                "request_line": cache.get_station(sid, "request_line"),
+                "all_stations_info": cache.get("all_stations_info"),
+            }
+        )
+        self.live_voting = _json_members(
+            {"live_voting": cache.get_station(sid, "live_voting")}
+        )
+
+        # Anonymous users all see the same schedule, save for being allowed to vote when tuned in
+        anon_next_votable = []
+        if (
+            len(self.sched_next) > 0
+            and self.sched_next[0]["type"] == "Election"
+            and len(self.sched_next[0]["songs"]) > 1
+        ):
+            anon_next_votable = [dict(self.sched_next[0], voting_allowed=True)]
+            anon_next_votable += self.sched_next[1:]
+        self.anonymous_schedule = {
+            False: self._schedule_members(self.sched_next),
+            True: self._schedule_members(anon_next_votable or self.sched_next),
+        }
+
+        self.build_time = timestamp() - start_time
+        log.debug(
+            "sync_broadcast",
+            "SID %s broadcast built in %.6f, %s shared bytes."
+            % (
+                sid,
+                self.build_time,
+                len(self.shared) + len(self.anonymous_schedule[False]),
+            ),
+        )
+
+    def _schedule_members(self, sched_next):
+        return _json_members(
+            {
+                "sched_current": self.sched_current,
+                "sched_next": sched_next,
+                "sched_history": self.sched_history,
+            }
+        )
+
+    def can_render(self, request):
+        if getattr(request, "_output_array", False):
+            return False
+        # mobile clients don't get album_diff or request_line, which are in the shared bytes
+        if request.mobile:
+            return False
+        if request.get_cookie("r4_active_list") == "current_listeners":
+            return False
+        for extra in ("all_albums", "all_artists", "all_groups", "current_listeners"):
+            if extra in request.request.arguments:
+                return False
+        return True
+
+    def render(self, user, live_voting=False, startclock=None):
+        """
+        Returns the complete, serialized sync output for the user as bytes.
+        """
+        output = {"user": user.to_private_dict()}
+        if user.is_dj():
+            attach_dj_info_to_request(_DictRequest(self.sid, output))
+
+        parts = [self.shared]
+        if user.is_anonymous():
+            parts.append(self.anonymous_schedule[bool(user.is_tunedin())])
+            if (
+                len(self.sched_next) > 0
+                and user.data.get("voted_entry")
+                and user.data.get("voted_entry") > 0  # type: ignore
+                and user.data["lock_sid"] == self.sid
+            ):
+                output["already_voted"] = [
+                    (self.sched_next[0]["id"], user.data["voted_entry"])
+                ]
+        else:
+            output["requests"] = user.get_requests(self.sid)
+            output.update(self.user_schedule(user))
+            user_vote_cache = cache.get_user(user, "vote_history")
+            if user_vote_cache:
+                output["already_voted"] = user_vote_cache
+
+        if live_voting:
+            parts.append(self.live_voting)
+
+        output["api_info"] = {
+            "exectime": timestamp() - (startclock or timestamp()),
+            "time": round(timestamp()),
+        }
+        parts.append(_json_members(output))
+        return b"{" + b",".join(part for part in parts if part) + b"}"
+
+
+class _DictRequest:
+    # Just enough of a request for attach_dj_info_to_request to write into a plain dict
+    def __init__(self, sid, output):
+        self.sid = sid
+        self.output = output
+
+    def append(self, key, value):
+        self.output[key] = value
+
+
+def build_sync_broadcast(sid):
+    broadcast = SyncBroadcast(sid)
+    if not broadcast.is_ready():
+        return None
+    return broadcast
+
+
 def check_sync_status(sid, offline_ack: bool | None = False):
     if not cache.get_station(sid, "backend_ok") and not offline_ack:
         raise APIException("station_offline")
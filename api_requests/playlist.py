@@ -16,18 +16,29 @@ from libs import cache
 from libs import db
 from libs import config
 from libs.pretty_date import pretty_date
+from nerdwave import catalog
+from nerdwave import leaderboards
 from nerdwave import playlist
+from nerdwave import rating
 from nerdwave.playlist_objects.metadata import MetadataNotFoundError
 from api.exceptions import APIException
 
-PAGE_LIMIT = 1000
+PAGE_LIMIT = catalog.PAGE_LIMIT
 
 
 def get_all_albums(sid, user=None):
+    albums = cache.get_station(sid, "all_albums")
     if not user or user.is_anonymous():
-        return cache.get_station(sid, "all_albums")
-    else:
+        return albums
+    if albums is None:
         return playlist.get_all_albums_list(sid, user)
+    overlay = rating.get_album_overlay(sid, user.id)
+    if not overlay:
+        return albums
+    return [
+        {**album, **overlay[album["id"]]} if album["id"] in overlay else album
+        for album in albums
+    ]
 
 
 def get_all_artists(sid):
@@ -42,6 +53,26 @@ def get_all_groups_power(sid):
     return cast(list[playlist.SongGroup], cache.get_station(sid, "all_groups_power"))
 
 
+def _get_list_page(sid, key, offset):
+    page = catalog.get_page(sid, key, offset)
+    if page and offset % PAGE_LIMIT == 0:
+        return page
+    # nothing published yet, or a client asking for an offset we don't have a page for
+    items = cache.get_station(sid, key) or []
+    page = items[offset : offset + PAGE_LIMIT]
+    return {
+        "data": page,
+        "has_more": offset + PAGE_LIMIT < len(items),
+        "progress": (
+            min(math.ceil((offset + len(page)) / len(items) * 100), 100)
+            if items
+            else 100
+        ),
+        "next": offset + PAGE_LIMIT,
+        "catalog_version": cache.get("catalog_version"),
+    }
+
+
 @handle_api_url("all_albums")
 class AllAlbumsHandler(APIHandler):
     description = "Get a list of all albums on the station playlist."
@@ -60,29 +91,53 @@ class AllAlbumsHandler(APIHandler):
 
 @handle_api_url("all_albums_paginated")
 class AllAlbumsPaginatedHandler(APIHandler):
-    description = "Returns chunks of a list of all albums on the station playlist."
+    description = "Returns chunks of a list of all albums on the station playlist.  Pass 'next' from the previous chunk as 'after'.  Also passing 'cursor' from the previous chunk pages from the last album's name instead, which doesn't skip or repeat albums when the list changes mid-walk; 'after' is then only used for progress."
     return_name = "all_albums_paginated"
-    fields = {"after": (fieldtypes.integer, False)}
+    fields = {
+        "after": (fieldtypes.integer, False),
+        "cursor": (fieldtypes.string, False),
+    }
 
     def post(self):
         sql, args = playlist.get_all_albums_list_sql(self.sid, self.user)
         offset = self.get_argument_int("after", 0) or 0
-        args = args + (offset,)
-        albums = db.c.fetch_all(
-            sql + f" ORDER BY album_name LIMIT {PAGE_LIMIT} OFFSET %s", args
-        )
+        cursor = self.get_argument("cursor")
+        if cursor:
+            # keyset pagination on the last album's (album_name, album_id), carried in the cursor
+            album_id, _, album_name = cursor.partition(":")
+            if not album_id.isdigit():
+                raise APIException("invalid_argument", "Invalid cursor.")
+            sql += "AND (album_name, r4_albums.album_id) > (%s, %s) "
+            albums = db.c.fetch_all(
+                sql + f"ORDER BY album_name, r4_albums.album_id LIMIT {PAGE_LIMIT}",
+                args + (album_name, int(album_id)),
+            )
+        else:
+            albums = db.c.fetch_all(
+                sql
+                + f"ORDER BY album_name, r4_albums.album_id LIMIT {PAGE_LIMIT} OFFSET %s",
+                args + (offset,),
+            )
         self.append(
             self.return_name,
             {
                 "data": albums,
-                "has_more": albums and len(albums) == PAGE_LIMIT,
+                "has_more": len(albums) == PAGE_LIMIT,
                 "progress": min(
                     math.ceil(
-                        (offset + len(albums)) / playlist.num_albums[self.sid] * 100
+                        (offset + len(albums))
+                        / max(playlist.num_albums[self.sid], 1)
+                        * 100
                     ),
                     100,
                 ),
                 "next": offset + PAGE_LIMIT,
+                "cursor": (
+                    "%s:%s" % (albums[-1]["id"], albums[-1]["name"])
+                    if albums
+                    else cursor
+                ),
+                "catalog_version": cache.get("catalog_version"),
             },
         )
 
@@ -107,21 +162,11 @@ class AllArtistsPaginatedHandler(APIHandler):
     fields = {"after": (fieldtypes.integer, False)}
 
     def post(self):
-        all_artists = get_all_artists(
-            sid=self.sid,
-        )
-        offset = self.get_argument_int("after", 0) or 0
-        page = all_artists[offset : offset + PAGE_LIMIT]
         self.append(
             self.return_name,
-            {
-                "data": page,
-                "has_more": page[-1] != all_artists[-1],
-                "progress": min(
-                    math.ceil((offset + len(page)) / len(all_artists) * 100), 100
-                ),
-                "next": offset + PAGE_LIMIT,
-            },
+            _get_list_page(
+                self.sid, "all_artists", self.get_argument_int("after", 0) or 0
+            ),
         )
 
 
@@ -154,21 +199,11 @@ class AllGroupsPaginatedHandler(APIHandler):
     fields = {"after": (fieldtypes.integer, False)}
 
     def post(self):
-        all_groups = get_all_groups(
-            sid=self.sid,
-        )
-        offset = self.get_argument_int("after", 0) or 0
-        page = all_groups[offset : offset + PAGE_LIMIT]
         self.append(
             self.return_name,
-            {
-                "data": page,
-                "has_more": page[-1] != all_groups[-1],
-                "progress": min(
-                    math.ceil((offset + len(page)) / len(all_groups) * 100), 100
-                ),
-                "next": offset + PAGE_LIMIT,
-            },
+            _get_list_page(
+                self.sid, "all_groups", self.get_argument_int("after", 0) or 0
+            ),
         )
 
 
@@ -324,33 +359,11 @@ class Top100Songs(APIHandler):
     allow_get = True
 
     def post(self):
-        if "sid" in self.request.arguments:
-            self.append(
-                self.return_name,
-                db.c.fetch_all(
-                    "SELECT DISTINCT ON (song_rating, song_id) "
-                    "song_origin_sid AS origin_sid, song_id AS id, song_title AS title, album_name, CAST(ROUND(CAST(song_rating AS NUMERIC), 1) AS REAL) AS song_rating, song_rating_count "
-                    "FROM r4_song_sid "
-                    "JOIN r4_songs USING (song_id) "
-                    "JOIN r4_albums USING (album_id) "
-                    "WHERE r4_song_sid.sid = %s AND song_rating_count > 20 AND song_verified = TRUE "
-                    "ORDER BY song_rating DESC, song_id, song_rating_count DESC, song_id LIMIT 100",
-                    (self.sid,),
-                ),
-            )
-        else:
-            self.append(
-                self.return_name,
-                db.c.fetch_all(
-                    "SELECT DISTINCT ON (song_rating, song_id) "
-                    "song_origin_sid AS origin_sid, song_id AS id, song_title AS title, album_name, CAST(ROUND(CAST(song_rating AS NUMERIC), 1) AS REAL) AS song_rating, song_rating_count "
-                    "FROM r4_songs "
-                    "JOIN r4_song_sid USING (song_id) "
-                    "JOIN r4_albums USING (album_id) "
-                    "WHERE song_rating_count > 20 AND song_verified = TRUE "
-                    "ORDER BY song_rating DESC, song_id LIMIT 100"
-                ),
-            )
+        sid = self.sid if "sid" in self.request.arguments else None
+        snapshot = leaderboards.get_snapshot()
+        if snapshot and self.not_modified(snapshot["versions"]["top_100"]):
+            return
+        self.append(self.return_name, leaderboards.get_top(snapshot, sid))
 
 
 @handle_api_html_url("top_100")
@@ -409,30 +422,31 @@ class PlaybackHistory(APIHandler):
     allow_get = True
     pagination = True
 
-    def post(self):
-        if self.user.is_anonymous():
-            self.append(
-                self.return_name,
-                db.c.fetch_all(
-                    "SELECT r4_song_history.song_id AS id, song_title AS title, album_id, album_name, songhist_time AS song_played_at, song_artist_parseable AS artist_parseable, CAST(ROUND(CAST(song_rating AS NUMERIC), 1) AS REAL) AS rating "
-                    "FROM r4_song_history JOIN r4_song_sid USING (song_id, sid) JOIN r4_songs USING (song_id) JOIN r4_albums USING (album_id) "
-                    "WHERE r4_song_history.sid = %s "
-                    "ORDER BY songhist_id DESC " + self.get_sql_limit_string(),
-                    (self.sid,),
-                ),
-            )
-        else:
-            self.append(
-                self.return_name,
-                db.c.fetch_all(
-                    "SELECT r4_song_history.song_id AS id, song_title AS title, album_id, album_name, song_rating_user AS rating_user, song_fave AS fave, songhist_time AS song_played_at, song_artist_parseable AS artist_parseable, CAST(ROUND(CAST(song_rating AS NUMERIC), 1) AS REAL) AS rating, song_rating_user AS rating_user "
-                    "FROM r4_song_history JOIN r4_song_sid USING (song_id, sid) JOIN r4_songs USING (song_id) JOIN r4_albums USING (album_id) "
-                    "LEFT JOIN r4_song_ratings ON r4_song_history.song_id = r4_song_ratings.song_id AND user_id = %s "
-                    "WHERE r4_song_history.sid = %s "
-                    "ORDER BY songhist_id DESC " + self.get_sql_limit_string(),
-                    (self.user.id, self.sid),
-                ),
-            )
+    async def post(self):
+        async with db.async_cursor() as cursor:
+            if self.user.is_anonymous():
+                self.append(
+                    self.return_name,
+                    await cursor.fetch_all(
+                        "SELECT r4_song_history.song_id AS id, song_title AS title, album_id, album_name, songhist_time AS song_played_at, song_artist_parseable AS artist_parseable, CAST(ROUND(CAST(song_rating AS NUMERIC), 1) AS REAL) AS rating "
+                        "FROM r4_song_history JOIN r4_song_sid USING (song_id, sid) JOIN r4_songs USING (song_id) JOIN r4_albums USING (album_id) "
+                        "WHERE r4_song_history.sid = %s "
+                        "ORDER BY songhist_id DESC " + self.get_sql_limit_string(),
+                        (self.sid,),
+                    ),
+                )
+            else:
+                self.append(
+                    self.return_name,
+                    await cursor.fetch_all(
+                        "SELECT r4_song_history.song_id AS id, song_title AS title, album_id, album_name, song_rating_user AS rating_user, song_fave AS fave, songhist_time AS song_played_at, song_artist_parseable AS artist_parseable, CAST(ROUND(CAST(song_rating AS NUMERIC), 1) AS REAL) AS rating, song_rating_user AS rating_user "
+                        "FROM r4_song_history JOIN r4_song_sid USING (song_id, sid) JOIN r4_songs USING (song_id) JOIN r4_albums USING (album_id) "
+                        "LEFT JOIN r4_song_ratings ON r4_song_history.song_id = r4_song_ratings.song_id AND user_id = %s "
+                        "WHERE r4_song_history.sid = %s "
+                        "ORDER BY songhist_id DESC " + self.get_sql_limit_string(),
+                        (self.user.id, self.sid),
+                    ),
+                )
 
 
 @handle_api_html_url("playback_history")
@@ -474,13 +488,10 @@ class StationSongCountRequest(APIHandler):
     allow_get = True
 
     def post(self):
-        self.append(
-            self.return_name,
-            db.c.fetch_all(
-                "SELECT song_origin_sid AS sid, COUNT(song_id) AS song_count "
-                "FROM r4_songs WHERE song_verified = TRUE GROUP BY song_origin_sid"
-            ),
-        )
+        snapshot = leaderboards.get_snapshot()
+        if snapshot and self.not_modified(snapshot["versions"]["station_song_count"]):
+            return
+        self.append(self.return_name, leaderboards.get_station_song_count(snapshot))
 
 
 @handle_api_url("user_requested_history")
@@ -28,8 +28,12 @@ class SubmitRatingRequest(APIHandler):
     def rate(self, song_id, rating):
         if not self.user.data["rate_anything"]:
             acl = cache.get_station(self.sid, "user_rating_acl")
-            sched_current = cache.get_station(self.sid, "sched_current")
-            if not sched_current or not sched_current.get_song().id == song_id:
+            sched_snapshot = cache.get_station(self.sid, "sched_snapshot")
+            if (
+                not sched_snapshot
+                or not sched_snapshot.current
+                or not sched_snapshot.current.get_song_id() == song_id
+            ):
                 if not acl or not song_id in acl or not self.user.id in acl[song_id]:
                     raise APIException("cannot_rate_now")
             elif not self.user.is_tunedin():
@@ -1,10 +1,196 @@
+from collections import OrderedDict
+from time import time as timestamp
+
 from api.web import APIHandler
 from api import fieldtypes
 from api.urls import handle_api_url
+from libs import config
 from libs import db
+from nerdwave import rating
+from nerdwave import search_index
 from nerdwave.playlist_objects.metadata import make_searchable_string
 from api.exceptions import APIException
 
+# (sid, searchable string) -> (time, artists, albums, songs), shared by all users.
+# Per-user ratings and faves are laid over a copy of the results after the fact.
+_results_cache = OrderedDict()
+
+
+def get_search_mode():
+    """
+    "trigram" ranks prefix matches first, then by pg_trgm word similarity, and also
+    finds near-misses/typos.  "like" is the original substring match sorted by name.
+    "index" answers from nerdwave.search_index in memory, using trigram until built.
+    """
+    if config.has("search_mode") and config.get("search_mode"):
+        return config.get("search_mode")
+    return "trigram"
+
+
+def _get_cache_size():
+    if config.has("search_cache_size"):
+        return config.get("search_cache_size")
+    return 500
+
+
+def _get_cache_ttl():
+    # short, since the results carry cooldown status
+    if config.has("search_cache_ttl"):
+        return config.get("search_cache_ttl")
+    return 30
+
+
+def _get_cached(key):
+    cached = _results_cache.get(key)
+    if not cached:
+        return None
+    if cached[0] < timestamp() - _get_cache_ttl():
+        del _results_cache[key]
+        return None
+    _results_cache.move_to_end(key)
+    return cached[1:]
+
+
+def _set_cached(key, artists, albums, songs):
+    if not _get_cache_size():
+        return
+    _results_cache[key] = (timestamp(), artists, albums, songs)
+    _results_cache.move_to_end(key)
+    while len(_results_cache) > _get_cache_size():
+        _results_cache.popitem(last=False)
+
+
+def _search_like(sid, s):
+    s = "%%%s%%" % s
+    artists = db.c.fetch_all(
+        "SELECT DISTINCT artist_id AS id, artist_name AS name "
+        "FROM r4_song_sid "
+        "JOIN r4_song_artist USING (song_id) "
+        "JOIN r4_artists USING (artist_id) "
+        "WHERE sid = %s AND song_exists = TRUE AND artist_name_searchable LIKE %s "
+        "ORDER BY artist_name "
+        "LIMIT 50",
+        (sid, s),
+    )
+    albums = db.c.fetch_all(
+        "SELECT DISTINCT album_id AS id, album_name AS name, album_cool AS cool, CAST(ROUND(CAST(album_rating AS NUMERIC), 1) AS REAL) AS rating, "
+        "FALSE AS fave, 0 AS rating_user, FALSE as rating_complete "
+        "FROM r4_album_sid "
+        "JOIN r4_albums USING (album_id) "
+        "WHERE sid = %s AND album_exists = TRUE AND album_name_searchable LIKE %s "
+        "ORDER BY album_name "
+        "LIMIT 50",
+        (sid, s),
+    )
+    # base SQL here copy pasted from /nerdwave/playlist_objects/album.py
+    songs = db.c.fetch_all(
+        "SELECT r4_song_sid.song_id AS id, song_length AS length, song_origin_sid AS origin_sid, song_title AS title, song_added_on AS added_on, "
+        "song_url AS url, song_link_text AS link_text, CAST(ROUND(CAST(song_rating AS NUMERIC), 1) AS REAL) AS rating, "
+        "FALSE AS requestable, song_cool AS cool, song_cool_end AS cool_end, "
+        "song_artist_parseable AS artist_parseable, "
+        "0 AS rating_user, FALSE AS fave, "
+        "r4_albums.album_name, r4_songs.album_id "
+        "FROM r4_song_sid "
+        "JOIN r4_songs ON (r4_song_sid.song_id = r4_songs.song_id AND r4_songs.song_title_searchable LIKE %s) "
+        "JOIN r4_albums ON (r4_songs.album_id = r4_albums.album_id) "
+        "WHERE r4_song_sid.song_exists = TRUE AND r4_songs.song_verified = TRUE AND r4_song_sid.sid = %s "
+        "ORDER BY album_name, song_title "
+        "LIMIT 100",
+        (s, sid),
+    )
+    return artists, albums, songs
+
+
+def _search_trigram(sid, s):
+    # LIKE '%s%' and <% both use the trigram GIN indexes on the *_searchable columns.
+    params = {"sid": sid, "term": s, "prefix": "%s%%" % s, "contains": "%%%s%%" % s}
+    artists = db.c.fetch_all(
+        "SELECT artist_id AS id, artist_name AS name "
+        "FROM r4_artists "
+        "WHERE (artist_name_searchable LIKE %(contains)s OR %(term)s <%% artist_name_searchable) "
+        "AND EXISTS (SELECT 1 FROM r4_song_artist JOIN r4_song_sid USING (song_id) WHERE r4_song_artist.artist_id = r4_artists.artist_id AND sid = %(sid)s AND song_exists = TRUE) "
+        "ORDER BY artist_name_searchable LIKE %(prefix)s DESC, word_similarity(%(term)s, artist_name_searchable) DESC, artist_name "
+        "LIMIT 50",
+        params,
+    )
+    albums = db.c.fetch_all(
+        "SELECT album_id AS id, album_name AS name, album_cool AS cool, CAST(ROUND(CAST(album_rating AS NUMERIC), 1) AS REAL) AS rating, "
+        "FALSE AS fave, 0 AS rating_user, FALSE as rating_complete "
+        "FROM r4_album_sid "
+        "JOIN r4_albums USING (album_id) "
+        "WHERE sid = %(sid)s AND album_exists = TRUE AND (album_name_searchable LIKE %(contains)s OR %(term)s <%% album_name_searchable) "
+        "ORDER BY album_name_searchable LIKE %(prefix)s DESC, word_similarity(%(term)s, album_name_searchable) DESC, album_name "
+        "LIMIT 50",
+        params,
+    )
+    songs = db.c.fetch_all(
+        "SELECT r4_song_sid.song_id AS id, song_length AS length, song_origin_sid AS origin_sid, song_title AS title, song_added_on AS added_on, "
+        "song_url AS url, song_link_text AS link_text, CAST(ROUND(CAST(song_rating AS NUMERIC), 1) AS REAL) AS rating, "
+        "FALSE AS requestable, song_cool AS cool, song_cool_end AS cool_end, "
+        "song_artist_parseable AS artist_parseable, "
+        "0 AS rating_user, FALSE AS fave, "
+        "r4_albums.album_name, r4_songs.album_id "
+        "FROM r4_song_sid "
+        "JOIN r4_songs ON (r4_song_sid.song_id = r4_songs.song_id) "
+        "JOIN r4_albums ON (r4_songs.album_id = r4_albums.album_id) "
+        "WHERE r4_song_sid.song_exists = TRUE AND r4_songs.song_verified = TRUE AND r4_song_sid.sid = %(sid)s "
+        "AND (song_title_searchable LIKE %(contains)s OR %(term)s <%% song_title_searchable) "
+        "ORDER BY song_title_searchable LIKE %(prefix)s DESC, word_similarity(%(term)s, song_title_searchable) DESC, album_name, song_title "
+        "LIMIT 100",
+        params,
+    )
+    return artists, albums, songs
+
+
+def search(sid, s):
+    """
+    Anonymous results for a searchable string, from the LRU where possible.
+    The returned rows are shared - copy them before changing anything.
+    """
+    mode = get_search_mode()
+    if mode == "index":
+        index = search_index.get(sid)
+        if index:
+            return index.search(s)
+        mode = "trigram"
+    key = (sid, mode, s)
+    cached = _get_cached(key)
+    if cached:
+        return cached
+    if mode == "like":
+        results = _search_like(sid, s)
+    else:
+        results = _search_trigram(sid, s)
+    _set_cached(key, *results)
+    return results
+
+
+def overlay_user_ratings(sid, user, albums, songs):
+    album_ratings = rating.get_album_ratings(sid, [a["id"] for a in albums], user.id)
+    song_ratings = rating.get_song_ratings([s["id"] for s in songs], user.id)
+
+    user_albums = []
+    for album in albums:
+        album = dict(album)
+        album_rating = album_ratings.get(album["id"])
+        if album_rating:
+            album["fave"] = album_rating["fave"] or False
+            album["rating_user"] = album_rating["rating_user"] or 0
+            album["rating_complete"] = album_rating["rating_complete"] or False
+        user_albums.append(album)
+
+    user_songs = []
+    for song in songs:
+        song = dict(song)
+        song["requestable"] = True
+        song_rating = song_ratings.get(song["id"])
+        if song_rating:
+            song["fave"] = song_rating["fave"] or False
+            song["rating_user"] = song_rating["rating_user"] or 0
+        user_songs.append(song)
+
+    return user_albums, user_songs
+
 
 @handle_api_url("search")
 class SearchHandler(APIHandler):
@@ -18,78 +204,9 @@ class SearchHandler(APIHandler):
         if len(s) < 3:
             raise APIException("search_string_too_short")
 
-        s = "%%%s%%" % s
-
-        artists = db.c.fetch_all(
-            "SELECT DISTINCT artist_id AS id, artist_name AS name "
-            "FROM r4_song_sid "
-            "JOIN r4_song_artist USING (song_id) "
-            "JOIN r4_artists USING (artist_id) "
-            "WHERE sid = %s AND song_exists = TRUE AND artist_name_searchable LIKE %s "
-            "ORDER BY artist_name "
-            "LIMIT 50",
-            (self.sid, s),
-        )
-
-        if self.user.is_anonymous():
-            albums = db.c.fetch_all(
-                "SELECT DISTINCT album_id AS id, album_name AS name, album_cool AS cool, CAST(ROUND(CAST(album_rating AS NUMERIC), 1) AS REAL) AS rating, "
-                "FALSE AS fave, 0 AS rating_user, FALSE as rating_complete "
-                "FROM r4_album_sid "
-                "JOIN r4_albums USING (album_id) "
-                "WHERE sid = %s AND album_exists = TRUE AND album_name_searchable LIKE %s "
-                "ORDER BY album_name "
-                "LIMIT 50",
-                (self.sid, s),
-            )
-        else:
-            albums = db.c.fetch_all(
-                "SELECT DISTINCT r4_albums.album_id AS id, album_name AS name, album_cool AS cool, CAST(ROUND(CAST(album_rating AS NUMERIC), 1) AS REAL) AS rating, "
-                "COALESCE(album_fave, FALSE) AS fave, COALESCE(album_rating_user, 0) AS rating_user, COALESCE(album_rating_complete, FALSE) AS rating_complete "
-                "FROM r4_album_sid "
-                "JOIN r4_albums USING (album_id) "
-                "LEFT JOIN r4_album_ratings ON (r4_albums.album_id = r4_album_ratings.album_id AND r4_album_ratings.user_id = %s AND r4_album_ratings.sid = %s) "
-                "LEFT JOIN r4_album_faves ON (r4_albums.album_id = r4_album_faves.album_id AND r4_album_faves.user_id = %s) "
-                "WHERE r4_album_sid.sid = %s AND album_exists = TRUE AND album_name_searchable LIKE %s "
-                "ORDER BY album_name "
-                "LIMIT 50",
-                (self.user.id, self.sid, self.user.id, self.sid, s),
-            )
-
-        # base SQL here copy pasted from /nerdwave/playlist_objects/album.py
-        if self.user.is_anonymous():
-            songs = db.c.fetch_all(
-                "SELECT r4_song_sid.song_id AS id, song_length AS length, song_origin_sid AS origin_sid, song_title AS title, song_added_on AS added_on, "
-                "song_url AS url, song_link_text AS link_text, CAST(ROUND(CAST(song_rating AS NUMERIC), 1) AS REAL) AS rating, "
-                "FALSE AS requestable, song_cool AS cool, song_cool_end AS cool_end, "
-                "song_artist_parseable AS artist_parseable, "
-                "0 AS rating_user, FALSE AS fave, "
-                "r4_albums.album_name, r4_songs.album_id "
-                "FROM r4_song_sid "
-                "JOIN r4_songs ON (r4_song_sid.song_id = r4_songs.song_id AND r4_songs.song_title_searchable LIKE %s) "
-                "JOIN r4_albums ON (r4_songs.album_id = r4_albums.album_id) "
-                "WHERE r4_song_sid.song_exists = TRUE AND r4_songs.song_verified = TRUE AND r4_song_sid.sid = %s "
-                "ORDER BY album_name, song_title "
-                "LIMIT 100",
-                (s, self.sid),
-            )
-        else:
-            songs = db.c.fetch_all(
-                "SELECT r4_song_sid.song_id AS id, song_length AS length, song_origin_sid AS origin_sid, song_title AS title, song_added_on AS added_on, "
-                "song_url AS url, song_link_text AS link_text, CAST(ROUND(CAST(song_rating AS NUMERIC), 1) AS REAL) AS rating, "
-                "TRUE AS requestable, song_cool AS cool, song_cool_end AS cool_end, "
-                "song_artist_parseable AS artist_parseable, "
-                "COALESCE(song_rating_user, 0) AS rating_user, COALESCE(song_fave, FALSE) AS fave, "
-                "r4_albums.album_name, r4_songs.album_id "
-                "FROM r4_song_sid "
-                "JOIN r4_songs ON (r4_song_sid.song_id = r4_songs.song_id AND r4_songs.song_title_searchable LIKE %s) "
-                "LEFT JOIN r4_song_ratings ON (r4_song_sid.song_id = r4_song_ratings.song_id AND user_id = %s) "
-                "JOIN r4_albums ON (r4_songs.album_id = r4_albums.album_id) "
-                "WHERE r4_song_sid.song_exists = TRUE AND r4_songs.song_verified = TRUE AND r4_song_sid.sid = %s "
-                "ORDER BY album_name, song_title "
-                "LIMIT 100",
-                (s, self.user.id, self.sid),
-            )
+        artists, albums, songs = search(self.sid, s)
+        if not self.user.is_anonymous():
+            albums, songs = overlay_user_ratings(self.sid, self.user, albums, songs)
 
         self.append("artists", artists)
         self.append("albums", albums)
@@ -4,6 +4,7 @@ import numbers
 import sys
 import uuid
 import asyncio
+import inspect
 from urllib.parse import urlparse
 from time import time as timestamp
 
@@ -28,8 +29,13 @@ from api.urls import handle_api_url
 from nerdwave.user import User
 import api.locale
 import api_requests.info
+import nerdwave.catalog
+import nerdwave.leaderboards
 import nerdwave.playlist
 import nerdwave.schedule
+import nerdwave.search_index
+import nerdwave.song_ranks
+from nerdwave.playlist_objects import object_cache
 
 from libs import cache
 from libs import log
@@ -37,13 +43,30 @@ from libs import config
 from libs import zeromq
 
 
+def _get_fanout_batch_size():
+    if config.has("sync_fanout_batch_size") and config.get("sync_fanout_batch_size"):
+        return config.get("sync_fanout_batch_size")
+    return 100
+
+
+def _get_fanout_deadline():
+    if config.has("sync_fanout_deadline") and config.get("sync_fanout_deadline"):
+        return config.get("sync_fanout_deadline")
+    return 5
+
+
 class SessionBank:
-    def __init__(self):
+    def __init__(self, sid=None):
         super(SessionBank, self).__init__()
+        self.sid = sid
         self.sessions = []
         self.websockets = []
         self.throttled = {}
         self.websockets_by_user = {}
+        # fan-out bookkeeping, keyed by fan-out name (update_all, keep_alive, etc.)
+        self.generations = {}
+        self.pending = {}
+        self.stats = {}
 
     def __iter__(self):
         for item in self.sessions:
@@ -104,54 +127,143 @@ class SessionBank:
                 toret.append(session)
         return toret
 
-    def keep_alive(self):
-        for session in self.sessions + self.websockets:
-            try:
-                session.keep_alive()
-            except Exception as e:
-                session.nw_finish()
-                log.exception("sync", "Session failed keepalive.", e)
+    def _priority(self, session):
+        # DJs, then tuned in listeners, then websockets, then long-poll sessions
+        return (
+            not session.user.is_dj(),
+            not session.user.is_tunedin(),
+            not session.is_websocket,
+        )
 
-    def update_all(self, sid):
+    def queue_depth(self):
+        return sum(self.pending.values())
+
+    def fan_out(self, name, sessions, action, on_error=None, on_done=None):
+        """
+        Runs action(session) for every session in batches, yielding to the IOLoop between
+        batches so that votes, ratings, etc. still get handled during a big update.
+        Starting a new fan-out with the same name makes any older one still in progress stop.
+        """
+        self.generations[name] = self.generations.get(name, 0) + 1
+        tornado.ioloop.IOLoop.current().spawn_callback(
+            self._fan_out,
+            name,
+            self.generations[name],
+            sorted(sessions, key=self._priority),
+            action,
+            on_error,
+            on_done,
+        )
+
+    async def _fan_out(self, name, generation, sessions, action, on_error, on_done):
+        start_time = timestamp()
+        deadline = start_time + _get_fanout_deadline()
+        batch_size = _get_fanout_batch_size()
         session_count = 0
         session_failed_count = 0
-        for session in self.sessions + self.websockets:
-            try:
-                session.update()
-                session_count += 1
-            except Exception as e:
+        batches = 0
+        late = False
+        superseded = False
+        self.pending[name] = len(sessions)
+        for i in range(0, len(sessions), batch_size):
+            if self.generations[name] != generation:
+                superseded = True
+                break
+            for session in sessions[i : i + batch_size]:
                 try:
-                    session.nw_finish()
-                except:
-                    pass
-                session_failed_count += 1
-                log.exception("sync_update_all", "Failed to update session.", e)
+                    action(session)
+                    session_count += 1
+                except Exception as e:
+                    session_failed_count += 1
+                    if on_error:
+                        on_error(session, e)
+            batches += 1
+            self.pending[name] = max(0, len(sessions) - i - batch_size)
+            if not self.pending[name]:
+                break
+            # Once past the deadline, stop yielding and get everyone else done right away
+            if timestamp() < deadline:
+                await asyncio.sleep(0)
+            else:
+                late = True
+        if self.generations[name] == generation:
+            self.pending[name] = 0
+
+        stats = {
+            "sessions": session_count,
+            "failed": session_failed_count,
+            "batches": batches,
+            "time": timestamp() - start_time,
+            "deadline_missed": late,
+            "superseded": superseded,
+            "finished_at": timestamp(),
+        }
+        self.stats[name] = stats
         log.debug(
-            "sync_update_all",
-            "Updated %s sessions (%s failed) for sid %s."
-            % (session_count, session_failed_count, sid),
+            "sync_%s" % name,
+            "Updated %s sessions (%s failed) for sid %s in %s batches, %.6f (%.6f per session)%s."
+            % (
+                session_count,
+                session_failed_count,
+                self.sid,
+                batches,
+                stats["time"],
+                stats["time"] / max(1, session_count + session_failed_count),
+                ", superseded" if superseded else "",
+            ),
         )
+        if late:
+            log.warn(
+                "sync_%s" % name,
+                "SID %s fan-out of %s sessions missed its deadline."
+                % (self.sid, len(sessions)),
+            )
+        if on_done:
+            on_done()
+
+    def _finish_failed(self, name):
+        def on_error(session, e):
+            try:
+                session.nw_finish()
+            except:
+                pass
+            log.exception("sync_%s" % name, "Failed to update session.", e)
+
+        return on_error
+
+    def keep_alive(self):
+        self.fan_out(
+            "keep_alive",
+            self.sessions + self.websockets,
+            lambda session: session.keep_alive(),
+            self._finish_failed("keep_alive"),
+        )
+
+    def _update_session(self, session, broadcast):
+        # a full update includes the user update, so any pending throttled one can go
+        if session in self.throttled:
+            tornado.ioloop.IOLoop.instance().remove_timeout(self.throttled[session])
+            del self.throttled[session]
+        if not session.is_websocket and getattr(session, "_finished", False):
+            return
+        session.update(broadcast)
 
-        self.clear()
+    def update_all(self, sid):
+        broadcast = api_requests.info.build_sync_broadcast(sid)
+        self.fan_out(
+            "update_all",
+            self.sessions + self.websockets,
+            lambda session: self._update_session(session, broadcast),
+            self._finish_failed("update_all"),
+        )
 
     def update_dj(self):
-        for session in self.websockets:
-            if session.user.is_dj():
-                try:
-                    session.update_dj_only()
-                    log.debug(
-                        "sync_update_dj", "Updated user %s session." % session.user.id
-                    )
-                except Exception as e:
-                    try:
-                        session.nw_finish()
-                    except:
-                        pass
-                    log.exception(
-                        "sync_update_dj",
-                        "Session failed to be updated during update_dj.",
-                        e,
-                    )
+        self.fan_out(
+            "update_dj",
+            [session for session in self.websockets if session.user.is_dj()],
+            lambda session: session.update_dj_only(),
+            self._finish_failed("update_dj"),
+        )
 
     # this function is only called when the user's tune_in status changes
     # though it does send an update for the whole user() object if the situation
@@ -196,9 +308,15 @@ class SessionBank:
                 session.write_message(data)
 
     def send_to_all(self, uuid_exclusion, data):
-        for session in self.websockets:
-            if not uuid_exclusion == session.uuid:
-                session.write_message(data)
+        message = json.dumps(data).encode("utf-8")
+        self.fan_out(
+            "send_to_all",
+            [session for session in self.websockets if session.uuid != uuid_exclusion],
+            lambda session: session.write_message(message),
+            lambda session, e: log.exception(
+                "sync_send_to_all", "Failed to send to session.", e
+            ),
+        )
 
     def _throttle_session(self, session, updated_by_ip=False):
         if not session in self.throttled:
@@ -236,7 +354,7 @@ def init():
     global websocket_allow_from
 
     for sid in config.station_ids:
-        sessions[sid] = SessionBank()
+        sessions[sid] = SessionBank(sid)
         delayed_live_vote[sid] = None
         delayed_live_vote_timers[sid] = None
     websocket_allow_from = config.get("websocket_allow_from")
@@ -282,10 +400,25 @@ def _on_zmq(messages):
                 delay_live_vote_removal(message["sid"])
                 nerdwave.playlist.update_num_songs()
                 nerdwave.playlist.prepare_cooldown_algorithm(message["sid"])
-                cache.update_local_cache_for_sid(message["sid"])
+                # reloads everything if the message doesn't say what changed, or a tool
+                # wrote to the cache since
+                if cache.update_local_cache_for_sid(
+                    message["sid"], message.get("changes")
+                ):
+                    nerdwave.catalog.refresh_local(message["sid"])
+                    nerdwave.leaderboards.refresh_local()
+                nerdwave.song_ranks.update(message["sid"])
+                object_cache.check_catalog_version()
+                nerdwave.search_index.update(
+                    message["sid"], cache.get_station(message["sid"], "album_diff")
+                )
                 sessions[message["sid"]].update_all(message["sid"])
                 votes_by = {}
                 last_vote_by = {}
+            elif message["action"] == "cache_changed":
+                cache.apply_changes(message["changes"])
+            elif message["action"] == "invalidate_objects":
+                object_cache.on_invalidate(message)
             elif message["action"] == "update_ip":
                 for sid in sessions:
                     sessions[sid].update_ip_address(message["ip"])
@@ -353,6 +486,7 @@ class Sync(APIHandler):
     is_websocket = False
     dj = False
     wait_future = None
+    _raw_output = None
 
     async def post(self):
         global sessions
@@ -416,7 +550,7 @@ class Sync(APIHandler):
     def refresh_user(self):
         self.user.refresh(self.sid)
 
-    def update(self):
+    def update(self, broadcast=None):
         # Overwrite this value since who knows how long we've spent idling
         self._startclock = timestamp()
 
@@ -426,9 +560,18 @@ class Sync(APIHandler):
         self.user.refresh(self.sid)
         if "requests_paused" in self.user.data:
             del self.user.data["requests_paused"]
-        api_requests.info.attach_info_to_request(self)
+        if broadcast and broadcast.can_render(self):
+            self._raw_output = broadcast.render(self.user, startclock=self._startclock)
+        else:
+            api_requests.info.attach_info_to_request(self)
         self.finish()
 
+    def write_output(self):
+        if self._raw_output is not None:
+            self.write(self._raw_output)
+        else:
+            super(Sync, self).write_output()
+
     def update_user(self):
         self._startclock = timestamp()
 
@@ -574,7 +717,8 @@ class WSHandler(tornado.websocket.WebSocketHandler):
         super(WSHandler, self).on_close()
 
     def write_message(self, obj, *args, **kwargs):
-        message = json.dumps(obj)
+        # pre-serialized messages (see api_requests.info.SyncBroadcast) are sent as-is
+        message = obj if isinstance(obj, bytes) else json.dumps(obj)
         try:
             super(WSHandler, self).write_message(message, *args, **kwargs)
         except tornado.websocket.WebSocketClosedError:
@@ -778,6 +922,7 @@ class WSHandler(tornado.websocket.WebSocketHandler):
         )
         endpoint.user = self.user
         endpoint._startclock = timestamp()
+        deferred = False
         try:
             # it's required to see if another person on the same IP address has overriden the vote
             # for the in-memory user here, so it requires a DB fetch.
@@ -795,57 +940,36 @@ class WSHandler(tornado.websocket.WebSocketHandler):
                 endpoint.prepare_standalone(message_id)
             else:
                 endpoint.prepare_standalone()
-            endpoint.post()
-            endpoint.append(
-                "api_info",
-                {
-                    "exectime": timestamp() - endpoint._startclock,
-                    "time": round(timestamp()),
-                },
-            )
-            if endpoint.sync_across_sessions:
-                if (
-                    endpoint.return_name in endpoint._output
-                    and isinstance(endpoint._output[endpoint.return_name], dict)
-                    and not endpoint._output[endpoint.return_name]["success"]
-                ):
-                    pass
-                else:
-                    zeromq.publish(
-                        {
-                            "action": "result_sync",
-                            "sid": self.sid,
-                            "user_id": self.user.id,
-                            "data": endpoint._output,
-                            "uuid_exclusion": self.uuid,
-                        }
-                    )
-            if (
-                message["action"] == "/api4/vote"
-                and endpoint.return_name in endpoint._output
-                and isinstance(endpoint._output[endpoint.return_name], dict)
-                and endpoint._output[endpoint.return_name]["success"]
-            ):
-                live_voting = nerdwave.schedule.update_live_voting(self.sid)
-                endpoint.append("live_voting", live_voting)
-                if self.should_vote_throttle():
-                    zeromq.publish(
-                        {
-                            "action": "delayed_live_voting",
-                            "sid": self.sid,
-                            "uuid_exclusion": self.uuid,
-                            "data": {"live_voting": live_voting},
-                        }
-                    )
-                else:
-                    zeromq.publish(
-                        {
-                            "action": "live_voting",
-                            "sid": self.sid,
-                            "uuid_exclusion": self.uuid,
-                            "data": {"live_voting": live_voting},
-                        }
-                    )
+            result = endpoint.post()
+            if inspect.isawaitable(result):
+                # endpoints with an async post (e.g. ones using db.async_cursor) finish
+                # in the background so this socket can keep handling messages
+                deferred = True
+                tornado.ioloop.IOLoop.current().spawn_callback(
+                    self._await_endpoint, message, endpoint, result
+                )
+            else:
+                self._endpoint_done(message, endpoint)
+        except APIException as e:
+            endpoint.write_error(e.code, exc_info=sys.exc_info(), no_finish=True)
+            if e.code != 200:
+                log.exception("websocket", "API Exception during operation.", e)
+        except Exception as e:
+            endpoint.write_error(500, exc_info=sys.exc_info(), no_finish=True)
+            log.exception("websocket", "API Exception during operation.", e)
+        finally:
+            if not deferred:
+                self.write_message(endpoint._output)
+
+    async def _await_endpoint(self, message, endpoint, result):
+        """
+        Finishes an endpoint whose post() is "async def", awaiting
+        libs.db.async_cursor() queries instead of blocking on db.c.  HTTP and
+        pretty-printed requests get the same through Tornado awaiting prepare().
+        """
+        try:
+            await result
+            self._endpoint_done(message, endpoint)
         except APIException as e:
             endpoint.write_error(e.code, exc_info=sys.exc_info(), no_finish=True)
             if e.code != 200:
@@ -856,7 +980,59 @@ class WSHandler(tornado.websocket.WebSocketHandler):
         finally:
             self.write_message(endpoint._output)
 
-    def update(self):
+    def _endpoint_done(self, message, endpoint):
+        endpoint.append(
+            "api_info",
+            {
+                "exectime": timestamp() - endpoint._startclock,
+                "time": round(timestamp()),
+            },
+        )
+        if endpoint.sync_across_sessions:
+            if (
+                endpoint.return_name in endpoint._output
+                and isinstance(endpoint._output[endpoint.return_name], dict)
+                and not endpoint._output[endpoint.return_name]["success"]
+            ):
+                pass
+            else:
+                zeromq.publish(
+                    {
+                        "action": "result_sync",
+                        "sid": self.sid,
+                        "user_id": self.user.id,
+                        "data": endpoint._output,
+                        "uuid_exclusion": self.uuid,
+                    }
+                )
+        if (
+            message["action"] == "/api4/vote"
+            and endpoint.return_name in endpoint._output
+            and isinstance(endpoint._output[endpoint.return_name], dict)
+            and endpoint._output[endpoint.return_name]["success"]
+        ):
+            live_voting = nerdwave.schedule.update_live_voting(self.sid)
+            endpoint.append("live_voting", live_voting)
+            if self.should_vote_throttle():
+                zeromq.publish(
+                    {
+                        "action": "delayed_live_voting",
+                        "sid": self.sid,
+                        "uuid_exclusion": self.uuid,
+                        "data": {"live_voting": live_voting},
+                    }
+                )
+            else:
+                zeromq.publish(
+                    {
+                        "action": "live_voting",
+                        "sid": self.sid,
+                        "uuid_exclusion": self.uuid,
+                        "data": {"live_voting": live_voting},
+                    }
+                )
+
+    def update(self, broadcast=None):
         handler = APIHandler(websocket=True)
         handler.locale = self.locale
         handler.request = typing.cast(
@@ -874,6 +1050,12 @@ class WSHandler(tornado.websocket.WebSocketHandler):
                 raise APIException("station_offline")
 
             self.refresh_user()
+            if broadcast and broadcast.can_render(handler):
+                self.write_message(
+                    broadcast.render(self.user, live_voting=True, startclock=startclock)
+                )
+                handler = None
+                return
             api_requests.info.attach_info_to_request(handler, live_voting=True)
             if self.user.is_dj():
                 api_requests.info.attach_dj_info_to_request(handler)
@@ -893,6 +1075,13 @@ class WSHandler(tornado.websocket.WebSocketHandler):
     def update_user(self):
         self.write_message({"user": self.user.to_private_dict()})
 
+    def update_dj_only(self):
+        handler = APIHandler(websocket=True)
+        handler.sid = self.sid
+        handler._output = {}
+        api_requests.info.attach_dj_info_to_request(handler)
+        self.write_message(handler._output)
+
     def login_mixup_warn(self):
         self.write_message(
             {
@@ -1017,3 +1206,26 @@ class WSHandler(tornado.websocket.WebSocketHandler):
         if sched_current_dict and (sched_current_dict["id"] != message["sched_id"]):
             self.update()
             self.write_message({"outdated_data_warning": {"outdated": True}})
+
+
+@handle_api_url("admin/sync_fanout")
+class SyncFanoutStats(APIHandler):
+    description = "Fan-out queue depth and timings for the API process that answers this request."
+    return_name = "sync_fanout"
+    admin_required = True
+    sid_required = False
+
+    def post(self):
+        self.append(
+            self.return_name,
+            {
+                sid: {
+                    "queue_depth": bank.queue_depth(),
+                    "pending": bank.pending,
+                    "sessions": len(bank.sessions),
+                    "websockets": len(bank.websockets),
+                    "fanouts": bank.stats,
+                }
+                for sid, bank in sessions.items()
+            },
+        )
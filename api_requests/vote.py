@@ -1,4 +1,3 @@
-import typing
 from time import time as timestamp
 
 from api import fieldtypes
@@ -6,8 +5,7 @@ from api.web import APIHandler
 from api.exceptions import APIException
 from api.urls import handle_api_url
 import nerdwave.schedule
-from nerdwave.events.event import BaseEvent
-from nerdwave.events.election import Election
+from nerdwave import listener_stats
 
 from libs import cache
 from libs import config
@@ -34,15 +32,12 @@ class SubmitVote(APIHandler):
         lock_count = 0
         voted = False
         elec_id = None
-        for event in typing.cast(
-            list[BaseEvent], cache.get_station(self.sid, "sched_next")
-        ):
+        sched_snapshot = cache.get_station(self.sid, "sched_snapshot")
+        for event in sched_snapshot.next if sched_snapshot else ():
             lock_count += 1
             if (
                 event.is_election
-                and typing.cast(Election, event).has_entry_id(
-                    self.get_argument("entry_id")
-                )
+                and event.has_entry_id(self.get_argument("entry_id"))
                 and len(event.songs) > 1
             ):
                 elec_id = event.id
@@ -77,6 +72,7 @@ class SubmitVote(APIHandler):
     def vote(self, entry_id, event, lock_count):
         # Subtract a previous vote from the song's total if there was one
         already_voted = False
+        new_vote = False
         if self.user.is_anonymous():
             # log.debug("vote", "Anon already voted: %s" % (self.user.data['voted_entry'],))
             if (
@@ -176,10 +172,11 @@ class SubmitVote(APIHandler):
                         "UPDATE phpbb_users SET radio_inactive = FALSE, radio_last_active = %s WHERE user_id = %s",
                         (timestamp(), self.user.id),
                     )
+                    new_vote = True
 
                     autovoted_entry = event.has_request_by_user(self.user.id)
                     if autovoted_entry:
-                        event.add_vote_to_entry(autovoted_entry.data["entry_id"], -1)
+                        event.add_vote_to_entry(autovoted_entry.entry_id, -1)
 
                 user_vote_cache = cache.get_user(self.user, "vote_history")
                 if not user_vote_cache:
@@ -208,4 +205,6 @@ class SubmitVote(APIHandler):
             db.c.rollback()
             raise
 
+        if new_vote:
+            listener_stats.record_vote(self.user.id, event.sid)
         return True
@@ -1,7 +1,12 @@
 import os
 import os.path
 from time import time as timestamp
+import concurrent.futures
+import hashlib
+import json
 import mimetypes
+import multiprocessing
+import shutil
 import sys
 import psutil
 import traceback
@@ -13,14 +18,23 @@ from libs import config
 from libs import log
 from libs import cache
 from libs import db
+from libs import replaygain
 
+from nerdwave import catalog
 from nerdwave import playlist
-from nerdwave.playlist_objects.song import PassableScanError
+from nerdwave.playlist_objects.song import PassableScanError, read_tags
 
 mimetypes.init()
 
-_found_album_art = []
+# Art that had no songs to match yet: { directory: { filename: sids } }
+_found_album_art = {}
 _on_screen = False
+# Source art file -> what was rendered from it, see _get_art_manifest
+_art_manifest = None
+_art_manifest_dirty = False
+_art_manifest_saved_at = 0
+# the monitor saves the manifest at most this often, rather than after every image
+ART_MANIFEST_SAVE_INTERVAL = 30
 
 
 class AlbumArtNoAlbumFoundError(PassableScanError):
@@ -31,9 +45,10 @@ def write_unmatched_art_log():
     with open(
         os.path.join(config.get_directory("log_dir"), "nw_unmatched_art.log"), "w"
     ) as unmatched_log:
-        for album_art_tuple in _found_album_art:
-            unmatched_log.write(album_art_tuple[0])
-            unmatched_log.write("\n")
+        for found in _found_album_art.values():
+            for filename in found.keys():
+                unmatched_log.write(filename)
+                unmatched_log.write("\n")
 
 
 def set_on_screen(on_screen):
@@ -55,19 +70,21 @@ def _common_init():
         pass
 
 
-def full_music_scan(full_reset):
+def full_music_scan(full_reset, jobs=1):
     _common_init()
     db.connect()
     cache.connect()
-    db.c.start_transaction()
 
-    try:
+    # Songs are written in batches of their own transactions (see _scan_songs) rather
+    # than holding one transaction open for the length of a full scan.
+    with db.c.transaction():
         if full_reset:
             db.c.update("UPDATE r4_songs SET song_file_mtime = 0")
         db.c.update("UPDATE r4_songs SET song_scanned = FALSE")
 
-        _scan_all_directories()
+    _scan_all_directories(jobs=jobs)
 
+    with db.c.transaction():
         # This procedure is slow but steady and easy to use.
         dead_songs = db.c.fetch_list(
             "SELECT song_id FROM r4_songs WHERE song_scanned = FALSE AND song_verified = TRUE"
@@ -75,21 +92,19 @@ def full_music_scan(full_reset):
         for song_id in dead_songs:
             song = playlist.Song.load_from_id(song_id)
             song.disable()
+    catalog.bump_version()
 
-        db.c.commit()
-
-        _process_found_album_art()
-        print()
-        write_unmatched_art_log()
-    except:
-        db.c.rollback()
-        raise
+    _process_found_album_art(jobs=jobs)
+    _flush_art_manifest()
+    print()
+    write_unmatched_art_log()
 
 
-def full_art_update():
+def full_art_update(jobs=1):
     _common_init()
-    _scan_all_directories(art_only=True)
-    _process_found_album_art()
+    _scan_all_directories(art_only=True, jobs=jobs)
+    _process_found_album_art(jobs=jobs)
+    _flush_art_manifest()
     write_unmatched_art_log()
     print()
 
@@ -101,27 +116,161 @@ def _print_to_screen_inline(txt):
         sys.stdout.flush()
 
 
-def _scan_all_directories(art_only=False):
-    total_files = 0
-    file_counter = 0
-    for directory, sids in config.get("song_dirs").items():
-        for root, _subdirs, files in os.walk(directory, followlinks=True):
-            total_files += len(files)
-            _print_to_screen_inline(f"Prepping {total_files}")
+def _get_scan_batch_size():
+    if config.has("scanner_batch_size") and config.get("scanner_batch_size"):
+        return config.get("scanner_batch_size")
+    return 250
 
+
+def _scan_all_directories(art_only=False, jobs=1):
+    files = []
     for directory, sids in config.get("song_dirs").items():
-        for root, _subdirs, files in os.walk(directory, followlinks=True):
-            for filename in files:
-                filename = os.path.join(root, filename)
-                if art_only and not _is_image(filename):
-                    pass
-                else:
-                    _scan_file(filename, sids)
-                file_counter += 1
+        for root, _subdirs, filenames in os.walk(directory, followlinks=True):
+            for filename in filenames:
+                files.append((os.path.join(root, filename), sids))
+            _print_to_screen_inline(f"Prepping {len(files)}")
+    _print_to_screen_inline("\n")
+
+    songs = []
+    images = []
+    for filename, sids in files:
+        if _is_mp3(filename):
+            songs.append((filename, sids))
+        elif _is_image(filename):
+            images.append((filename, sids))
+
+    if not art_only:
+        _scan_songs(songs, jobs)
+
+    # Art goes last so every album in the library exists by the time it's matched.
+    _process_album_art_batch(images, jobs)
+
+
+def _read_song_file(job):
+    # Runs in a worker process - no database or cache access allowed here.
+    filename, sids, needs_replay_gain = job
+    try:
+        tags = read_tags(filename)
+        replay_gain = None
+        if needs_replay_gain:
+            replay_gain = replaygain.get_gain_for_song(filename)
+        return filename, sids, tags, replay_gain, None
+    except Exception as e:
+        return filename, sids, None, None, e
+
+
+def _write_song_file(filename, sids, tags, replay_gain, error):
+    try:
+        # a savepoint per song, so one bad file doesn't take its batch down with it
+        with db.c.transaction():
+            if error:
+                raise error
+            s = playlist.Song.load_from_file(filename, sids, tags, replay_gain)
+            if not db.c.fetch_var(
+                "SELECT album_id FROM r4_songs WHERE song_id = %s", (s.id,)
+            ):
+                _add_scan_error(
+                    s.filename,
+                    PassableScanError(
+                        "%s was scanned but has no album ID." % s.filename
+                    ),
+                )
+                s.disable()
+        return True
+    except IOError as e:
+        _add_scan_error(filename, e)
+        _disable_file(filename)
+    except Exception as e:
+        _add_scan_error(filename, e, sys.exc_info())
+        _disable_file(filename)
+    return False
+
+
+def _scan_songs(songs, jobs):
+    """
+    Full scan pipeline: mtimes for the whole library are loaded in one query, files
+    that changed have their tags and replay gain read by `jobs` worker processes,
+    and the results are written to the database from this process in batches.
+    """
+    start_time = timestamp()
+    batch_size = _get_scan_batch_size()
+    known = {}
+    for row in db.c.fetch_all(
+        "SELECT song_filename, song_file_mtime, song_replay_gain IS NULL AS needs_replay_gain "
+        "FROM r4_songs WHERE song_verified = TRUE"
+    ):
+        known[row["song_filename"]] = row
+
+    unchanged = []
+    changed = []
+    for filename, sids in songs:
+        try:
+            new_mtime = os.stat(filename)[8]
+        except (IOError, OSError) as e:
+            _add_scan_error(filename, e)
+            _disable_file(filename)
+            continue
+        row = known.get(filename)
+        if row and row["song_file_mtime"] and row["song_file_mtime"] == new_mtime:
+            unchanged.append(filename)
+        else:
+            changed.append((filename, sids, not row or row["needs_replay_gain"]))
+
+    for i in range(0, len(unchanged), batch_size):
+        db.c.update(
+            "UPDATE r4_songs SET song_scanned = TRUE WHERE song_filename = ANY(%s)",
+            (unchanged[i : i + batch_size],),
+        )
+    log.info(
+        "scan",
+        "%s songs unchanged, %s to scan with %s job(s)."
+        % (len(unchanged), len(changed), jobs),
+    )
+
+    executor = None
+    if jobs > 1:
+        # fork, so workers inherit the loaded config without re-importing anything
+        executor = concurrent.futures.ProcessPoolExecutor(
+            jobs, mp_context=multiprocessing.get_context("fork")
+        )
+        results = executor.map(_read_song_file, changed, chunksize=4)
+    else:
+        results = map(_read_song_file, changed)
+
+    scanned = 0
+    errors = 0
+    last_print = 0
+    db.c.start_transaction()
+    try:
+        for result in results:
+            if not _write_song_file(*result):
+                errors += 1
+            scanned += 1
+            if scanned % batch_size == 0:
+                db.c.commit()
+                db.c.start_transaction()
+            if timestamp() - last_print > 0.25:
+                last_print = timestamp()
+                rate = scanned / max(last_print - start_time, 0.001)
                 _print_to_screen_inline(
-                    "%s %s / %s" % (directory, file_counter, total_files)
+                    "Scanned %s / %s, %s errors, %.1f songs/s"
+                    % (scanned, len(changed), errors, rate)
                 )
-        _print_to_screen_inline("\n")
+        db.c.commit()
+    except:
+        db.c.rollback()
+        raise
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+    _print_to_screen_inline("\n")
+
+    elapsed = max(timestamp() - start_time, 0.001)
+    log.info(
+        "scan",
+        "Full scan of %s songs (%s changed, %s errors) took %.1fs, %.1f songs/s."
+        % (len(songs), scanned, errors, elapsed, len(songs) / elapsed),
+    )
 
 
 def _scan_directory(directory, sids):
@@ -206,7 +355,7 @@ def _scan_file(filename, sids):
         try:
             _process_album_art(filename, sids)
         except AlbumArtNoAlbumFoundError:
-            _found_album_art.append((filename, sids))
+            _add_found_album_art(filename, sids)
     return True
 
 
@@ -245,123 +394,339 @@ def _is_image(filename):
     return False
 
 
-def _process_found_album_art(dirname=None):
-    if dirname and not dirname.endswith(os.sep):
-        dirname += os.sep
-    matched_count = 0
-    for album_art_tuple in _found_album_art:
-        filename, sids = album_art_tuple
-        if not dirname or (os.path.dirname(filename) + os.sep) == dirname:
+def _add_found_album_art(filename, sids):
+    _found_album_art.setdefault(os.path.dirname(filename) + os.sep, {})[
+        filename
+    ] = sids
+
+
+def _process_found_album_art(dirname=None, jobs=1):
+    if dirname:
+        if not dirname.endswith(os.sep):
+            dirname += os.sep
+        found = _found_album_art.pop(dirname, None)
+        if not found:
+            return
+        for filename, sids in found.items():
             try:
                 if _process_album_art(filename, sids):
-                    matched_count += 1
-            except:
-                pass
-            if not dirname:
-                _print_to_screen_inline(
-                    "Matched album art: %s/%s"
-                    % (matched_count, len(_found_album_art) - 1)
+                    print(f"Found album art for {dirname}")
+            except AlbumArtNoAlbumFoundError:
+                _add_found_album_art(filename, sids)
+        return
+
+    found = []
+    for found_in_dir in _found_album_art.values():
+        found.extend(found_in_dir.items())
+    _found_album_art.clear()
+    _process_album_art_batch(found, jobs)
+    _print_to_screen_inline(
+        "Matched album art: %s/%s"
+        % (len(found) - sum(len(d) for d in _found_album_art.values()), len(found))
+    )
+    _print_to_screen_inline("\n")
+
+
+def _get_art_manifest_path():
+    return os.path.join(config.get("album_art_file_path"), "nw_art_manifest.json")
+
+
+def _get_art_manifest():
+    """
+    { source filename: { "mtime", "size", "hash", "targets", "formats" } }
+    targets are the output names ("<sid>_<album_id>", "a_<album_id>") last rendered
+    from that file and formats the extensions they were rendered in, so unchanged
+    art for unchanged albums is skipped entirely.
+    """
+    global _art_manifest
+    if _art_manifest is None:
+        try:
+            with open(_get_art_manifest_path()) as manifest_file:
+                _art_manifest = json.load(manifest_file)
+        except (OSError, ValueError):
+            _art_manifest = {}
+    return _art_manifest
+
+
+def _save_art_manifest():
+    global _art_manifest_dirty
+    global _art_manifest_saved_at
+    path = _get_art_manifest_path()
+    try:
+        with open(path + ".tmp", "w") as manifest_file:
+            json.dump(_get_art_manifest(), manifest_file)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        log.warn("album_art", "Could not save album art manifest: %s" % e)
+    _art_manifest_dirty = False
+    _art_manifest_saved_at = timestamp()
+
+
+def _save_art_manifest_later():
+    global _art_manifest_dirty
+    _art_manifest_dirty = True
+    if _art_manifest_saved_at < timestamp() - ART_MANIFEST_SAVE_INTERVAL:
+        _save_art_manifest()
+
+
+def _flush_art_manifest(notifier=None):
+    # also the monitor's pyinotify loop callback, which stops the loop if this returns True
+    if _art_manifest_dirty:
+        _save_art_manifest()
+
+
+def _get_album_ids_for_art(filename):
+    # Album IDs that are associated with the songs in the same directory as the image file.
+    directory = os.path.dirname(filename) + os.sep
+    return db.c.fetch_list(
+        "SELECT DISTINCT album_id FROM r4_songs WHERE song_filename LIKE %s || '%%'",
+        (directory,),
+    )
+
+
+def _get_art_targets(sids, album_ids):
+    targets = []
+    for album_id in album_ids:
+        for sid in sids:
+            targets.append("%s_%s" % (sid, album_id))
+        # sids[0] is the origin SID
+        if sids[0] == config.get("album_art_master_sid") or not os.path.exists(
+            os.path.join(config.get("album_art_file_path"), "a_%s_120.jpg" % album_id)
+        ):
+            targets.append("a_%s" % album_id)
+    return targets
+
+
+def _get_art_formats():
+    if config.has("album_art_webp") and config.get("album_art_webp"):
+        return (("jpg", "JPEG"), ("webp", "WEBP"))
+    return (("jpg", "JPEG"),)
+
+
+def _get_art_extensions():
+    return [extension for extension, _image_format in _get_art_formats()]
+
+
+def _art_is_rendered(entry, targets):
+    """
+    Whether the manifest entry covers every target in every configured format,
+    and the files are still there.
+    """
+    extensions = _get_art_extensions()
+    return (
+        set(targets).issubset(entry["targets"])
+        # entries from before formats were recorded only ever had jpg
+        and set(extensions).issubset(entry.get("formats", ["jpg"]))
+        and _art_targets_exist(targets, extensions)
+    )
+
+
+def _art_targets_exist(targets, extensions):
+    for target in targets:
+        for extension in extensions:
+            if not os.path.exists(
+                os.path.join(
+                    config.get("album_art_file_path"),
+                    "%s_320.%s" % (target, extension),
                 )
-            else:
-                print(f"Found album art for {dirname}")
-    if not dirname:
-        _print_to_screen_inline("\n")
+            ):
+                return False
+    return True
 
 
-def _process_album_art(filename, sids):
-    # Processes album art by finding the album IDs that are associated with the songs that exist
-    # in the same directory as the image file.
+def _get_art_job(filename, sids):
     if not config.get("album_art_enabled"):
-        return True
+        return None
+    album_ids = _get_album_ids_for_art(filename)
+    if not album_ids or len(album_ids) == 0:
+        raise AlbumArtNoAlbumFoundError
+    targets = _get_art_targets(sids, album_ids)
+    entry = _get_art_manifest().get(filename)
+    if entry:
+        stat = os.stat(filename)
+        if (
+            entry["mtime"] == stat.st_mtime
+            and entry["size"] == stat.st_size
+            and _art_is_rendered(entry, targets)
+        ):
+            return None
+    return filename, targets, entry
+
+
+def _hash_art_file(filename):
+    h = hashlib.blake2b(digest_size=20)
+    with open(filename, "rb") as art_file:
+        for chunk in iter(lambda: art_file.read(1048576), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _link_art(source, destination):
+    # Replaces rather than overwrites, so other links to the old file are left alone.
+    tmp_path = "%s.%s.tmp" % (destination, os.getpid())
     try:
-        directory = os.path.dirname(filename) + os.sep
-        album_ids = db.c.fetch_list(
-            "SELECT DISTINCT album_id FROM r4_songs WHERE song_filename LIKE %s || '%%'",
-            (directory,),
-        )
-        if not album_ids or len(album_ids) == 0:
-            raise AlbumArtNoAlbumFoundError
+        os.link(source, tmp_path)
+    except OSError:
+        shutil.copyfile(source, tmp_path)
+    os.replace(tmp_path, destination)
+
+
+def _render_album_art(job):
+    # Runs in a worker process - no database or cache access allowed here.
+    # Returns (filename, new manifest entry, warnings, error)
+    filename, targets, entry = job
+    art_path = config.get("album_art_file_path")
+    warnings = []
+    try:
+        stat = os.stat(filename)
+        art_hash = _hash_art_file(filename)
+        new_entry = {
+            "mtime": stat.st_mtime,
+            "size": stat.st_size,
+            "hash": art_hash,
+            "targets": targets,
+            "formats": _get_art_extensions(),
+        }
+        if entry:
+            # older targets rendered in fewer formats are caught by _art_targets_exist
+            new_entry["targets"] = sorted(set(targets) | set(entry["targets"]))
+            # touched or copied, but the same picture
+            if entry["hash"] == art_hash and _art_is_rendered(entry, targets):
+                return filename, new_entry, warnings, None
+
         with Image.open(filename) as im_original:
             if not im_original:
                 raise IOError
             if im_original.mode != "RGB":
                 im_original = im_original.convert("RGB")
-            im_320 = im_original
-            im_240 = im_original
-            im_120 = im_original
+            renditions = {120: im_original, 240: im_original, 320: im_original}
             if im_original.size[0] > 420 or im_original.size[1] > 420:
-                im_320 = im_original.copy()
-                im_320.thumbnail((320, 320), Image.Resampling.LANCZOS)
+                renditions[320] = im_original.copy()
+                renditions[320].thumbnail((320, 320), Image.Resampling.LANCZOS)
             if im_original.size[0] > 240 or im_original.size[1] > 240:
-                im_240 = im_original.copy()
-                im_240.thumbnail((240, 240), Image.Resampling.LANCZOS)
+                renditions[240] = im_original.copy()
+                renditions[240].thumbnail((240, 240), Image.Resampling.LANCZOS)
             if im_original.size[0] > 160 or im_original.size[1] > 160:
-                im_120 = im_original.copy()
-                im_120.thumbnail((120, 120), Image.Resampling.LANCZOS)
+                renditions[120] = im_original.copy()
+                renditions[120].thumbnail((120, 120), Image.Resampling.LANCZOS)
             if im_original.size[0] < 320 or im_original.size[1] < 320:
-                _add_scan_error(
-                    filename,
-                    PassableScanError(
-                        "Small Art Warning: %sx%s"
-                        % (im_original.size[0], im_original.size[1])
-                    ),
-                )
-            for album_id in album_ids:
-                for sid in sids:
-                    im_120.save(
-                        os.path.join(
-                            config.get("album_art_file_path"),
-                            "%s_%s_120.jpg" % (sid, album_id),
-                        )
-                    )
-                    im_240.save(
-                        os.path.join(
-                            config.get("album_art_file_path"),
-                            "%s_%s_240.jpg" % (sid, album_id),
-                        )
-                    )
-                    im_320.save(
-                        os.path.join(
-                            config.get("album_art_file_path"),
-                            "%s_%s_320.jpg" % (sid, album_id),
-                        )
-                    )
-                a_120_path = os.path.join(
-                    config.get("album_art_file_path"), "a_%s_120.jpg" % (album_id)
+                warnings.append(
+                    "Small Art Warning: %sx%s"
+                    % (im_original.size[0], im_original.size[1])
                 )
-                # sids[0] is the origin SID
-                if sids[0] == config.get("album_art_master_sid") or not os.path.exists(
-                    a_120_path
-                ):
-                    im_120.save(a_120_path)
-                    im_240.save(
-                        os.path.join(
-                            config.get("album_art_file_path"),
-                            "a_%s_240.jpg" % (album_id),
-                        )
-                    )
-                    im_320.save(
-                        os.path.join(
-                            config.get("album_art_file_path"),
-                            "a_%s_320.jpg" % (album_id),
-                        )
+
+            # Each rendition is encoded once, then linked to every sid/album name.
+            for size, im in renditions.items():
+                for extension, image_format in _get_art_formats():
+                    rendered = os.path.join(
+                        art_path,
+                        "%s_%s.%s.%s.tmp" % (art_hash, size, extension, os.getpid()),
                     )
-            log.debug(
-                "album_art", "Scanned %s for album ID %s." % (filename, album_ids)
-            )
-            return True
+                    try:
+                        im.save(rendered, image_format)
+                        for target in targets:
+                            _link_art(
+                                rendered,
+                                os.path.join(
+                                    art_path, "%s_%s.%s" % (target, size, extension)
+                                ),
+                            )
+                    finally:
+                        if os.path.exists(rendered):
+                            os.unlink(rendered)
+        return filename, new_entry, warnings, None
     except (IOError, OSError) as err:
-        _add_scan_error(
+        return (
             filename,
+            None,
+            warnings,
             PassableScanError(
                 f"Could not open album art. (this can happen if a directory has been deleted) {err}"
             ),
         )
-    except AlbumArtNoAlbumFoundError:
-        raise
     except Exception as e:
+        return filename, None, warnings, e
+
+
+def _record_album_art(filename, new_entry, warnings, error):
+    for warning in warnings:
+        _add_scan_error(filename, PassableScanError(warning))
+    if error:
+        try:
+            raise error
+        except Exception as e:
+            _add_scan_error(filename, e, sys.exc_info())
+        return False
+    _get_art_manifest()[filename] = new_entry
+    log.debug(
+        "album_art", "Scanned %s for %s." % (filename, ", ".join(new_entry["targets"]))
+    )
+    return True
+
+
+def _process_album_art(filename, sids):
+    if not config.get("album_art_enabled"):
+        return True
+    try:
+        job = _get_art_job(filename, sids)
+    except (IOError, OSError) as e:
         _add_scan_error(filename, e)
-    return False
+        return False
+    if not job:
+        return True
+    result = _record_album_art(*_render_album_art(job))
+    _save_art_manifest_later()
+    return result
+
+
+def _process_album_art_batch(images, jobs):
+    """
+    Album art for a full scan: matches art to albums here, skips anything the
+    manifest says is already rendered, and renders the rest with `jobs` processes.
+    Art without albums is put aside in _found_album_art.
+    """
+    if not config.get("album_art_enabled") or not images:
+        return
+    start_time = timestamp()
+    art_jobs = []
+    up_to_date = 0
+    for filename, sids in images:
+        try:
+            job = _get_art_job(filename, sids)
+            if job:
+                art_jobs.append(job)
+            else:
+                up_to_date += 1
+        except AlbumArtNoAlbumFoundError:
+            _add_found_album_art(filename, sids)
+        except (IOError, OSError) as e:
+            _add_scan_error(filename, e)
+
+    executor = None
+    if jobs > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(
+            jobs, mp_context=multiprocessing.get_context("fork")
+        )
+        results = executor.map(_render_album_art, art_jobs, chunksize=4)
+    else:
+        results = map(_render_album_art, art_jobs)
+
+    rendered = 0
+    try:
+        for result in results:
+            _record_album_art(*result)
+            rendered += 1
+            _print_to_screen_inline("Album art %s / %s" % (rendered, len(art_jobs)))
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+        _save_art_manifest()
+    _print_to_screen_inline("\n")
+    log.info(
+        "album_art",
+        "%s art files, %s up to date, %s rendered in %.1fs."
+        % (len(images), up_to_date, rendered, timestamp() - start_time),
+    )
 
 
 def _disable_file(filename):
@@ -509,6 +874,9 @@ class FileEventHandler(ProcessEvent):
         except Exception as xception:
             _add_scan_error(event.pathname, xception)
 
+        if event.dir or _is_mp3(event.pathname):
+            catalog.bump_version()
+
 
 def monitor():
     _common_init()
@@ -531,7 +899,12 @@ def monitor():
                 log.info("scan", "File monitor started.")
                 wm = pyinotify.WatchManager()
                 wm.add_watch(config.get("monitor_dir"), mask, rec=True, auto_add=True)
-                pyinotify.Notifier(wm, FileEventHandler()).loop()
+                # wakes up at least every ART_MANIFEST_SAVE_INTERVAL to save the manifest
+                pyinotify.Notifier(
+                    wm,
+                    FileEventHandler(),
+                    timeout=ART_MANIFEST_SAVE_INTERVAL * 1000,
+                ).loop(callback=_flush_art_manifest)
                 go = False
             except NewDirectoryException:
                 log.debug("scan", "New directory added, restarting watch.")
@@ -543,4 +916,5 @@ def monitor():
                 except:
                     pass
     finally:
+        _flush_art_manifest()
         log.info("scan", "File monitor shutdown.")
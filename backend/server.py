@@ -7,8 +7,11 @@ import tornado.process
 import tornado.options
 
 from backend import sync_to_front
+from nerdwave import leaderboards
 from nerdwave import schedule
 from nerdwave import playlist
+from nerdwave.playlist_objects import object_cache
+from nerdwave.playlist_objects import song_pool
 from libs import log
 from libs import config
 from libs import db
@@ -16,6 +19,11 @@ from libs import cache
 from libs import memory_trace
 from libs import zeromq
 
+try:
+    import ujson as json
+except ImportError:
+    import json
+
 
 class AdvanceScheduleRequest(tornado.web.RequestHandler):
     processed = False
@@ -109,6 +117,19 @@ class AdvanceScheduleRequest(tornado.web.RequestHandler):
         return string
 
 
+def _on_zmq(messages):
+    for message in messages:
+        try:
+            message = json.loads(message)
+        except Exception as e:
+            log.exception("zeromq", "Error decoding ZeroMQ message.", e)
+            return
+
+        if message.get("action") == "invalidate_objects":
+            object_cache.on_invalidate(message)
+            song_pool.reset_all()
+
+
 class BackendServer:
     def _listen(self, sid):
         log.init(
@@ -121,7 +142,13 @@ class BackendServer:
         )
         db.connect()
         cache.connect()
+        cache.track_changes()
+        leaderboards.enable_patching()
         zeromq.init_pub()
+        # everything else on the bus is for API processes
+        zeromq.init_sub(actions=("invalidate_objects",))
+        zeromq.set_sub_callback(_on_zmq)
+        object_cache.set_publisher(zeromq.publish)
         memory_trace.setup(config.station_id_friendly[sid].lower())
 
         # (r"/refresh/([0-9]+)", RefreshScheduleRequest)
@@ -138,6 +165,9 @@ class BackendServer:
 
         for station_id in config.station_ids:
             playlist.prepare_cooldown_algorithm(station_id)
+        song_pool.load(sid)
+        object_cache.check_catalog_version()
+        object_cache.setup_reporting()
         schedule.load()
         log.debug(
             "start",
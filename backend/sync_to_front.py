@@ -1,8 +1,11 @@
+from libs import cache
 from libs import zeromq
 
 
 def sync_frontend_all(sid):
-    zeromq.publish({"action": "update_all", "sid": sid})
+    zeromq.publish(
+        {"action": "update_all", "sid": sid, "changes": cache.pop_changes()}
+    )
 
 
 def sync_frontend_ip(ip_address):
@@ -1,5 +1,13 @@
+import pickle
+import re
+from collections import OrderedDict
+from time import time as timestamp
+
+import tornado.ioloop
+
 from libs import config
 from libs import db
+from libs import log
 import pylibmc as libmc
 from api.exceptions import APIException
 
@@ -14,9 +22,44 @@ _memcache_behaviors = {
     "connect_timeout": 1000000,
     "receive_timeout": 5000000,
     "send_timeout": 5000000,
+    "cas": True,
 }
 local = {}
 
+# API processes also keep hot keys they don't hold in local for a few seconds, see
+# setup_local_cache.  key -> (expires_at, value)
+_hot = OrderedDict()
+_hot_names = set()
+_HOT_NAMES = (
+    "backend_ok",
+    "backend_paused",
+    "backend_paused_playing",
+    "pause_title",
+    "catalog_version",
+    "sched_current_dict",
+    "sched_next_dict",
+    "sched_history_dict",
+    "dj_user_ids",
+    "api_keys",
+    "all_station_info",
+)
+_key_prefix = re.compile(r"^(?:sid|u)\d+_")
+_user_key = re.compile(r"^u\d+_")
+_local_stats = {"hits": 0, "misses": 0, "bytes": 0, "refetched": 0}
+
+# Every key set gets a generation.  The backend collects the keys it sets during a song
+# change and sends them with update_all, so API processes only refetch what changed.
+# key -> generation last set or fetched by this process
+_generations = {}
+_last_generation = 0
+# key -> generation, set since the last pop_changes, in processes that track_changes
+_changes = {}
+_tracking = False
+# zeromq.publish in API processes, to announce hot keys they set themselves
+_publish = None
+# sid -> cache_generation when API processes last reloaded the station's local keys
+_seen_generations = {}
+
 
 class TestModeCache:
     def __init__(self):
@@ -31,6 +74,29 @@ class TestModeCache:
     def set(self, key, value):
         self.vars[key] = value
 
+    def get_multi(self, keys):
+        return {key: self.vars[key] for key in keys if key in self.vars}
+
+    def set_multi(self, mapping):
+        self.vars.update(mapping)
+
+    def gets(self, key):
+        if not key in self.vars:
+            return (None, None)
+        return (self.vars[key], id(self.vars[key]))
+
+    def cas(self, key, value, cas_id):
+        if key in self.vars and id(self.vars[key]) == cas_id:
+            self.vars[key] = value
+            return True
+        return False
+
+    def add(self, key, value):
+        if key in self.vars:
+            return False
+        self.vars[key] = value
+        return True
+
 
 def connect():
     global _memcache
@@ -59,20 +125,202 @@ def connect():
         _memcache_ratings.get("hello")
 
 
+def _get_local_cache_size():
+    if config.has("local_cache_size"):
+        return config.get("local_cache_size")
+    return 5000
+
+
+def _get_local_cache_ttl():
+    if config.has("local_cache_ttl"):
+        return config.get("local_cache_ttl")
+    return 5
+
+
+def _get_local_cache_report_interval():
+    if config.has("local_cache_report_interval"):
+        return config.get("local_cache_report_interval")
+    return 3600
+
+
+def _is_hot(key):
+    return bool(_hot_names) and _key_prefix.sub("", key, count=1) in _hot_names
+
+
+def _next_generation():
+    global _last_generation
+    _last_generation = max(int(timestamp() * 1000000), _last_generation + 1)
+    return _last_generation
+
+
+def _measure(value):
+    return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+
+def _set_hot(key, value):
+    _hot[key] = (timestamp() + _get_local_cache_ttl(), value)
+    _hot.move_to_end(key)
+    while len(_hot) > _get_local_cache_size():
+        _hot.popitem(last=False)
+
+
+def setup_local_cache(publish):
+    """
+    Called by API processes.  Keeps hot keys in memory for local_cache_ttl seconds,
+    announces hot keys this process sets, and logs hit rates.
+    """
+    global _publish
+    global _hot_names
+    _publish = publish
+    if _get_local_cache_size() > 0 and _get_local_cache_ttl() > 0:
+        if config.has("local_cache_keys"):
+            _hot_names = set(config.get("local_cache_keys"))
+        else:
+            _hot_names = set(_HOT_NAMES)
+    if _get_local_cache_report_interval():
+        tornado.ioloop.PeriodicCallback(
+            report_local_stats, _get_local_cache_report_interval() * 1000
+        ).start()
+
+
+def track_changes():
+    """
+    Called by the backend.  Keys it sets are collected until pop_changes.
+    """
+    global _tracking
+    _tracking = True
+
+
+def pop_changes():
+    if not _tracking:
+        return None
+    changes = dict(_changes)
+    _changes.clear()
+    return changes
+
+
 def set_global(key, value, save_local=False):
     if not _memcache:
         raise APIException("internal_error", "No memcache connection.", http_code=500)
-    if save_local or key in local:
-        local[key] = value
     _memcache.set(key, value)
+    _after_set(key, value, save_local)
+
+
+def update_global(key, update, save_local=False, retries=10):
+    """
+    Read-modify-write for keys that several processes change at once.
+    update(value) gets the current value and returns the new one, or None to leave
+    the key alone.  It may be called again with a fresher value if another process
+    wrote the key in between.  Returns the value written, or None.
+    """
+    if not _memcache:
+        raise APIException("internal_error", "No memcache connection.", http_code=500)
+    for _ in range(retries):
+        value, cas_id = _memcache.gets(key)
+        value = update(value)
+        if value is None:
+            return None
+        if cas_id is None:
+            written = _memcache.add(key, value)
+        else:
+            written = _memcache.cas(key, value, cas_id)
+        if written:
+            _after_set(key, value, save_local)
+            return value
+    log.warn("cache", "Gave up updating %s after %s tries." % (key, retries))
+    return None
+
+
+def _after_set(key, value, save_local):
+    held = key in local
+    if save_local or held:
+        local[key] = value
+    hot = _is_hot(key)
+    if hot:
+        _set_hot(key, value)
+    # user keys change all the time and are only ever read straight from memcache,
+    # so only the hot ones get a generation
+    if not hot and _user_key.match(key):
+        return
+    generation = _next_generation()
+    _generations[key] = generation
+    if _tracking:
+        _changes[key] = generation
+    if _publish and (hot or held):
+        _publish({"action": "cache_changed", "changes": {key: generation}})
 
 
 def get(key):
     if not _memcache:
         raise APIException("internal_error", "No memcache connection.", http_code=500)
     if key in local:
+        _local_stats["hits"] += 1
         return local[key]
-    return _memcache.get(key)
+    if not _is_hot(key):
+        return _memcache.get(key)
+    cached = _hot.get(key)
+    if cached and cached[0] > timestamp():
+        _hot.move_to_end(key)
+        _local_stats["hits"] += 1
+        return cached[1]
+    value = _memcache.get(key)
+    _local_stats["misses"] += 1
+    _local_stats["bytes"] += _measure(value)
+    _set_hot(key, value)
+    return value
+
+
+def apply_changes(changes):
+    """
+    Called by API processes with the keys another process says it set.  Refetches the
+    changed keys held in local in one round trip and drops changed hot keys.
+    Returns the keys whose generation was new to this process.
+    """
+    changed = [key for key in changes if _generations.get(key) != changes[key]]
+    if not changed:
+        return changed
+    refetch = [key for key in changed if key in local]
+    fetched = _memcache.get_multi(refetch) if refetch else {}
+    for key in changed:
+        _hot.pop(key, None)
+        _generations[key] = changes[key]
+    for key in refetch:
+        local[key] = fetched.get(key)
+        _local_stats["bytes"] += _measure(local[key])
+    _local_stats["refetched"] += len(refetch)
+    return changed
+
+
+def get_local_stats():
+    loads = _local_stats["hits"] + _local_stats["misses"]
+    return {
+        "size": len(_hot),
+        "local_size": len(local),
+        "hits": _local_stats["hits"],
+        "misses": _local_stats["misses"],
+        "bytes": _local_stats["bytes"],
+        "refetched": _local_stats["refetched"],
+        "hit_rate": (_local_stats["hits"] / loads * 100) if loads else 0,
+    }
+
+
+def report_local_stats():
+    stats = get_local_stats()
+    log.info(
+        "local_cache",
+        "%s hot keys and %s local keys, %s hits, %s misses (%.1f%%), %s keys refetched on change, %s bytes fetched."
+        % (
+            stats["size"],
+            stats["local_size"],
+            stats["hits"],
+            stats["misses"],
+            stats["hit_rate"],
+            stats["refetched"],
+            stats["bytes"],
+        ),
+    )
+    for key in _local_stats:
+        _local_stats[key] = 0
 
 
 def set_user(user, key, value):
@@ -82,6 +330,13 @@ def set_user(user, key, value):
         set_global("u%s_%s" % (user.id, key), value)
 
 
+def update_user(user, key, update):
+    if user.__class__.__name__ == "int" or user.__class__.__name__ == "long":
+        return update_global("u%s_%s" % (user, key), update)
+    else:
+        return update_global("u%s_%s" % (user.id, key), update)
+
+
 def get_user(user, key):
     if user.__class__.__name__ == "int" or user.__class__.__name__ == "long":
         return get("u%s_%s" % (user, key))
@@ -109,6 +364,36 @@ def get_song_rating(song_id, user_id):
     return _memcache_ratings.get("rating_song_%s_%s" % (song_id, user_id))
 
 
+def get_song_ratings(song_ids, user_id):
+    """
+    Returns a dict of song_id: rating for the songs that were found in the cache.
+    """
+    if not _memcache_ratings:
+        raise APIException("internal_error", "No memcache connection.", http_code=500)
+    keys = {"rating_song_%s_%s" % (song_id, user_id): song_id for song_id in song_ids}
+    if not keys:
+        return {}
+    return {
+        keys[key]: rating
+        for key, rating in _memcache_ratings.get_multi(list(keys)).items()
+    }
+
+
+def set_song_ratings(ratings, user_id):
+    """
+    ratings: dict of song_id: rating
+    """
+    if not _memcache_ratings:
+        raise APIException("internal_error", "No memcache connection.", http_code=500)
+    if ratings:
+        _memcache_ratings.set_multi(
+            {
+                "rating_song_%s_%s" % (song_id, user_id): rating
+                for song_id, rating in ratings.items()
+            }
+        )
+
+
 def set_album_rating(sid, album_id, user_id, rating):
     if not _memcache_ratings:
         raise APIException("internal_error", "No memcache connection.", http_code=500)
@@ -128,13 +413,160 @@ def get_album_rating(sid, album_id, user_id):
     return _memcache_ratings.get("rating_album_%s_%s_%s" % (sid, album_id, user_id))
 
 
+def get_album_ratings(sid, album_ids, user_id):
+    """
+    Returns a dict of album_id: rating for the albums that were found in the cache.
+    """
+    if not _memcache_ratings:
+        raise APIException("internal_error", "No memcache connection.", http_code=500)
+    keys = {
+        "rating_album_%s_%s_%s" % (sid, album_id, user_id): album_id
+        for album_id in album_ids
+    }
+    if not keys:
+        return {}
+    return {
+        keys[key]: rating
+        for key, rating in _memcache_ratings.get_multi(list(keys)).items()
+    }
+
+
+def set_album_ratings(sid, ratings, user_id):
+    """
+    ratings: dict of album_id: rating
+    """
+    if not _memcache_ratings:
+        raise APIException("internal_error", "No memcache connection.", http_code=500)
+    if ratings:
+        _memcache_ratings.set_multi(
+            {
+                "rating_album_%s_%s_%s" % (sid, album_id, user_id): rating
+                for album_id, rating in ratings.items()
+            }
+        )
+
+
+# (sid, song_id): time the song's (and its album's) ratings were last primed
+_rating_cache_primed = {}
+
+
+def _get_prime_ttl():
+    if config.has("rating_cache_prime_ttl") and config.get("rating_cache_prime_ttl"):
+        return config.get("rating_cache_prime_ttl")
+    return 3600
+
+
+def _get_prime_batch_size():
+    if config.has("rating_cache_prime_batch") and config.get(
+        "rating_cache_prime_batch"
+    ):
+        return config.get("rating_cache_prime_batch")
+    return 1000
+
+
+def _stream_set_multi(query, params, to_item):
+    # Writes query results to the ratings cache in batches rather than all at once
+    count = 0
+    for rows in db.fetch_batches(query, params, _get_prime_batch_size()):
+        _memcache_ratings.set_multi(dict(to_item(row) for row in rows))
+        count += len(rows)
+    return count
+
+
 def prime_rating_cache_for_events(sid, events, songs=None):
+    """
+    Loads ratings for the songs (and their albums) of the given events into the ratings cache.
+
+    Rating changes write through to the cache (see nerdwave.rating), so a song only needs priming
+    again when it hasn't been primed in rating_cache_prime_ttl seconds, or when ratings for it were
+    written since that didn't come through the API.  Users without a rating or fave aren't primed;
+    nerdwave.rating fills those in on demand.
+    """
+    if not _memcache_ratings:
+        raise APIException("internal_error", "No memcache connection.", http_code=500)
+    all_songs = {}
     for e in events:
         for song in e.songs:
-            prime_rating_cache_for_song(song, sid)
+            all_songs[song.id] = song
     if songs:
         for song in songs:
-            prime_rating_cache_for_song(song, sid)
+            all_songs[song.id] = song
+    if not all_songs:
+        return
+
+    t = timestamp()
+    expire_before = t - _get_prime_ttl()
+    candidates = {}
+    for song_id, song in all_songs.items():
+        primed_at = _rating_cache_primed.get((sid, song_id))
+        if not primed_at or primed_at < expire_before:
+            candidates[song_id] = song
+    primed = [song_id for song_id in all_songs if song_id not in candidates]
+    if primed:
+        for row in db.c.fetch_all(
+            "SELECT song_id, MAX(song_rated_at) AS rated_at FROM r4_song_ratings WHERE song_id = ANY(%s) GROUP BY song_id",
+            (primed,),
+        ):
+            primed_at = _rating_cache_primed[(sid, row["song_id"])]
+            if row["rated_at"] and row["rated_at"] >= primed_at:
+                candidates[row["song_id"]] = all_songs[row["song_id"]]
+    if not candidates:
+        return
+
+    song_ids = list(candidates)
+    album_ids = list(set(song.album.id for song in candidates.values() if song.album))
+    song_rows = _stream_set_multi(
+        "SELECT song_id, r4_song_ratings.user_id, song_rating_user, song_fave "
+        "FROM r4_song_ratings JOIN phpbb_users USING (user_id) "
+        "WHERE radio_inactive = FALSE AND song_id = ANY(%s) "
+        "AND (song_rating_user IS NOT NULL OR song_fave = TRUE)",
+        (song_ids,),
+        lambda row: (
+            "rating_song_%s_%s" % (row["song_id"], row["user_id"]),
+            {"rating_user": row["song_rating_user"], "fave": row["song_fave"]},
+        ),
+    )
+    album_rows = 0
+    if album_ids:
+        album_rows = _stream_set_multi(
+            "SELECT album_ratings.album_id, album_ratings.user_id, album_rating_user, album_rating_complete, album_fave "
+            "FROM ("
+            "SELECT COALESCE(r4_album_ratings.album_id, faves.album_id) AS album_id, "
+            "COALESCE(r4_album_ratings.user_id, faves.user_id) AS user_id, "
+            "album_rating_user, album_rating_complete, album_fave "
+            "FROM (SELECT * FROM r4_album_ratings WHERE sid = %s AND album_id = ANY(%s) AND album_rating_user IS NOT NULL) AS r4_album_ratings "
+            "FULL OUTER JOIN (SELECT * FROM r4_album_faves WHERE album_id = ANY(%s) AND album_fave = TRUE) AS faves "
+            "ON (r4_album_ratings.album_id = faves.album_id AND r4_album_ratings.user_id = faves.user_id)"
+            ") AS album_ratings "
+            "JOIN phpbb_users ON (phpbb_users.user_id = album_ratings.user_id) "
+            "WHERE phpbb_users.radio_inactive = FALSE",
+            (sid, album_ids, album_ids),
+            lambda row: (
+                "rating_album_%s_%s_%s" % (sid, row["album_id"], row["user_id"]),
+                {
+                    "rating_user": row["album_rating_user"] or 0,
+                    "fave": row["album_fave"] or False,
+                    "rating_complete": row["album_rating_complete"] or False,
+                },
+            ),
+        )
+
+    for song_id in song_ids:
+        _rating_cache_primed[(sid, song_id)] = t
+    # forget about songs that have fallen out of the schedule
+    for key in [k for k, v in _rating_cache_primed.items() if v < expire_before]:
+        del _rating_cache_primed[key]
+    log.debug(
+        "rating_cache",
+        "Primed %s songs (%s skipped), %s song ratings and %s album ratings in %.6f"
+        % (
+            len(song_ids),
+            len(all_songs) - len(song_ids),
+            song_rows,
+            album_rows,
+            timestamp() - t,
+        ),
+    )
 
 
 def prime_rating_cache_for_song(song, sid):
@@ -158,34 +590,72 @@ def refresh_local_station(sid, key):
     local["sid%s_%s" % (sid, key)] = _memcache.get("sid%s_%s" % (sid, key))
 
 
-def update_local_cache_for_sid(sid):
-    refresh_local_station(sid, "album_diff")
-    refresh_local_station(sid, "sched_next")
-    refresh_local_station(sid, "sched_history")
-    refresh_local_station(sid, "sched_current")
-    refresh_local_station(sid, "sched_next_dict")
-    refresh_local_station(sid, "sched_history_dict")
-    refresh_local_station(sid, "sched_current_dict")
-    refresh_local_station(sid, "current_listeners")
-    refresh_local_station(sid, "request_line")
-    refresh_local_station(sid, "request_user_positions")
-    refresh_local_station(sid, "user_rating_acl")
-    refresh_local_station(sid, "user_rating_acl_song_index")
-    refresh_local("request_expire_times")
-
-    all_stations = {}
-    for station_id in config.station_ids:
-        all_stations[station_id] = get_station(station_id, "all_station_info")
-    set_global("all_stations_info", all_stations)
+_LOCAL_STATION_KEYS = (
+    "album_diff",
+    "sched_snapshot",
+    "sched_next_dict",
+    "sched_history_dict",
+    "sched_current_dict",
+    "current_listeners",
+    "request_line",
+    "request_user_positions",
+    "user_rating_acl",
+    "user_rating_acl_song_index",
+)
+
+
+def bump_generation():
+    """
+    Call from tools that write keys outside the backend (scanner, recalculate_*, etc.).
+    API processes reload everything on their next update_all, since nothing told them
+    which keys changed.
+    """
+    set_global("cache_generation", timestamp())
+
+
+def update_local_cache_for_sid(sid, changes=None):
+    """
+    Called by API processes on start (changes is None) to load everything they keep in
+    local, and on update_all with the keys the backend changed.
+    Returns True if everything was reloaded, in which case callers should reload
+    whatever else they keep in local too.
+    """
+    generation = _memcache.get("cache_generation")
+    if changes is None or _seen_generations.get(sid) != generation:
+        for key in _LOCAL_STATION_KEYS:
+            refresh_local_station(sid, key)
+        refresh_local("request_expire_times")
+        if sid in _seen_generations:
+            _hot.clear()
+        _seen_generations[sid] = generation
+        changed = None
+    else:
+        changed = apply_changes(changes)
+
+    station_info_keys = [
+        "sid%s_all_station_info" % station_id for station_id in config.station_ids
+    ]
+    if (
+        changed is None
+        or "all_stations_info" not in local
+        or any(key in changed for key in station_info_keys)
+    ):
+        all_stations = {}
+        for station_id in config.station_ids:
+            all_stations[station_id] = get_station(station_id, "all_station_info")
+        local["all_stations_info"] = all_stations
+    return changed is None
 
 
 def reset_station_caches():
+    bump_generation()
     set_global("request_expire_times", None, True)
     for sid in config.station_ids:
         set_station(sid, "album_diff", None, True)
         set_station(sid, "sched_next", None, True)
         set_station(sid, "sched_history", None, True)
         set_station(sid, "sched_current", None, True)
+        set_station(sid, "sched_snapshot", None, True)
         set_station(sid, "current_listeners", None, True)
         set_station(sid, "request_line", None, True)
         set_station(sid, "request_user_positions", None, True)
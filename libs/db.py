@@ -1,6 +1,9 @@
+import asyncio
+import threading
 import psycopg2
 import psycopg2.extras
 import time
+from contextlib import asynccontextmanager, contextmanager
 
 from libs import config
 from libs import log
@@ -12,27 +15,34 @@ class DatabaseDisconnectedError(Exception):
 
 class PostgresCursor(psycopg2.extras.RealDictCursor):
     in_tx = False
+    tx_depth = 0
     auto_retry = True
     disconnected = False
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.in_tx = False
+        self.tx_depth = 0
         self.auto_retry = True
         self.disconnected = False
 
     def execute(self, *args, **kwargs):
+        global c
         if self.disconnected:
             raise DatabaseDisconnectedError
 
         try:
             return super().execute(*args, **kwargs)
         except connection_errors as e:
-            if self.auto_retry:
+            if self.in_tx:
+                # The transaction died with the connection, there's nothing to retry.
+                self.in_tx = False
+                self.tx_depth = 0
+                raise
+            elif self.auto_retry and self is c:
                 log.exception("psycopg", "Psycopg exception", e)
                 close()
                 connect(auto_retry=self.auto_retry)
-                global c
                 return c.execute(*args, **kwargs)
             else:
                 raise
@@ -110,21 +120,56 @@ class PostgresCursor(psycopg2.extras.RealDictCursor):
         columns = ",".join(map(str, args))
         self.execute("CREATE INDEX %s ON %s (%s)" % (name, table, columns))
 
+    # Nested transactions (e.g. an election created during the backend's advance)
+    # become savepoints, so an inner rollback doesn't throw away the outer work.
+
     def start_transaction(self):
-        if not self.in_tx:
+        if self.in_tx:
+            self.tx_depth += 1
+            self.execute("SAVEPOINT nw_tx_%s" % self.tx_depth)
             return
         self.execute("START TRANSACTION")
         self.in_tx = True
+        self.tx_depth = 0
 
     def commit(self):
         if not self.in_tx:
             return
+        if self.tx_depth:
+            self.execute("RELEASE SAVEPOINT nw_tx_%s" % self.tx_depth)
+            self.tx_depth -= 1
+            return
         self.execute("COMMIT")
         self.in_tx = False
 
     def rollback(self):
+        if self.connection.closed:
+            self.in_tx = False
+            self.tx_depth = 0
+            return
+        if self.in_tx and self.tx_depth:
+            self.execute("ROLLBACK TO SAVEPOINT nw_tx_%s" % self.tx_depth)
+            self.tx_depth -= 1
+            return
         self.execute("ROLLBACK")
         self.in_tx = False
+        self.tx_depth = 0
+
+    @contextmanager
+    def transaction(self):
+        """
+        with db.c.transaction():
+                ...
+        Commits when the block exits, including early returns,
+        and rolls back on exceptions.
+        """
+        self.start_transaction()
+        try:
+            yield self
+        except:
+            self.rollback()
+            raise
+        self.commit()
 
 
 # Ignoring type because we expect a crash if these don't exist anyway.
@@ -134,21 +179,13 @@ connection: psycopg2.extensions.connection = None  # type: ignore
 connection_errors = (psycopg2.OperationalError, psycopg2.InterfaceError)
 
 
-def connect(auto_retry=True, retry_only_this_time=False):
-    global connection
-    global c
-
-    if connection and c and not c.closed:
-        return True
-
+def _get_connstr():
     name = config.get("db_name")
     host = config.get("db_host")
     port = config.get("db_port")
     user = config.get("db_user")
     password = config.get("db_password")
 
-    psycopg2.extensions.register_type(psycopg2.extensions.UNICODE)
-    psycopg2.extensions.register_type(psycopg2.extensions.UNICODEARRAY)
     base_connstr = "sslmode=disable "
     if host:
         base_connstr += "host=%s " % host
@@ -158,16 +195,29 @@ def connect(auto_retry=True, retry_only_this_time=False):
         base_connstr += "user=%s " % user
     if password:
         base_connstr += "password=%s " % password
+    return base_connstr + ("dbname=%s" % name)
+
+
+def _new_connection():
+    psycopg2.extensions.register_type(psycopg2.extensions.UNICODE)
+    psycopg2.extensions.register_type(psycopg2.extensions.UNICODEARRAY)
+    new_connection = psycopg2.connect(_get_connstr(), connect_timeout=1)
+    new_connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    new_connection.autocommit = True
+    return new_connection
+
+
+def connect(auto_retry=True, retry_only_this_time=False):
+    global connection
+    global c
+
+    if connection and c and not c.closed:
+        return True
+
     connected = False
     while not connected:
         try:
-            connection = psycopg2.connect(
-                base_connstr + ("dbname=%s" % name), connect_timeout=1
-            )
-            connection.set_isolation_level(
-                psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT
-            )
-            connection.autocommit = True
+            connection = _new_connection()
             c = connection.cursor(cursor_factory=PostgresCursor)
             c.auto_retry = auto_retry
             connected = True
@@ -188,6 +238,7 @@ def close():
         # forgot to commit?  too bad.
         if c.in_tx:
             log.critical("txopen", "Forgot to close a transaction!  Rolling back!")
+            c.tx_depth = 0
             c.rollback()
         c.close()
     if connection:
@@ -195,9 +246,378 @@ def close():
     c = None  # type: ignore
     connection = None  # type: ignore
 
+    # Idle pooled connections most likely went down with the main one.
+    if pool:
+        pool.close_idle()
+    if async_pool:
+        async_pool.close_idle()
+
     return True
 
 
+def transaction():
+    return c.transaction()
+
+
+_batch_cursor_count = 0
+
+
+def fetch_batches(query, params, batch_size):
+    """
+    Yields lists of up to batch_size rows from a server-side cursor, so a large
+    result never sits in this process' memory all at once.
+    """
+    global _batch_cursor_count
+    _batch_cursor_count += 1
+    # outside a transaction (autocommit) the cursor has to outlive its own statement
+    cursor = connection.cursor(
+        "nw_batches_%s" % _batch_cursor_count,
+        cursor_factory=psycopg2.extras.RealDictCursor,
+        withhold=not c.in_tx,
+    )
+    cursor.itersize = batch_size
+    try:
+        cursor.execute(query, params)
+        rows = cursor.fetchmany(batch_size)
+        while rows:
+            yield rows
+            rows = cursor.fetchmany(batch_size)
+    finally:
+        cursor.close()
+
+
+class ConnectionPool:
+    """
+    Autocommit connections handed out one per task by db.cursor(), for work that
+    must not share db.c's connection (e.g. its own transaction).
+    Holds on to at most `size` idle connections; busier moments open extra
+    connections that get closed when returned.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.idle = []
+        self.in_use = 0
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            self.in_use += 1
+            while self.idle:
+                pooled_connection = self.idle.pop()
+                if not pooled_connection.closed:
+                    return pooled_connection
+        try:
+            return _new_connection()
+        except:
+            with self.lock:
+                self.in_use -= 1
+            raise
+
+    def put(self, pooled_connection, discard=False):
+        with self.lock:
+            self.in_use -= 1
+            if (
+                not discard
+                and not pooled_connection.closed
+                and len(self.idle) < self.size
+            ):
+                self.idle.append(pooled_connection)
+                return
+        if not pooled_connection.closed:
+            pooled_connection.close()
+
+    def close_idle(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for pooled_connection in idle:
+            if not pooled_connection.closed:
+                pooled_connection.close()
+
+
+pool: ConnectionPool = None  # type: ignore
+
+
+def get_pool():
+    global pool
+    if not pool:
+        size = 5
+        if config.has("db_pool_size"):
+            size = config.get("db_pool_size")
+        pool = ConnectionPool(size)
+    return pool
+
+
+@contextmanager
+def cursor():
+    """
+    with db.cursor() as cursor:
+            cursor.fetch_all(...)
+    A PostgresCursor on its own pooled connection for the length of the block.
+    Connections that fail are dropped from the pool, and since a pooled cursor is
+    tied to its connection, retrying is left to the next db.cursor() block.
+    """
+    p = get_pool()
+    pooled_connection = p.get()
+    discard = False
+    pooled_cursor = pooled_connection.cursor(cursor_factory=PostgresCursor)
+    pooled_cursor.auto_retry = False
+    try:
+        yield pooled_cursor
+    except connection_errors:
+        discard = True
+        raise
+    finally:
+        if pooled_cursor.in_tx and not pooled_connection.closed:
+            log.critical("txopen", "Forgot to close a transaction!  Rolling back!")
+            try:
+                pooled_cursor.tx_depth = 0
+                pooled_cursor.rollback()
+            except connection_errors:
+                discard = True
+        if not pooled_cursor.closed:
+            pooled_cursor.close()
+        p.put(pooled_connection, discard)
+
+
+async def _wait_ready(async_connection):
+    loop = asyncio.get_running_loop()
+    while True:
+        state = async_connection.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            return
+        fd = async_connection.fileno()
+        ready = loop.create_future()
+
+        def on_ready():
+            if not ready.done():
+                ready.set_result(None)
+
+        if state == psycopg2.extensions.POLL_READ:
+            loop.add_reader(fd, on_ready)
+            try:
+                await ready
+            finally:
+                loop.remove_reader(fd)
+        elif state == psycopg2.extensions.POLL_WRITE:
+            loop.add_writer(fd, on_ready)
+            try:
+                await ready
+            finally:
+                loop.remove_writer(fd)
+        else:
+            raise psycopg2.OperationalError("Bad poll state: %s" % state)
+
+
+class AsyncConnectionPool:
+    """
+    psycopg2 asynchronous connections for AsyncCursor.  Asynchronous connections are
+    always in autocommit mode.  At most `size` queries run at once per process;
+    everything else waits its turn without blocking the IOLoop.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.idle = []
+        self.in_use = 0
+        self.slots = asyncio.Semaphore(size)
+
+    async def get(self):
+        self.in_use += 1
+        while self.idle:
+            async_connection = self.idle.pop()
+            if not async_connection.closed:
+                return async_connection
+        try:
+            async_connection = psycopg2.connect(
+                _get_connstr(), connect_timeout=1, async_=True
+            )
+            await _wait_ready(async_connection)
+            return async_connection
+        except:
+            self.in_use -= 1
+            raise
+
+    def put(self, async_connection, discard=False):
+        self.in_use -= 1
+        if (
+            not discard
+            and not async_connection.closed
+            and len(self.idle) < self.size
+        ):
+            self.idle.append(async_connection)
+        elif not async_connection.closed:
+            async_connection.close()
+
+    def close_idle(self):
+        idle = self.idle
+        self.idle = []
+        for async_connection in idle:
+            if not async_connection.closed:
+                async_connection.close()
+
+
+class AsyncCursor:
+    """
+    Awaitable version of PostgresCursor's fetch_* API, for use from Tornado handlers:
+
+    async with db.async_cursor() as cursor:
+            rows = await cursor.fetch_all(...)
+    """
+
+    def __init__(self, async_pool, async_connection):
+        self.pool = async_pool
+        self.connection = async_connection
+        self.cursor = async_connection.cursor(
+            cursor_factory=psycopg2.extras.RealDictCursor
+        )
+        self.in_tx = False
+        self.tx_depth = 0
+        self.auto_retry = True
+
+    async def _reconnect(self):
+        self.pool.put(self.connection, discard=True)
+        self.connection = await self.pool.get()
+        self.cursor = self.connection.cursor(
+            cursor_factory=psycopg2.extras.RealDictCursor
+        )
+
+    async def execute(self, query, params=None):
+        try:
+            self.cursor.execute(query, params)
+            await _wait_ready(self.connection)
+        except connection_errors as e:
+            if self.in_tx:
+                self.in_tx = False
+                self.tx_depth = 0
+                raise
+            elif not self.auto_retry:
+                raise
+            log.exception("psycopg", "Psycopg async exception", e)
+            await self._reconnect()
+            self.cursor.execute(query, params)
+            await _wait_ready(self.connection)
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    async def fetch_var(self, query, params=None):
+        await self.execute(query, params)
+        if self.cursor.rowcount <= 0 or not self.cursor.rowcount:
+            return None
+        r = self.cursor.fetchone()
+        if not r:
+            return None
+        return r[next(iter(r.keys()))]
+
+    async def fetch_row(self, query, params=None):
+        await self.execute(query, params)
+        if self.cursor.rowcount <= 0 or not self.cursor.rowcount:
+            return None
+        return self.cursor.fetchone()
+
+    async def fetch_all(self, query, params=None):
+        await self.execute(query, params)
+        if self.cursor.rowcount <= 0 or not self.cursor.rowcount:
+            return []
+        return self.cursor.fetchall()
+
+    async def fetch_list(self, query, params=None) -> list:
+        await self.execute(query, params)
+        if self.cursor.rowcount <= 0 or not self.cursor.rowcount:
+            return []
+        arr = []
+        for row in self.cursor.fetchall():
+            arr.append(row[next(iter(row.keys()))])
+        return arr
+
+    async def update(self, query, params=None):
+        await self.execute(query, params)
+        return self.cursor.rowcount
+
+    async def start_transaction(self):
+        if self.in_tx:
+            self.tx_depth += 1
+            await self.execute("SAVEPOINT nw_tx_%s" % self.tx_depth)
+            return
+        await self.execute("BEGIN")
+        self.in_tx = True
+        self.tx_depth = 0
+
+    async def commit(self):
+        if not self.in_tx:
+            return
+        if self.tx_depth:
+            await self.execute("RELEASE SAVEPOINT nw_tx_%s" % self.tx_depth)
+            self.tx_depth -= 1
+            return
+        await self.execute("COMMIT")
+        self.in_tx = False
+
+    async def rollback(self):
+        if self.connection.closed:
+            self.in_tx = False
+            self.tx_depth = 0
+            return
+        if self.in_tx and self.tx_depth:
+            await self.execute("ROLLBACK TO SAVEPOINT nw_tx_%s" % self.tx_depth)
+            self.tx_depth -= 1
+            return
+        await self.execute("ROLLBACK")
+        self.in_tx = False
+        self.tx_depth = 0
+
+    @asynccontextmanager
+    async def transaction(self):
+        await self.start_transaction()
+        try:
+            yield self
+        except:
+            await self.rollback()
+            raise
+        await self.commit()
+
+
+async_pool: AsyncConnectionPool = None  # type: ignore
+
+
+def get_async_pool():
+    global async_pool
+    if not async_pool:
+        size = 10
+        if config.has("db_async_pool_size"):
+            size = config.get("db_async_pool_size")
+        async_pool = AsyncConnectionPool(size)
+    return async_pool
+
+
+@asynccontextmanager
+async def async_cursor():
+    p = get_async_pool()
+    async with p.slots:
+        async_cur = AsyncCursor(p, await p.get())
+        discard = False
+        try:
+            yield async_cur
+        except connection_errors:
+            discard = True
+            raise
+        finally:
+            if async_cur.in_tx and not async_cur.connection.closed:
+                log.critical(
+                    "txopen", "Forgot to close a transaction!  Rolling back!"
+                )
+                try:
+                    async_cur.tx_depth = 0
+                    await async_cur.rollback()
+                except connection_errors:
+                    discard = True
+            async_cur.cursor.close()
+            p.put(async_cur.connection, discard)
+
+
 def connection_keepalive():
     if c.disconnected:
         connect(auto_retry=False)
@@ -282,6 +702,8 @@ def create_tables():
     c.update(
         "CREATE INDEX album_name_trgm_gin ON r4_albums USING GIN(album_name_searchable gin_trgm_ops)"
     )
+    # keyset pagination for all_albums_paginated
+    c.create_idx("r4_albums", "album_name", "album_id")
 
     c.update(
         " \
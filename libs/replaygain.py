@@ -1,19 +1,75 @@
+import hashlib
+import os
 import subprocess
-
-# from gi.repository import GLib
-# from rgain3 import rgcalc, util
-# from rgain3.script import init_gstreamer
+import tempfile
 
 from libs import config
+from libs import log
 
 ref_level = 89
-# init_gstreamer()
+
+# GStreamer is loaded on first use, so forked scanner workers each initialize their own.
+_gst = None
+
+
+class ReplayGainError(Exception):
+    pass
 
 
 def get_gain_for_song(file):
     if config.has("disable_replaygain") and config.get("disable_replaygain"):
         return "0.0 dB"
 
+    cache_key = None
+    cache_dir = _get_cache_dir()
+    if cache_dir:
+        cache_key = get_audio_hash(file)
+        gain = _get_cached_gain(cache_dir, cache_key)
+        if gain:
+            return gain
+
+    if get_engine() == "gstreamer":
+        gain = _analyze_gstreamer(file)
+    else:
+        gain = _analyze_subprocess(file)
+
+    if cache_key:
+        _set_cached_gain(cache_dir, cache_key, gain)
+    return gain
+
+
+def get_engine():
+    """
+    "gstreamer" decodes and analyzes in-process with GStreamer's rganalysis element,
+    "subprocess" runs rgain3's replaygain script per file.  Stays "subprocess" by
+    default until nw_devtool_benchmark_replaygain.py shows both agree on a library.
+    """
+    engine = "subprocess"
+    if config.has("replaygain_engine") and config.get("replaygain_engine"):
+        engine = config.get("replaygain_engine")
+    if engine == "gstreamer" and not _load_gst():
+        engine = "subprocess"
+    return engine
+
+
+def _load_gst():
+    global _gst
+    if _gst is None:
+        try:
+            import gi
+
+            gi.require_version("Gst", "1.0")
+            from gi.repository import Gst
+
+            Gst.init(None)
+            _gst = Gst
+        except (ImportError, ValueError) as e:
+            log.warn("replaygain", "GStreamer unavailable, using subprocess: %s" % e)
+            _gst = False
+    return _gst
+
+
+def _analyze_subprocess(file):
     output = subprocess.run(
         ["replaygain", "-d", f"-r {ref_level}", f"{file}"],
         capture_output=True,
@@ -25,32 +81,110 @@ def get_gain_for_song(file):
     gain = gain_line.split(":")[-1].strip()
     return gain
 
-    # this code below would be better but does not close file handlers and crashes RW eventually
 
-    # mostly copy/pasted from rgain3 source
-    # adapted for Nerdwave usage
+def _analyze_gstreamer(file):
+    # rgain3 does the same through a GLib main loop, but leaks file handles over
+    # thousands of files.  A bare pipeline torn down to NULL after each file doesn't.
+    Gst = _gst
+    pipeline = Gst.parse_launch(
+        "filesrc name=src ! decodebin ! audioconvert ! audioresample "
+        "! rganalysis reference-level=%s ! fakesink" % ref_level
+    )
+    pipeline.get_by_name("src").set_property("location", file)
+    bus = pipeline.get_bus()
+    gain = None
+    pipeline.set_state(Gst.State.PLAYING)
+    try:
+        while True:
+            message = bus.timed_pop_filtered(
+                Gst.CLOCK_TIME_NONE,
+                Gst.MessageType.TAG | Gst.MessageType.ERROR | Gst.MessageType.EOS,
+            )
+            if message.type == Gst.MessageType.ERROR:
+                err, _debug = message.parse_error()
+                raise ReplayGainError("%s: %s" % (file, err.message))
+            elif message.type == Gst.MessageType.TAG:
+                found, value = message.parse_tag().get_double(Gst.TAG_TRACK_GAIN)
+                if found:
+                    gain = value
+            elif message.type == Gst.MessageType.EOS:
+                break
+    finally:
+        pipeline.set_state(Gst.State.NULL)
+
+    if gain is None:
+        raise ReplayGainError("%s: no track gain calculated." % file)
+    return "%0.2f dB" % gain
+
+
+def _get_cache_dir():
+    cache_dir = None
+    if config.has("replaygain_cache_dir"):
+        cache_dir = config.get("replaygain_cache_dir")
+    if cache_dir is False:
+        return None
+    # null (as shipped in the reference config) means the same as leaving it out
+    if cache_dir:
+        return cache_dir
+    return os.path.join(tempfile.gettempdir(), "nerdwave_replaygain")
+
+
+def get_audio_hash(file):
+    """
+    Hashes an MP3's audio only, skipping ID3v2 and ID3v1 tags, so renames and re-tags
+    of a file still find its cached gain.
+    """
+    with open(file, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        f.seek(0)
 
-    # exceptions = []
+        start = 0
+        header = f.read(10)
+        if len(header) == 10 and header[:3] == b"ID3":
+            size = (
+                (header[6] & 0x7F) << 21
+                | (header[7] & 0x7F) << 14
+                | (header[8] & 0x7F) << 7
+                | (header[9] & 0x7F)
+            )
+            start = 10 + size
+            # footer present
+            if header[5] & 0x10:
+                start += 10
+        if end - start >= 128:
+            f.seek(end - 128)
+            if f.read(3) == b"TAG":
+                end -= 128
 
-    # # handlers
-    # def on_finished(evsrc, trackdata, albumdata):
-    #     loop.quit()
+        h = hashlib.blake2b(digest_size=20)
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = f.read(min(remaining, 1048576))
+            if not chunk:
+                break
+            h.update(chunk)
+            remaining -= len(chunk)
+    return h.hexdigest()
 
-    # def on_error(evsrc, exc):
-    #     exceptions.append(exc)
-    #     loop.quit()
 
-    # rg = rgcalc.ReplayGain([file], True, ref_level)
-    # with util.gobject_signals(
-    #     rg,
-    #     ("all-finished", on_finished),
-    #     ("error", on_error),
-    # ):
-    #     loop = GLib.MainLoop()
-    #     rg.start()
-    #     loop.run()
+def _get_cached_gain(cache_dir, cache_key):
+    try:
+        with open(os.path.join(cache_dir, cache_key[:2], cache_key)) as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
 
-    # if exceptions:
-    #     raise exceptions[0]
 
-    # return "%0.2f dB" % rg.track_data.popitem()[1].gain
+def _set_cached_gain(cache_dir, cache_key, gain):
+    # Written to a temp file then renamed, since scanner workers share the cache.
+    try:
+        directory = os.path.join(cache_dir, cache_key[:2])
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = os.path.join(directory, "%s.%s.tmp" % (cache_key, os.getpid()))
+        with open(tmp_path, "w") as f:
+            f.write(gain)
+        os.replace(tmp_path, os.path.join(directory, cache_key))
+    except OSError as e:
+        log.warn("replaygain", "Could not cache replay gain: %s" % e)
@@ -22,25 +22,36 @@ def init_pub():
     _pub.connect(config.get("zeromq_pub"))
 
 
-def init_sub():
+# Messages are sent as two frames: the action as the topic, then the JSON.
+# Subscribers that only care about some actions let ZeroMQ filter out the rest.
+
+
+def init_sub(actions=None):
     global _sub_stream
     context = zmq.Context()
     sub = context.socket(zmq.SUB)
     sub.connect(config.get("zeromq_sub"))
-    sub.setsockopt(zmq.SUBSCRIBE, b"")
+    if actions:
+        for action in actions:
+            sub.setsockopt(zmq.SUBSCRIBE, action.encode())
+    else:
+        sub.setsockopt(zmq.SUBSCRIBE, b"")
     _sub_stream = zmqstream.ZMQStream(sub)
 
 
 def set_sub_callback(methd):
     if not _sub_stream:
         raise APIException("internal_error", http_code=500)
-    _sub_stream.on_recv(methd)
+    # callbacks get the JSON frame only, as they did before topics
+    _sub_stream.on_recv(lambda frames: methd(frames[1:] if len(frames) > 1 else frames))
 
 
 def publish(dct):
     if not _pub:
         raise APIException("internal_error", http_code=500)
-    _pub.send_string(json.dumps(dct))
+    _pub.send_multipart(
+        [str(dct.get("action") or "").encode(), json.dumps(dct).encode()]
+    )
 
 
 def init_proxy():
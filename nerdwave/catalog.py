@@ -0,0 +1,179 @@
+import math
+from time import time as timestamp
+
+from libs import cache
+from libs import config
+from libs import log
+from nerdwave import playlist
+from nerdwave.playlist_objects import object_cache
+
+# The station catalog lists served by all_albums, all_artists, and all_groups.
+# The backend keeps its copy here and patches all_albums from each album diff;
+# everything else only changes when songs are added, changed, or removed, which
+# is when the scanner bumps catalog_version and the lists get rebuilt.
+# Each list is published with a version so API processes only fetch lists that
+# changed since they last looked.
+LIST_KEYS = ("all_albums", "all_artists", "all_groups", "all_groups_power")
+# Lists also published pre-split into pages for the *_paginated endpoints
+PAGED_KEYS = ("all_artists", "all_groups")
+PAGE_LIMIT = 1000
+
+_builders = {
+    "all_albums": playlist.get_all_albums_list,
+    "all_artists": playlist.get_all_artists_list,
+    "all_groups": playlist.get_all_groups_list,
+    "all_groups_power": playlist.get_all_groups_for_power,
+}
+
+# backend: sid -> StationCatalog
+catalogs = {}
+# API processes: sid -> {list key: version last fetched}
+_local_versions = {}
+
+
+def _get_refresh():
+    # full rebuilds as a safety net for changes made by tools that don't bump the version
+    if config.has("catalog_lists_refresh"):
+        return config.get("catalog_lists_refresh")
+    return 3600
+
+
+def bump_version():
+    """
+    Call after adding, changing, or removing songs, albums, or groups, so the backend
+    rebuilds the catalog lists on its next song change.
+    """
+    cache.set_global("catalog_version", timestamp())
+    cache.bump_generation()
+    object_cache.invalidate()
+
+
+def update(sid, album_diff):
+    """
+    Called by the backend on every song change, after the album diff is built.
+    Publishes only the lists that changed.
+    """
+    catalog = catalogs.get(sid)
+    catalog_version = cache.get("catalog_version")
+    if (
+        not catalog
+        or catalog.catalog_version != catalog_version
+        or catalog.built_at < timestamp() - _get_refresh()
+    ):
+        catalog = StationCatalog(sid)
+        catalog.build(catalog_version)
+        catalogs[sid] = catalog
+        catalog.publish(LIST_KEYS)
+    elif catalog.apply_album_diff(album_diff):
+        catalog.publish(("all_albums",))
+
+
+def get_page(sid, key, offset):
+    """
+    A page of a list in PAGED_KEYS, ready to send to the client, or None if the
+    backend hasn't published pages for the current catalog yet.
+    """
+    page = cache.get_station(sid, "%s_page_%s" % (key, offset // PAGE_LIMIT))
+    if page and page["catalog_version"] != cache.get("catalog_version"):
+        return None
+    return page
+
+
+def refresh_local(sid):
+    """
+    Called by API processes on update_all.  Fetches the lists whose version changed
+    into the local cache, where cache.get_station finds them.
+    """
+    cache.refresh_local_station(sid, "catalog_versions")
+    versions = cache.get_station(sid, "catalog_versions") or {}
+    local_versions = _local_versions.setdefault(sid, {})
+    for key in LIST_KEYS:
+        if key in local_versions and local_versions[key] == versions.get(key):
+            continue
+        cache.refresh_local_station(sid, key)
+        if key in versions:
+            local_versions[key] = versions[key]
+        else:
+            local_versions.pop(key, None)
+
+
+class StationCatalog:
+    def __init__(self, sid):
+        self.sid = sid
+        self.lists = {}
+        self.albums = {}
+        self.versions = {}
+        self.catalog_version = None
+        self.built_at = 0
+
+    def build(self, catalog_version):
+        start_time = timestamp()
+        for key in LIST_KEYS:
+            self.lists[key] = _builders[key](self.sid)
+        self._index_albums()
+        self.catalog_version = catalog_version
+        self.built_at = timestamp()
+        log.debug(
+            "catalog",
+            "SID %s: rebuilt catalog lists in %.3fs."
+            % (self.sid, self.built_at - start_time),
+        )
+
+    def _index_albums(self):
+        self.albums = {album["id"]: album for album in self.lists["all_albums"]}
+
+    def apply_album_diff(self, album_diff):
+        """
+        Patches all_albums in place from the album diff.  Returns True if anything
+        changed.  New or renamed albums re-query the list, since its order comes
+        from Postgres' collation.
+        """
+        changed = False
+        for diff in album_diff or []:
+            album = self.albums.get(diff["id"])
+            if not album or album["name"] != diff["name"]:
+                self.lists["all_albums"] = playlist.get_all_albums_list(self.sid)
+                self._index_albums()
+                return True
+            for key in ("cool", "cool_lowest", "newest_song_time", "rating"):
+                if key in diff and album[key] != diff[key]:
+                    album[key] = diff[key]
+                    changed = True
+        return changed
+
+    def publish(self, keys):
+        version = timestamp()
+        for key in keys:
+            cache.set_station(self.sid, key, self.lists[key], True)
+            self.versions[key] = version
+            if key in PAGED_KEYS:
+                self._publish_pages(key)
+        # versions go last, so anyone who sees a new version gets the new list
+        cache.set_station(self.sid, "catalog_versions", dict(self.versions), True)
+
+    def _publish_pages(self, key):
+        # The version lets clients tell if the catalog changed while they walk the pages.
+        items = self.lists[key]
+        offsets = range(0, len(items), PAGE_LIMIT) if items else (0,)
+        previous_count = cache.get_station(self.sid, "%s_page_count" % key) or 0
+        for offset in offsets:
+            page = items[offset : offset + PAGE_LIMIT]
+            cache.set_station(
+                self.sid,
+                "%s_page_%s" % (key, offset // PAGE_LIMIT),
+                {
+                    "data": page,
+                    "has_more": offset + PAGE_LIMIT < len(items),
+                    "progress": (
+                        min(math.ceil((offset + len(page)) / len(items) * 100), 100)
+                        if items
+                        else 100
+                    ),
+                    "next": offset + PAGE_LIMIT,
+                    "catalog_version": self.catalog_version,
+                },
+            )
+        # a shorter list leaves pages from the old one behind
+        for page_number in range(len(offsets), previous_count):
+            cache.set_station(self.sid, "%s_page_%s" % (key, page_number), None)
+        cache.set_station(self.sid, "%s_page_count" % key, len(offsets))
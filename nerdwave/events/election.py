@@ -8,9 +8,9 @@ from libs import cache
 from libs import log
 from nerdwave import playlist
 from nerdwave import request
+from nerdwave import rating
 from nerdwave.user import User
 from nerdwave.events import event
-from nerdwave.playlist_objects.song import SongNonExistent
 
 _request_interval = {}
 _request_sequence = {}
@@ -178,12 +178,16 @@ class Election(event.BaseEvent):
         elec.public = True
         elec.timed = False
         elec.sched_id = row["sched_id"]
-        for song_row in db.c.fetch_all(
+        song_rows = db.c.fetch_all(
             "SELECT * FROM r4_election_entries WHERE elec_id = %s", (elec_id,)
-        ):
-            try:
-                song = playlist.Song.load_from_id(song_row["song_id"], elec.sid)
-            except SongNonExistent:
+        )
+        songs = playlist.Song.load_many(
+            [song_row["song_id"] for song_row in song_rows], elec.sid
+        )
+        for song_row in song_rows:
+            if song_row["song_id"] in songs:
+                song = songs[song_row["song_id"]]
+            else:
                 song = playlist.Song.load_from_id(
                     song_row["song_id"],
                     db.c.fetch_var(
@@ -554,14 +558,21 @@ class Election(event.BaseEvent):
         self.has_priority = priority
 
     def to_dict(self, user=None, check_rating_acl=False):
-        obj = super(Election, self).to_dict(user)
+        # songs get rebuilt below, so don't have the base class look up ratings for them
+        obj = super(Election, self).to_dict()
         obj["used"] = self.used
         obj["length"] = self.length()
         obj["songs"] = []
+        song_ratings = None
+        album_ratings = None
+        if user:
+            song_ratings, album_ratings = rating.get_ratings_for_songs(
+                self.songs, user.id
+            )
         for song in self.songs:
             if check_rating_acl and user and not user.is_anonymous():
                 song.check_rating_acl(user)
-            obj["songs"].append(song.to_dict(user))
+            obj["songs"].append(song.to_dict(user, song_ratings, album_ratings))
         return obj
 
     def has_entry_id(self, entry_id):
@@ -1,6 +1,7 @@
 from typing import TypeVar, Type
 from time import time as timestamp
 from nerdwave.playlist_objects.song import Song
+from nerdwave import rating
 
 from libs import db
 from libs import log
@@ -337,10 +338,16 @@ class BaseEvent:
             elif self.start:
                 obj["end"] = self.start + self.length()
             obj["songs"] = []
+            song_ratings = None
+            album_ratings = None
+            if user:
+                song_ratings, album_ratings = rating.get_ratings_for_songs(
+                    self.songs, user.id
+                )
             for song in self.songs:
                 if check_rating_acl:
                     song.check_rating_acl(user)
-                obj["songs"].append(song.to_dict(user))
+                obj["songs"].append(song.to_dict(user, song_ratings, album_ratings))
         return obj
 
     def delete(self):
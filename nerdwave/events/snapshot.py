@@ -0,0 +1,79 @@
+from collections import namedtuple
+
+from libs import db
+from nerdwave.events.election import ElecSongTypes
+
+# The backend's current and upcoming events, cut down to what API processes need to
+# check votes and ratings against, as sched_snapshot.  Unpickling the full
+# Election/Song/Album graphs on every song change is far more work than these
+# tuples.  Everything shown to listeners comes from the sched_*_dict keys instead.
+
+
+class SongEntry(
+    namedtuple(
+        "SongEntry", ("id", "entry_id", "entry_type", "elec_request_user_id")
+    )
+):
+    __slots__ = ()
+
+
+class EventSnapshot(namedtuple("EventSnapshot", ("id", "sid", "is_election", "songs"))):
+    __slots__ = ()
+
+    @classmethod
+    def from_event(cls, event):
+        return cls(
+            event.id,
+            event.sid,
+            event.is_election,
+            tuple(
+                SongEntry(
+                    song.id,
+                    song.data.get("entry_id"),
+                    song.data.get("entry_type"),
+                    song.data.get("elec_request_user_id"),
+                )
+                for song in getattr(event, "songs", None) or ()
+            ),
+        )
+
+    def get_song_id(self):
+        if not self.songs:
+            return None
+        return self.songs[0].id
+
+    def has_entry_id(self, entry_id):
+        return self.get_entry(entry_id) is not None
+
+    def get_entry(self, entry_id):
+        for song in self.songs:
+            if song.entry_id == entry_id:
+                return song
+        return None
+
+    def has_request_by_user(self, user_id):
+        for song in self.songs:
+            if (
+                song.entry_type == ElecSongTypes.request
+                and song.elec_request_user_id == user_id
+            ):
+                return song
+        return False
+
+    def add_vote_to_entry(self, entry_id, addition=1):
+        # same as Election.add_vote_to_entry
+        return db.c.update(
+            "UPDATE r4_election_entries SET entry_votes = entry_votes + %s WHERE entry_id = %s",
+            (addition, entry_id),
+        )
+
+
+class ScheduleSnapshot(namedtuple("ScheduleSnapshot", ("current", "next"))):
+    __slots__ = ()
+
+    @classmethod
+    def from_events(cls, current, upnext):
+        return cls(
+            EventSnapshot.from_event(current) if current else None,
+            tuple(EventSnapshot.from_event(event) for event in upnext),
+        )
@@ -0,0 +1,214 @@
+import bisect
+from time import time as timestamp
+
+from libs import cache
+from libs import config
+from libs import db
+from libs import log
+
+# The top_100 and station_song_count endpoints, kept in memcache as one snapshot:
+#   {"boards": {sid: board, None: global board}, "station_song_count": [...],
+#    "versions": {"top_100": ..., "station_song_count": ...}, ...}
+# A board holds more than TOP_LIMIT songs, sorted by (-rating, song_id), so rating
+# changes from Song.update_rating can move songs in and out of it without asking
+# Postgres again.  Song counts only change with the scanner, which bumps
+# catalog_version and gets everything rebuilt on the next song change.
+TOP_LIMIT = 100
+_DEPTH = 150
+_MIN_RATING_COUNT = 20
+
+# (key, row, sids) of ratings saved in the song change transaction, patched into
+# the snapshot by update() once it's committed
+_pending = []
+# only backends patch; tools that recalculate ratings in bulk rebuild at the end
+_patching = False
+
+
+def _get_refresh():
+    # full rebuilds as a safety net for tools that change ratings in bulk
+    if config.has("leaderboards_refresh"):
+        return config.get("leaderboards_refresh")
+    return 3600
+
+
+def _load_board(sid=None):
+    if sid:
+        rows = db.c.fetch_all(
+            "SELECT DISTINCT ON (song_rating, song_id) "
+            "song_origin_sid AS origin_sid, song_id AS id, song_title AS title, album_name, CAST(ROUND(CAST(song_rating AS NUMERIC), 1) AS REAL) AS song_rating, song_rating_count, song_rating AS sort_rating "
+            "FROM r4_song_sid "
+            "JOIN r4_songs USING (song_id) "
+            "JOIN r4_albums USING (album_id) "
+            "WHERE r4_song_sid.sid = %s AND song_rating_count > %s AND song_verified = TRUE "
+            "ORDER BY song_rating DESC, song_id LIMIT %s",
+            (sid, _MIN_RATING_COUNT, _DEPTH),
+        )
+    else:
+        rows = db.c.fetch_all(
+            "SELECT DISTINCT ON (song_rating, song_id) "
+            "song_origin_sid AS origin_sid, song_id AS id, song_title AS title, album_name, CAST(ROUND(CAST(song_rating AS NUMERIC), 1) AS REAL) AS song_rating, song_rating_count, song_rating AS sort_rating "
+            "FROM r4_songs "
+            "JOIN r4_song_sid USING (song_id) "
+            "JOIN r4_albums USING (album_id) "
+            "WHERE song_rating_count > %s AND song_verified = TRUE "
+            "ORDER BY song_rating DESC, song_id LIMIT %s",
+            (_MIN_RATING_COUNT, _DEPTH),
+        )
+    return {
+        "keys": [(-row.pop("sort_rating"), row["id"]) for row in rows],
+        "rows": rows,
+        # every eligible song is on the board, so nothing can be missing below it
+        "complete": len(rows) < _DEPTH,
+    }
+
+
+def _count_songs():
+    return db.c.fetch_all(
+        "SELECT song_origin_sid AS sid, COUNT(song_id) AS song_count "
+        "FROM r4_songs WHERE song_verified = TRUE GROUP BY song_origin_sid"
+    )
+
+
+def build():
+    start_time = timestamp()
+    boards = {None: _load_board()}
+    for sid in config.station_ids:
+        boards[sid] = _load_board(sid)
+    station_song_count = _count_songs()
+    built_at = timestamp()
+    log.debug(
+        "leaderboards", "Rebuilt leaderboards in %.3fs." % (built_at - start_time)
+    )
+    return {
+        "boards": boards,
+        "station_song_count": station_song_count,
+        "versions": {"top_100": built_at, "station_song_count": built_at},
+        "catalog_version": cache.get("catalog_version"),
+        "built_at": built_at,
+    }
+
+
+def enable_patching():
+    """
+    Called by the backend, so song_rating_changed queues patches for update().
+    """
+    global _patching
+    _patching = True
+
+
+def update():
+    """
+    Called by the backend on every song change, after it commits.  Patches in the
+    ratings that changed, or rebuilds the snapshot if it's missing, the scanner
+    changed the catalog, or it's old.
+    """
+    pending = list(_pending)
+    del _pending[:]
+    snapshot = cache.get("leaderboards")
+    if (
+        not snapshot
+        or snapshot["catalog_version"] != cache.get("catalog_version")
+        or snapshot["built_at"] < timestamp() - _get_refresh()
+    ):
+        rebuild()
+    elif pending:
+        # every station's backend patches the same snapshot
+        cache.update_global(
+            "leaderboards", lambda snapshot: _apply_patches(snapshot, pending)
+        )
+
+
+def rebuild():
+    cache.set_global("leaderboards", build())
+
+
+def discard_pending():
+    """
+    Call when the transaction that saved the queued ratings is rolled back.
+    """
+    del _pending[:]
+
+
+def refresh_local():
+    """
+    Called by API processes on update_all, so handlers read the snapshot from memory.
+    """
+    cache.refresh_local("leaderboards")
+
+
+def get_snapshot():
+    return cache.get("leaderboards")
+
+
+def get_top(snapshot, sid=None):
+    # straight from Postgres until the backend has published a snapshot
+    if not snapshot or sid not in snapshot["boards"]:
+        return _load_board(sid)["rows"][:TOP_LIMIT]
+    return snapshot["boards"][sid]["rows"][:TOP_LIMIT]
+
+
+def get_station_song_count(snapshot):
+    if not snapshot:
+        return _count_songs()
+    return snapshot["station_song_count"]
+
+
+def _patch_board(board, key, row):
+    """
+    Moves a song to its new place on the board, or off it if row is None.
+    Returns False if the board ran short and has to be reloaded.
+    """
+    keys = board["keys"]
+    for i, existing in enumerate(keys):
+        if existing[1] == key[1]:
+            del keys[i]
+            del board["rows"][i]
+            break
+    # below the last song of an incomplete board there may be songs we don't have
+    if row and (board["complete"] or (keys and key < keys[-1])):
+        i = bisect.bisect_left(keys, key)
+        keys.insert(i, key)
+        board["rows"].insert(i, row)
+        if len(keys) > _DEPTH:
+            keys.pop()
+            board["rows"].pop()
+            board["complete"] = False
+    return board["complete"] or len(keys) >= TOP_LIMIT
+
+
+def song_rating_changed(song):
+    """
+    Called after a song's rating is saved.  Queues a patch of every board the song
+    belongs to for the next update().
+    """
+    if not _patching:
+        return
+    row = None
+    if (
+        song.verified
+        and song.data["sids"]
+        and song.data["rating_count"] > _MIN_RATING_COUNT
+    ):
+        row = {
+            "origin_sid": song.data["origin_sid"],
+            "id": song.id,
+            "title": song.data["title"],
+            "album_name": song.album.data["name"] if song.album else None,
+            "song_rating": round(song.data["rating"], 1),
+            "song_rating_count": song.data["rating_count"],
+        }
+    key = (-song.data["rating"], song.id)
+    _pending.append((key, row, [None] + list(song.data["sids"])))
+
+
+def _apply_patches(snapshot, pending):
+    if not snapshot:
+        return None
+    for key, row, sids in pending:
+        for sid in sids:
+            if sid not in snapshot["boards"]:
+                continue
+            if not _patch_board(snapshot["boards"][sid], key, row):
+                snapshot["boards"][sid] = _load_board(sid)
+    snapshot["versions"]["top_100"] = timestamp()
+    return snapshot
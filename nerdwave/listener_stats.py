@@ -0,0 +1,180 @@
+from time import time as timestamp
+
+from libs import cache
+from libs import config
+
+# Everything /api4/listener shows about a user besides their profile row, kept in
+# memcache as u<id>_listener_stats:
+#   {"calculated_at": ..., "votes_by_station": [...], ..., "stations": {sid: {...}}}
+# Votes are counted into it as they happen; filled requests and ratings throw it away.
+
+# users whose requests were filled in the song change transaction, cleared by
+# clear_pending() once it's committed
+_pending = []
+
+
+def _get_max_age():
+    # catches songs being removed, which changes the counts without touching the user
+    if config.has("listener_stats_max_age"):
+        return config.get("listener_stats_max_age")
+    return 86400
+
+
+async def get(cursor, user_id, sid):
+    stats = cache.get_user(user_id, "listener_stats")
+    changed = False
+    if not stats or stats["calculated_at"] < timestamp() - _get_max_age():
+        stats = await calculate(cursor, user_id)
+        changed = True
+    if sid not in stats["stations"]:
+        stats["stations"][sid] = await calculate_station(cursor, user_id, sid)
+        changed = True
+    if changed:
+        cache.set_user(user_id, "listener_stats", stats)
+
+    result = {key: value for key, value in stats.items() if key != "stations"}
+    result.update(stats["stations"][sid])
+    return result
+
+
+def record_vote(user_id, sid):
+    """
+    Call after the vote is committed.  API processes count votes into the same
+    stats at once, hence the cas.
+    """
+
+    def add_vote(stats):
+        if not stats:
+            return None
+        for row in stats["votes_by_station"]:
+            if row["sid"] == sid:
+                row["votes"] += 1
+                break
+        else:
+            stats["votes_by_station"].append({"sid": sid, "votes": 1})
+        return stats
+
+    cache.update_user(user_id, "listener_stats", add_vote)
+
+
+def clear(user_id):
+    cache.set_user(user_id, "listener_stats", None)
+
+
+def clear_after_commit(user_id):
+    """
+    For changes made inside an open transaction: clearing now would let a profile
+    view cache the stats again before the new rows are visible.
+    """
+    _pending.append(user_id)
+
+
+def clear_pending():
+    """
+    Called by the backend after the song change commits.
+    """
+    pending = set(_pending)
+    del _pending[:]
+    for user_id in pending:
+        clear(user_id)
+
+
+def discard_pending():
+    """
+    Call when the transaction that queued the users is rolled back.
+    """
+    del _pending[:]
+
+
+async def calculate(cursor, user_id, sids=None):
+    stats = {"calculated_at": timestamp(), "stations": {}}
+
+    stats["votes_by_station"] = await cursor.fetch_all(
+        "SELECT sid, COUNT(vote_id) AS votes "
+        "FROM r4_vote_history "
+        "WHERE user_id = %s "
+        "GROUP BY sid",
+        (user_id,),
+    )
+
+    stats["requests_by_station"] = await cursor.fetch_all(
+        "SELECT sid, COUNT(request_id) AS requests "
+        "FROM r4_request_history "
+        "WHERE user_id = %s AND sid IS NOT NULL "
+        "GROUP BY sid",
+        (user_id,),
+    )
+
+    stats["requests_by_source_station"] = await cursor.fetch_all(
+        "SELECT song_origin_sid AS sid, COUNT(request_id) AS requests "
+        "FROM r4_request_history JOIN r4_songs USING (song_id) "
+        "WHERE user_id = %s AND song_verified = TRUE "
+        "GROUP BY song_origin_sid",
+        (user_id,),
+    )
+
+    stats["ratings_by_station"] = await cursor.fetch_all(
+        "SELECT song_origin_sid AS sid, TO_CHAR(AVG(song_rating_user), 'FM9.99') AS average_rating, COUNT(song_rating_user) AS ratings "
+        "FROM r4_song_ratings JOIN r4_songs USING (song_id) "
+        "WHERE user_id = %s AND song_verified = TRUE AND song_origin_sid > 0 AND song_rating_user IS NOT NULL "
+        "GROUP BY song_origin_sid",
+        (user_id,),
+    )
+
+    stats["rating_spread"] = await cursor.fetch_all(
+        "SELECT COUNT(song_id) AS ratings, song_rating_user AS rating FROM r4_song_ratings JOIN r4_songs USING (song_id) WHERE user_id = %s AND song_rating_user IS NOT NULL AND song_verified IS TRUE GROUP BY song_rating_user ORDER BY song_rating_user",
+        (user_id,),
+    )
+
+    for sid in sids or []:
+        stats["stations"][sid] = await calculate_station(cursor, user_id, sid)
+    return stats
+
+
+async def calculate_station(cursor, user_id, sid):
+    stats = {}
+    stats["top_albums"] = await cursor.fetch_all(
+        "SELECT album_id AS id, album_name AS name, CAST(ROUND(CAST(album_rating_user AS NUMERIC), 1) AS REAL) AS rating_listener, CAST(ROUND(CAST(album_rating AS NUMERIC), 1) AS REAL) AS rating "
+        "FROM r4_album_ratings "
+        "JOIN r4_album_sid USING (album_id, sid) "
+        "JOIN r4_albums USING (album_id) "
+        "WHERE user_id = %s AND r4_album_ratings.sid = %s AND album_exists = TRUE AND r4_album_sid.album_song_count >= 4 AND r4_album_ratings.album_rating_user > 0 "
+        "ORDER BY album_rating_user DESC NULLS LAST, r4_album_sid.album_song_count DESC "
+        "LIMIT 10",
+        (user_id, sid),
+    )
+
+    if sid == 5:
+        stats["top_request_albums"] = await cursor.fetch_all(
+            "SELECT COUNT(request_id) AS request_count_listener, id, name FROM ("
+            "SELECT r4_songs.album_id AS id, album_name AS name, request_id "
+            "FROM r4_request_history "
+            "JOIN r4_songs USING (song_id) "
+            "JOIN r4_albums USING (album_id) "
+            "WHERE r4_request_history.user_id = %s "
+            "ORDER BY request_id DESC "
+            "LIMIT 1000"
+            ") AS reqs "
+            "GROUP BY id, name "
+            "ORDER BY request_count_listener DESC "
+            "LIMIT 10",
+            (user_id,),
+        )
+    else:
+        stats["top_request_albums"] = await cursor.fetch_all(
+            "SELECT COUNT(request_id) AS request_count_listener, id, name FROM ("
+            "SELECT r4_songs.album_id AS id, album_name AS name, request_id "
+            "FROM r4_request_history "
+            "JOIN r4_songs USING (song_id) "
+            "JOIN r4_album_sid ON (r4_album_sid.sid = %s AND r4_album_sid.album_exists = TRUE AND r4_songs.album_id = r4_album_sid.album_id) "
+            "JOIN r4_albums ON (r4_album_sid.album_id = r4_albums.album_id) "
+            "WHERE r4_request_history.user_id = %s AND r4_request_history.sid = %s "
+            "ORDER BY request_id DESC "
+            "LIMIT 1000"
+            ") AS reqs "
+            "GROUP BY id, name "
+            "ORDER BY request_count_listener DESC "
+            "LIMIT 10",
+            (sid, user_id, sid),
+        )
+    return stats
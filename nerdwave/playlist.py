@@ -7,6 +7,7 @@ from libs import config
 
 from nerdwave.playlist_objects.song import Song
 from nerdwave.playlist_objects import cooldown
+from nerdwave.playlist_objects import song_pool
 
 # These sorts of single-function imports are to make sure
 # that any non-refactored code works with the way this module used to be.
@@ -58,6 +59,23 @@ def get_average_song_length(sid):
     return cooldown.cooldown_config[sid]["average_song_length"]
 
 
+def _verify_pool_count(sid, pool_count, count_sql, params):
+    """
+    In "verify" song pool mode, compares the in-memory pool size against
+    the SQL pool size and rebuilds the index when they disagree.
+    """
+    if song_pool.get_mode() != "verify":
+        return
+    sql_count = db.c.fetch_var(count_sql, params) or 0
+    if sql_count != pool_count:
+        log.warn(
+            "song_pool",
+            "SID %s: in-memory pool has %s songs, SQL has %s.  Reloading."
+            % (sid, pool_count, sql_count),
+        )
+        song_pool.reset(sid)
+
+
 def get_random_song_timed(sid, target_seconds=None, target_delta=None):
     """
     Fetch a random song abiding by all election block, request block, and
@@ -83,10 +101,20 @@ def get_random_song_timed(sid, target_seconds=None, target_delta=None):
     )
     lower_target_bound = target_seconds - (target_delta / 2)
     upper_target_bound = target_seconds + (target_delta / 2)
-    num_available = db.c.fetch_var(
-        "SELECT COUNT(r4_song_sid.song_id) " + sql_query,
-        (sid, lower_target_bound, upper_target_bound),
-    )
+    pool = song_pool.get_pool(sid)
+    if pool:
+        num_available = pool.count(target_seconds, target_delta)
+        _verify_pool_count(
+            sid,
+            num_available,
+            "SELECT COUNT(r4_song_sid.song_id) " + sql_query,
+            (sid, lower_target_bound, upper_target_bound),
+        )
+    else:
+        num_available = db.c.fetch_var(
+            "SELECT COUNT(r4_song_sid.song_id) " + sql_query,
+            (sid, lower_target_bound, upper_target_bound),
+        )
     log.info(
         "song_select",
         "Song pool size (cooldown, blocks, requests, timed) [target %s delta %s]: %s"
@@ -104,6 +132,10 @@ def get_random_song_timed(sid, target_seconds=None, target_delta=None):
             + sql_query % (sid, lower_target_bound, upper_target_bound),
         )
         return get_random_song(sid)
+    elif pool:
+        return Song.load_from_id(
+            pool.get_random_song_id(target_seconds, target_delta), sid
+        )
     else:
         offset = random.randint(1, num_available) - 1
         song_id = db.c.fetch_var(
@@ -130,7 +162,14 @@ def get_random_song(sid):
         "AND song_elec_blocked = FALSE "
         "AND album_requests_pending IS NULL"
     )
-    num_available = db.c.fetch_var("SELECT COUNT(song_id) " + sql_query, (sid,))
+    pool = song_pool.get_pool(sid)
+    if pool:
+        num_available = pool.count()
+        _verify_pool_count(
+            sid, num_available, "SELECT COUNT(song_id) " + sql_query, (sid,)
+        )
+    else:
+        num_available = db.c.fetch_var("SELECT COUNT(song_id) " + sql_query, (sid,))
     log.info(
         "song_select", "Song pool size (cooldown, blocks, requests): %s" % num_available
     )
@@ -142,6 +181,8 @@ def get_random_song(sid):
             "Song select query: SELECT COUNT(song_id) " + (sql_query % (sid,)),
         )
         return get_random_song_ignore_requests(sid)
+    elif pool:
+        return Song.load_from_id(pool.get_random_song_id(), sid)
     else:
         offset = random.randint(1, num_available) - 1
         song_id = db.c.fetch_var(
@@ -175,13 +216,22 @@ def get_random_song_ignore_requests(sid):
     """
     sql_query = (
         "FROM r4_song_sid "
+        "JOIN r4_songs USING (song_id) "
+        "JOIN r4_album_sid ON (r4_album_sid.album_id = r4_songs.album_id AND r4_album_sid.sid = r4_song_sid.sid) "
         "WHERE r4_song_sid.sid = %s "
         "AND song_exists = TRUE "
         "AND song_cool = FALSE "
         "AND song_request_only = FALSE "
         "AND song_elec_blocked = FALSE "
     )
-    num_available = db.c.fetch_var("SELECT COUNT(song_id) " + sql_query, (sid,))
+    pool = song_pool.get_pool(sid)
+    if pool:
+        num_available = pool.count(ignore_requests=True)
+        _verify_pool_count(
+            sid, num_available, "SELECT COUNT(song_id) " + sql_query, (sid,)
+        )
+    else:
+        num_available = db.c.fetch_var("SELECT COUNT(song_id) " + sql_query, (sid,))
     log.debug("song_select", "Song pool size (cooldown, blocks): %s" % num_available)
     offset = 0
     if not num_available or num_available == 0:
@@ -191,6 +241,8 @@ def get_random_song_ignore_requests(sid):
             "Song select query: SELECT COUNT(song_id) " + (sql_query % (sid,)),
         )
         return get_random_song_ignore_all(sid)
+    elif pool:
+        return Song.load_from_id(pool.get_random_song_id(ignore_requests=True), sid)
     else:
         offset = random.randint(1, num_available) - 1
         song_id = db.c.fetch_var(
@@ -234,6 +286,7 @@ def warm_cooled_songs(sid):
         "UPDATE r4_song_sid SET song_request_only = FALSE WHERE sid = %s AND song_request_only_end IS NOT NULL AND song_request_only_end < %s AND song_request_only = TRUE",
         (sid, int(timestamp())),
     )
+    song_pool.warm(sid, int(timestamp()))
 
 
 def remove_all_locks(sid):
@@ -248,6 +301,7 @@ def remove_all_locks(sid):
         "UPDATE r4_album_sid SET album_cool = FALSE AND album_cool_lowest = 0 WHERE sid = %s"
         % sid
     )
+    song_pool.reset(sid)
 
 
 def get_all_albums_list_sql(sid, user):
@@ -337,6 +391,7 @@ def reduce_song_blocks(sid):
         "UPDATE r4_song_sid SET song_elec_blocked_num = 0, song_elec_blocked = FALSE WHERE song_elec_blocked_num <= 0 AND song_elec_blocked = TRUE AND sid = %s",
         (sid,),
     )
+    song_pool.reduce_blocks(sid)
 
 
 def get_unrated_songs_for_user(user_id, limit="LIMIT ALL"):
@@ -1,10 +1,9 @@
-import math
 import os
 from time import time as timestamp
 
 from libs import cache, config, db, log
 from nerdwave import rating
-from nerdwave.playlist_objects import cooldown
+from nerdwave.playlist_objects import cooldown, song_pool
 from nerdwave.playlist_objects.metadata import (
     AssociatedMetadata,
     MetadataNotFoundError,
@@ -89,6 +88,10 @@ class Album(AssociatedMetadata):
                 "%s ID %s for sid %s could not be found."
                 % (cls.__name__, album_id, sid)
             )
+        return cls.load_from_row(row, sid)
+
+    @classmethod
+    def load_from_row(cls, row, sid):
         instance = cls()
         instance._assign_from_dict(row, sid)
         instance.sid = sid
@@ -278,78 +281,35 @@ class Album(AssociatedMetadata):
             )
         return new_sids
 
+    def get_cool_time(self, sid):
+        if self.data["cool_override"]:
+            return self.data["cool_override"]
+        cool_time = cooldown.get_album_cool_time(
+            sid,
+            self.rating_precise,
+            self.get_num_songs(sid),
+            self.data["added_on"],
+            self.data["cool_multiply"],
+        )
+        log.debug(
+            "cooldown",
+            "min_album_cool: %s .. max_album_cool: %s .. rating: %s .. cool_multiply: %s .. cool_time: %s"
+            % (
+                cooldown.cooldown_config[sid]["min_album_cool"],
+                cooldown.cooldown_config[sid]["max_album_cool"],
+                self.rating_precise,
+                self.data["cool_multiply"],
+                cool_time,
+            ),
+        )
+        return cool_time
+
     def start_cooldown(self, sid, cool_time=False):
         if sid == 0:
             return
 
-        if cool_time:
-            pass
-        elif self.data["cool_override"]:
-            cool_time = self.data["cool_override"]
-        else:
-            cool_rating = self.rating_precise
-            if not cool_rating or cool_rating == 0:
-                cool_rating = 3
-            # AlbumCD = minAlbumCD + ((maxAlbumR - albumR)/(maxAlbumR - minAlbumR)*(maxAlbumCD - minAlbumCD))
-            # old: auto_cool = cooldown.cooldown_config[sid]['min_album_cool'] + (((4 - (cool_rating - 1)) / 4.0) * (cooldown.cooldown_config[sid]['max_album_cool'] - cooldown.cooldown_config[sid]['min_album_cool']))
-            auto_cool = cooldown.cooldown_config[sid]["min_album_cool"] + (
-                ((5 - cool_rating) / 4.0)
-                * (
-                    cooldown.cooldown_config[sid]["max_album_cool"]
-                    - cooldown.cooldown_config[sid]["min_album_cool"]
-                )
-            )
-            album_song_count = self.get_num_songs(sid)
-            log.debug(
-                "cooldown",
-                "min_album_cool: %s .. max_album_cool: %s .. auto_cool: %s .. album_song_count: %s .. rating: %s"
-                % (
-                    cooldown.cooldown_config[sid]["min_album_cool"],
-                    cooldown.cooldown_config[sid]["max_album_cool"],
-                    auto_cool,
-                    album_song_count,
-                    cool_rating,
-                ),
-            )
-            cool_size_multiplier = config.get_station(
-                sid, "cooldown_size_min_multiplier"
-            ) + (
-                config.get_station(sid, "cooldown_size_max_multiplier")
-                - config.get_station(sid, "cooldown_size_min_multiplier")
-            ) / (
-                1
-                + math.pow(
-                    2.7183,
-                    (
-                        config.get_station(sid, "cooldown_size_slope")
-                        * (
-                            album_song_count
-                            - config.get_station(sid, "cooldown_size_slope_start")
-                        )
-                    ),
-                )
-                / 2
-            )
-            cool_age_multiplier = cooldown.get_age_cooldown_multiplier(
-                self.data["added_on"]
-            )
-            cool_time = int(
-                auto_cool
-                * cool_size_multiplier
-                * cool_age_multiplier
-                * self.data["cool_multiply"]
-            )
-            log.debug(
-                "cooldown",
-                "auto_cool: %s .. cool_size_multiplier: %s .. cool_age_multiplier: %s .. cool_multiply: %s .. cool_time: %s"
-                % (
-                    auto_cool,
-                    cool_size_multiplier,
-                    cool_age_multiplier,
-                    self.data["cool_multiply"],
-                    cool_time,
-                ),
-            )
+        if not cool_time:
+            cool_time = self.get_cool_time(sid)
         updated_album_ids[sid][self.id] = True
         log.debug(
             "cooldown",
@@ -360,23 +320,31 @@ class Album(AssociatedMetadata):
 
     def _start_cooldown_db(self, sid, cool_time):
         cool_end = int(cool_time + timestamp())
-        db.c.update(
-            "UPDATE r4_song_sid "
-            "SET song_cool = TRUE, song_cool_end = %s "
-            "FROM r4_songs "
-            "WHERE r4_song_sid.song_id = r4_songs.song_id AND album_id = %s AND sid = %s AND song_cool_end <= %s ",
-            (cool_end, self.id, sid, cool_end),
+        song_pool.mark_cool(
+            sid,
+            db.c.fetch_all(
+                "UPDATE r4_song_sid "
+                "SET song_cool = TRUE, song_cool_end = %s "
+                "FROM r4_songs "
+                "WHERE r4_song_sid.song_id = r4_songs.song_id AND album_id = %s AND sid = %s AND song_cool_end <= %s "
+                "RETURNING r4_song_sid.song_id, song_cool_end",
+                (cool_end, self.id, sid, cool_end),
+            ),
         )
         request_only_end = cool_end + config.get_station(
             sid, "cooldown_request_only_period"
         )
-        db.c.update(
-            "UPDATE r4_song_sid "
-            "SET song_request_only = TRUE, song_request_only_end = %s "
-            "FROM r4_songs "
-            "WHERE r4_song_sid.song_id = r4_songs.song_id AND album_id = %s AND sid = %s AND song_cool_end <= %s "
-            "AND song_request_only_end IS NOT NULL",
-            (request_only_end, self.id, sid, cool_end),
+        song_pool.mark_request_only(
+            sid,
+            db.c.fetch_all(
+                "UPDATE r4_song_sid "
+                "SET song_request_only = TRUE, song_request_only_end = %s "
+                "FROM r4_songs "
+                "WHERE r4_song_sid.song_id = r4_songs.song_id AND album_id = %s AND sid = %s AND song_cool_end <= %s "
+                "AND song_request_only_end IS NOT NULL "
+                "RETURNING r4_song_sid.song_id, song_request_only_end",
+                (request_only_end, self.id, sid, cool_end),
+            ),
         )
 
     def solve_cool_lowest(self, sid):
@@ -511,12 +479,16 @@ class Album(AssociatedMetadata):
 
     def _start_election_block_db(self, sid, num_elections):
         # refer to song.set_election_block for base SQL
-        db.c.update(
-            "UPDATE r4_song_sid "
-            "SET song_elec_blocked = TRUE, song_elec_blocked_by = %s, song_elec_blocked_num = %s "
-            "FROM r4_songs "
-            "WHERE r4_song_sid.song_id = r4_songs.song_id AND album_id = %s AND sid = %s AND song_elec_blocked_num <= %s",
-            ("album", num_elections, self.id, sid, num_elections),
+        song_pool.mark_elec_blocked(
+            sid,
+            db.c.fetch_all(
+                "UPDATE r4_song_sid "
+                "SET song_elec_blocked = TRUE, song_elec_blocked_by = %s, song_elec_blocked_num = %s "
+                "FROM r4_songs "
+                "WHERE r4_song_sid.song_id = r4_songs.song_id AND album_id = %s AND sid = %s AND song_elec_blocked_num <= %s "
+                "RETURNING r4_song_sid.song_id, song_elec_blocked_num",
+                ("album", num_elections, self.id, sid, num_elections),
+            ),
         )
 
     def load_extra_detail(self, sid, get_all_groups=False):
@@ -608,13 +580,15 @@ class Album(AssociatedMetadata):
             (count, self.id, sid),
         )
 
-    def to_dict(self, user=None):
+    def to_dict(self, user=None, user_rating=None):
         d = {}
         d["id"] = self.id
         for v in ["rating", "art", "name"]:
             d[v] = self.data[v]
 
-        if user:
+        if user and user_rating:
+            d.update(user_rating)
+        elif user:
             d.update(rating.get_album_rating(self.sid, self.id, user.id))
         else:
             d["rating_user"] = None
@@ -1,6 +1,7 @@
 from time import time as timestamp
 import math
 
+from libs import cache
 from libs import config
 from libs import log
 from libs import db
@@ -13,40 +14,65 @@ def prepare_cooldown_algorithm(sid):
     Prepares pre-calculated variables that relate to calculating cooldown.
     Should pull all variables fresh from the DB, for algorithm
     refer to jfinalfunk.
+
+    The variables are calculated once an hour by whichever process gets there first
+    (normally the backend, on a song change) and published to memcache.  Every other
+    process uses the published copy, with its calculation time as the version.
     """
     global cooldown_config
 
-    if not sid in cooldown_config:
-        cooldown_config[sid] = {"time": 0}
-    if cooldown_config[sid]["time"] > (timestamp() - 3600):
+    if sid in cooldown_config and cooldown_config[sid]["time"] > (timestamp() - 3600):
+        return
+
+    published = cache.get_station(sid, "cooldown_config")
+    if published and published["time"] > (timestamp() - 3600):
+        cooldown_config[sid] = published
         return
 
+    cooldown_config[sid] = calculate_cooldown_config(sid)
+    cache.set_station(sid, "cooldown_config", cooldown_config[sid])
+
+
+def calculate_cooldown_config(sid):
     # Variable names from here on down are from jf's proposal at: http://nerdwave.cc/forums/viewtopic.php?f=13&t=1267
-    sum_aasl = db.c.fetch_var(
-        "SELECT SUM(aasl) FROM ("
-        "SELECT AVG(song_length) AS aasl "
+    # One pass over the albums for all the per-album averages, summed up here, rather
+    # than one aggregate query over albums x songs for each sum.
+    albums = db.c.fetch_all(
+        "SELECT AVG(song_length) AS aasl, "
+        "AVG(album_cool_multiply) * AVG(song_length) AS multiplied_length, "
+        "AVG(album_rating) * AVG(song_length) AS rated_length "
         "FROM r4_album_sid "
         "JOIN r4_songs USING (album_id) "
         "JOIN r4_song_sid USING (song_id) "
         "WHERE r4_album_sid.sid = %s AND r4_songs.song_verified = TRUE "
-        "GROUP BY r4_album_sid.album_id) AS jfiscrazy",
+        "GROUP BY r4_album_sid.album_id",
         (sid,),
     )
+    station = db.c.fetch_row(
+        "SELECT "
+        "(SELECT AVG(album_rating) FROM r4_album_sid WHERE r4_album_sid.sid = %s AND r4_album_sid.album_exists = TRUE) AS avg_album_rating, "
+        "AVG(song_length) AS average_song_length, COUNT(song_id) AS number_songs "
+        "FROM r4_songs JOIN r4_song_sid USING (song_id) "
+        "WHERE song_exists = TRUE AND sid = %s",
+        (sid, sid),
+    )
+
+    def album_sum(key):
+        values = [row[key] for row in albums if row[key] is not None]
+        if not values:
+            return None
+        return math.fsum(float(value) for value in values)
+
+    sum_aasl = album_sum("aasl")
     if not sum_aasl:
         sum_aasl = 100000
     log.debug("cooldown", "SID %s: sumAASL: %s" % (sid, sum_aasl))
-    avg_album_rating = db.c.fetch_var(
-        "SELECT AVG(album_rating) FROM r4_album_sid WHERE r4_album_sid.sid = %s AND r4_album_sid.album_exists = TRUE",
-        (sid,),
-    )
+    avg_album_rating = station["avg_album_rating"]
     if not avg_album_rating:
         avg_album_rating = 3.5
     avg_album_rating = min(max(1, avg_album_rating), 5)
     log.debug("cooldown", "SID %s: avg_album_rating: %s" % (sid, avg_album_rating))
-    multiplier_adjustment = db.c.fetch_var(
-        "SELECT SUM(tempvar) FROM (SELECT r4_album_sid.album_id, AVG(album_cool_multiply) * AVG(song_length) AS tempvar FROM r4_album_sid JOIN r4_songs USING (album_id) JOIN r4_song_sid USING (song_id) WHERE r4_album_sid.sid = %s AND r4_songs.song_verified = TRUE GROUP BY r4_album_sid.album_id) AS hooooboy",
-        (sid,),
-    )
+    multiplier_adjustment = album_sum("multiplied_length")
     if not multiplier_adjustment:
         multiplier_adjustment = 1
     multiplier_adjustment = multiplier_adjustment / float(sum_aasl)
@@ -59,17 +85,7 @@ def prepare_cooldown_algorithm(sid):
     )
     base_album_cool = max(min(base_album_cool, 1000000), 1)
     log.debug("cooldown", "SID %s: base_album_cool: %s" % (sid, base_album_cool))
-    base_rating = db.c.fetch_var(
-        "SELECT SUM(tempvar) FROM ("
-        "SELECT r4_album_sid.album_id, AVG(album_rating) * AVG(song_length) AS tempvar "
-        "FROM r4_album_sid "
-        "JOIN r4_songs USING (album_id) "
-        "JOIN r4_song_sid USING (song_id) "
-        "WHERE r4_album_sid.sid = %s AND r4_songs.song_verified = TRUE "
-        "GROUP BY r4_album_sid.album_id"
-        ") AS hooooboy",
-        (sid,),
-    )
+    base_rating = album_sum("rated_length")
     if not base_rating:
         base_rating = 4
     base_rating = min(max(1, float(base_rating) / float(sum_aasl)), 5)
@@ -83,41 +99,34 @@ def prepare_cooldown_algorithm(sid):
     )
     log.debug("cooldown", "SID %s: max_album_cool: %s" % (sid, max_album_cool))
 
-    cooldown_config[sid]["sum_aasl"] = int(sum_aasl)
-    cooldown_config[sid]["avg_album_rating"] = float(avg_album_rating)
-    cooldown_config[sid]["multiplier_adjustment"] = float(multiplier_adjustment)
-    cooldown_config[sid]["base_album_cool"] = int(base_album_cool)
-    cooldown_config[sid]["base_rating"] = float(base_rating)
-    cooldown_config[sid]["min_album_cool"] = int(min_album_cool)
-    cooldown_config[sid]["max_album_cool"] = int(max_album_cool)
-    cooldown_config[sid]["time"] = int(timestamp())
-
-    average_song_length = (
-        db.c.fetch_var(
-            "SELECT AVG(song_length) FROM r4_songs JOIN r4_song_sid USING (song_id) WHERE song_exists = TRUE AND sid = %s",
-            (sid,),
-        )
-        or 0
-    )
+    result = {}
+    result["sum_aasl"] = int(sum_aasl)
+    result["avg_album_rating"] = float(avg_album_rating)
+    result["multiplier_adjustment"] = float(multiplier_adjustment)
+    result["base_album_cool"] = int(base_album_cool)
+    result["base_rating"] = float(base_rating)
+    result["min_album_cool"] = int(min_album_cool)
+    result["max_album_cool"] = int(max_album_cool)
+    result["time"] = int(timestamp())
+
+    average_song_length = station["average_song_length"] or 0
     log.debug(
         "cooldown", "SID %s: average_song_length: %s" % (sid, average_song_length)
     )
-    cooldown_config[sid]["average_song_length"] = float(average_song_length)
+    result["average_song_length"] = float(average_song_length)
     if not average_song_length:
         average_song_length = 160
-    number_songs = db.c.fetch_var(
-        "SELECT COUNT(song_id) FROM r4_song_sid WHERE song_exists = TRUE AND sid = %s",
-        (sid,),
-    )
+    number_songs = station["number_songs"]
     if not number_songs:
         number_songs = 1
     log.debug("cooldown", "SID %s: number_songs: %s" % (sid, number_songs))
-    cooldown_config[sid]["max_song_cool"] = float(average_song_length) * (
+    result["max_song_cool"] = float(average_song_length) * (
         number_songs * config.get_station(sid, "cooldown_song_max_multiplier")
     )
-    cooldown_config[sid]["min_song_cool"] = cooldown_config[sid][
-        "max_song_cool"
-    ] * config.get_station(sid, "cooldown_song_min_multiplier")
+    result["min_song_cool"] = result["max_song_cool"] * config.get_station(
+        sid, "cooldown_song_min_multiplier"
+    )
+    return result
 
 
 def get_age_cooldown_multiplier(added_on):
@@ -143,3 +152,140 @@ def get_age_cooldown_multiplier(added_on):
                 )
             )
     return cool_age_multiplier
+
+
+def get_apply_mode():
+    """
+    "batched" applies a started song's song, album, and group cooldowns in one statement
+    using album cooldowns calculated ahead of time, "per_object" has each object work out
+    and apply its own cooldown.
+    """
+    if config.has("cooldown_apply_mode") and config.get("cooldown_apply_mode"):
+        return config.get("cooldown_apply_mode")
+    return "batched"
+
+
+def get_album_cool_time(sid, rating, song_count, added_on, cool_multiply):
+    cool_rating = rating
+    if not cool_rating or cool_rating == 0:
+        cool_rating = 3
+    # AlbumCD = minAlbumCD + ((maxAlbumR - albumR)/(maxAlbumR - minAlbumR)*(maxAlbumCD - minAlbumCD))
+    # old: auto_cool = cooldown_config[sid]['min_album_cool'] + (((4 - (cool_rating - 1)) / 4.0) * (cooldown_config[sid]['max_album_cool'] - cooldown_config[sid]['min_album_cool']))
+    auto_cool = cooldown_config[sid]["min_album_cool"] + (
+        ((5 - cool_rating) / 4.0)
+        * (cooldown_config[sid]["max_album_cool"] - cooldown_config[sid]["min_album_cool"])
+    )
+    cool_size_multiplier = config.get_station(sid, "cooldown_size_min_multiplier") + (
+        config.get_station(sid, "cooldown_size_max_multiplier")
+        - config.get_station(sid, "cooldown_size_min_multiplier")
+    ) / (
+        1
+        + math.pow(
+            2.7183,
+            (
+                config.get_station(sid, "cooldown_size_slope")
+                * (song_count - config.get_station(sid, "cooldown_size_slope_start"))
+            ),
+        )
+        / 2
+    )
+    cool_age_multiplier = get_age_cooldown_multiplier(added_on)
+    return int(auto_cool * cool_size_multiplier * cool_age_multiplier * cool_multiply)
+
+
+# sid -> {album_id: (album rating, cooldown in seconds)}, calculated for the whole
+# station whenever the cooldown config is recalculated or an admin changes album
+# cooldowns.  Ratings are saved by every station's backend, so an album whose
+# current rating doesn't match the one its cooldown came from is calculated again.
+album_cool_times = {}
+_album_cool_times_version = {}
+
+
+def album_cool_times_changed(sid):
+    """
+    Call after changing album cooldown multipliers or overrides outside the backend.
+    """
+    cache.set_station(sid, "album_cool_times_version", timestamp())
+
+
+def get_album_cool_times(sid):
+    version = (
+        cooldown_config[sid]["time"],
+        cache.get_station(sid, "album_cool_times_version"),
+    )
+    if _album_cool_times_version.get(sid) == version:
+        return album_cool_times[sid]
+
+    start_time = timestamp()
+    cool_times = {}
+    for row in db.c.fetch_all(
+        "SELECT album_id, album_rating, album_song_count, album_added_on, album_cool_multiply, album_cool_override "
+        "FROM r4_album_sid JOIN r4_albums USING (album_id) "
+        "WHERE sid = %s AND album_exists = TRUE",
+        (sid,),
+    ):
+        if row["album_cool_override"]:
+            cool_time = row["album_cool_override"]
+        else:
+            cool_time = get_album_cool_time(
+                sid,
+                row["album_rating"],
+                row["album_song_count"] or 0,
+                row["album_added_on"],
+                row["album_cool_multiply"] or 1,
+            )
+        cool_times[row["album_id"]] = (row["album_rating"], cool_time)
+    album_cool_times[sid] = cool_times
+    _album_cool_times_version[sid] = version
+    log.debug(
+        "cooldown",
+        "SID %s: calculated cooldowns for %s albums in %.3fs."
+        % (sid, len(cool_times), timestamp() - start_time),
+    )
+    return cool_times
+
+
+def start_cooldowns(sid, song_id, song_cool_end, album_id, album_cool_end, group_cools):
+    """
+    Cools down a started song, its album, and its groups in one statement.
+    group_cools: dict of group_id: cool_end
+    Each song takes the latest cool_end of everything it belongs to, and never has its
+    cooldown shortened.  Returns the updated rows, for the song pool.
+    """
+    request_only_period = config.get_station(sid, "cooldown_request_only_period")
+    return db.c.fetch_all(
+        "WITH sources AS ( "
+        "SELECT r4_song_group.song_id, group_cool.cool_end, group_cool.cool_end + 300 AS request_only_end "
+        "FROM UNNEST(%(group_ids)s::INTEGER[], %(group_cool_ends)s::INTEGER[]) AS group_cool (group_id, cool_end) "
+        "JOIN r4_song_group USING (group_id) "
+        "JOIN r4_song_sid ON (r4_song_group.song_id = r4_song_sid.song_id AND r4_song_sid.sid = %(sid)s AND r4_song_sid.song_exists = TRUE) "
+        "UNION ALL "
+        "SELECT song_id, %(album_cool_end)s, %(album_request_only_end)s FROM r4_songs WHERE album_id = %(album_id)s "
+        "UNION ALL "
+        "SELECT %(song_id)s, %(song_cool_end)s, %(song_request_only_end)s "
+        "), targets AS ( "
+        "SELECT DISTINCT ON (song_id) song_id, cool_end, request_only_end FROM sources ORDER BY song_id, cool_end DESC "
+        ") "
+        "UPDATE r4_song_sid SET "
+        "song_cool = CASE WHEN song_cool_end <= targets.cool_end THEN TRUE ELSE song_cool END, "
+        "song_cool_end = GREATEST(song_cool_end, targets.cool_end), "
+        "song_request_only = CASE WHEN song_request_only_end IS NOT NULL THEN TRUE ELSE song_request_only END, "
+        "song_request_only_end = CASE WHEN song_request_only_end IS NULL THEN NULL "
+        "WHEN r4_song_sid.song_id = %(song_id)s THEN %(song_request_only_end)s "
+        "ELSE targets.request_only_end END "
+        "FROM targets "
+        "WHERE r4_song_sid.song_id = targets.song_id AND r4_song_sid.sid = %(sid)s "
+        "AND (r4_song_sid.song_cool_end <= targets.cool_end OR r4_song_sid.song_id = %(song_id)s) "
+        "RETURNING r4_song_sid.song_id, song_cool_end, song_request_only_end",
+        {
+            "sid": sid,
+            "song_id": song_id,
+            "song_cool_end": song_cool_end,
+            "song_request_only_end": song_cool_end + request_only_period,
+            "album_id": album_id,
+            "album_cool_end": album_cool_end,
+            "album_request_only_end": album_cool_end + request_only_period,
+            "group_ids": list(group_cools.keys()),
+            "group_cool_ends": list(group_cools.values()),
+        },
+    )
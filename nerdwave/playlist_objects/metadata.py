@@ -37,6 +37,7 @@ class AssociatedMetadata:
     select_by_name_query = None  # one %s argument: name
     select_by_id_query = None  # one %s argument: self.id
     select_by_song_id_query = None  # one %s argument: song_id
+    select_by_song_ids_query = None  # one %s argument: list of song_ids, include song_id
     disassociate_song_id_query = None  # two %s argument: song_id, self.id
     associate_song_id_query = None  # three %s argument: song_id, self.id, is_tag
     check_self_size_query = None  # one argument: self.id
@@ -86,6 +87,26 @@ class AssociatedMetadata:
             instances.append(instance)
         return instances
 
+    @classmethod
+    def load_rows_from_song_ids(cls, song_ids):
+        """
+        The rows load_list_from_song_id builds instances from, for many songs at once.
+        Returns {song_id: [row, ...]}, see load_list_from_rows.
+        """
+        rows = {song_id: [] for song_id in song_ids}
+        for row in db.c.fetch_all(cls.select_by_song_ids_query, (list(song_ids),)):
+            rows[row["song_id"]].append(row)
+        return rows
+
+    @classmethod
+    def load_list_from_rows(cls, rows):
+        instances = []
+        for row in rows:
+            instance = cls()
+            instance._assign_from_dict(row)
+            instances.append(instance)
+        return instances
+
     def __init__(self):
         self.id = None
         self.is_tag = False
@@ -0,0 +1,143 @@
+from collections import OrderedDict
+from collections import namedtuple
+
+import tornado.ioloop
+
+from libs import cache
+from libs import config
+from libs import log
+
+# Per-process cache of the parts of a song that only the scanner and admin tools
+# change: its r4_songs row, station list, album row, artists, and groups.  Cooldowns,
+# ratings, and play/vote/request counts change as songs play, so Song.load_many reads
+# those fresh on every load and lays them over the snapshot.
+# Snapshots are thrown away when the scanner bumps catalog_version, or when another
+# process sends an invalidate_objects message over ZeroMQ.
+
+# Rows are never handed out - every load builds new instances from copies of them.
+SongSnapshot = namedtuple(
+    "SongSnapshot", ("row", "sids", "album_row", "artist_rows", "group_rows")
+)
+
+# (song_id, sid, all_categories) -> SongSnapshot
+_songs = OrderedDict()
+_catalog_version = None
+# zeromq.publish in processes that have a ZeroMQ publisher, see set_publisher
+_publish = None
+_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+
+def _get_size():
+    if config.has("object_cache_size"):
+        return config.get("object_cache_size")
+    return 20000
+
+
+def _get_report_interval():
+    if config.has("object_cache_report_interval"):
+        return config.get("object_cache_report_interval")
+    return 3600
+
+
+def is_enabled():
+    return _get_size() > 0
+
+
+def set_publisher(publish):
+    global _publish
+    _publish = publish
+
+
+def get_songs(keys):
+    hits = {}
+    for key in keys:
+        snapshot = _songs.get(key)
+        if snapshot:
+            _songs.move_to_end(key)
+            hits[key] = snapshot
+    _stats["hits"] += len(hits)
+    _stats["misses"] += len(keys) - len(hits)
+    return hits
+
+
+def set_song(key, snapshot):
+    _songs[key] = snapshot
+    _songs.move_to_end(key)
+    while len(_songs) > _get_size():
+        _songs.popitem(last=False)
+
+
+def clear(song_ids=None):
+    """
+    Throws away this process' snapshots of the given songs, or all of them.
+    """
+    _stats["invalidations"] += 1
+    if song_ids is None:
+        _songs.clear()
+        return
+    song_ids = set(song_ids)
+    for key in [key for key in _songs if key[0] in song_ids]:
+        del _songs[key]
+
+
+def invalidate(song_ids=None):
+    """
+    Call after changing songs, albums, artists, or groups outside the scanner.
+    Clears the snapshots here and in every process listening on ZeroMQ.
+    """
+    clear(song_ids)
+    if _publish:
+        _publish({"action": "invalidate_objects", "song_ids": song_ids})
+
+
+def on_invalidate(message):
+    clear(message.get("song_ids"))
+
+
+def check_catalog_version():
+    """
+    Called on song changes.  Clears everything if the scanner changed the catalog.
+    """
+    global _catalog_version
+    catalog_version = cache.get("catalog_version")
+    if catalog_version != _catalog_version:
+        if _catalog_version is not None:
+            clear()
+        _catalog_version = catalog_version
+
+
+def get_stats():
+    loads = _stats["hits"] + _stats["misses"]
+    return {
+        "size": len(_songs),
+        "hits": _stats["hits"],
+        "misses": _stats["misses"],
+        "invalidations": _stats["invalidations"],
+        "hit_rate": (_stats["hits"] / loads * 100) if loads else 0,
+    }
+
+
+def report():
+    stats = get_stats()
+    log.info(
+        "object_cache",
+        "%s songs cached, %s hits, %s misses (%.1f%%), %s invalidations."
+        % (
+            stats["size"],
+            stats["hits"],
+            stats["misses"],
+            stats["hit_rate"],
+            stats["invalidations"],
+        ),
+    )
+    _stats["hits"] = 0
+    _stats["misses"] = 0
+    _stats["invalidations"] = 0
+
+
+def setup_reporting():
+    """
+    Logs the hit rate every object_cache_report_interval seconds.
+    """
+    if _get_report_interval():
+        tornado.ioloop.PeriodicCallback(report, _get_report_interval() * 1000).start()
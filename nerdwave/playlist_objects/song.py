@@ -10,11 +10,14 @@ from time import time as timestamp
 
 from libs import cache, config, db, log, replaygain
 from mutagen.mp3 import MP3
+from nerdwave import leaderboards
 from nerdwave import rating
-from nerdwave.playlist_objects import cooldown
-from nerdwave.playlist_objects.album import Album
+from nerdwave import song_ranks
+from nerdwave.playlist_objects import cooldown, object_cache, song_pool
+from nerdwave.playlist_objects.album import Album, updated_album_ids
 from nerdwave.playlist_objects.artist import Artist
 from nerdwave.playlist_objects.metadata import (
+    MetadataNotFoundError,
     MetadataUpdateError,
     make_searchable_string,
 )
@@ -29,6 +32,48 @@ def set_umask():
     os.umask(0o02)
 
 
+def read_tags(filename):
+    """
+    Reads the ID3 tags used by Song into a plain dict, without touching the database.
+    """
+
+    tags = {"genre_tag": None, "link_text": None, "url": None}
+    with open(filename, "rb") as mp3file:
+        f = MP3(mp3file, translate=False)
+
+        if not f.tags:
+            raise PassableScanError('Song filename "%s" has no tags.' % filename)
+
+        w = f.tags.getall("TIT2")
+        if len(w) > 0 and len(str(w[0])) > 0:
+            tags["title"] = str(w[0]).strip()
+        else:
+            raise PassableScanError('Song filename "%s" has no title tag.' % filename)
+        w = f.tags.getall("TPE1")
+        if len(w) > 0 and len(str(w[0])) > 0:
+            tags["artist_tag"] = str(w[0])
+        else:
+            raise PassableScanError('Song filename "%s" has no artist tag.' % filename)
+        w = f.tags.getall("TALB")
+        if len(w) > 0 and len(str(w[0]).strip()) > 0:
+            tags["album_tag"] = str(w[0]).strip()
+        else:
+            raise PassableScanError('Song filename "%s" has no album tag.' % filename)
+
+        w = f.tags.getall("TCON")
+        if len(w) > 0 and len(str(w[0])) > 0:
+            tags["genre_tag"] = str(w[0])
+        w = f.tags.getall("COMM")
+        if len(w) > 0 and len(str(w[0])) > 0:
+            tags["link_text"] = str(w[0]).strip()
+        w = f.tags.getall("WXXX")
+        if len(w) > 0 and len(str(w[0])) > 0:
+            tags["url"] = str(w[0]).strip()
+
+        tags["length"] = int(f.info.length)
+    return tags
+
+
 def zip_metadata(tag_metadata, kept_metadata):
     new_metadata = copy.copy(tag_metadata)
     for kept in kept_metadata:
@@ -79,6 +124,12 @@ class Song:
 
     @classmethod
     def load_from_id(cls, song_id, sid=None, all_categories=False):
+        if sid is not None and object_cache.is_enabled():
+            songs = cls.load_many([song_id], sid, all_categories)
+            if song_id not in songs:
+                raise SongNonExistent
+            return songs[song_id]
+
         if sid is not None:
             d = db.c.fetch_row(
                 "SELECT * FROM r4_songs JOIN r4_song_sid USING (song_id) WHERE r4_songs.song_id = %s AND r4_song_sid.sid = %s",
@@ -122,10 +173,125 @@ class Song:
         return s
 
     @classmethod
-    def load_from_file(cls, filename, sids):
+    def load_many(cls, song_ids, sid, all_categories=False):
+        """
+        Loads songs on a station with the same handful of queries however many there
+        are, using object_cache for everything but cooldowns, ratings, and counts.
+        Returns {song_id: Song}, leaving out songs that aren't on the station.
+        """
+        keys = {song_id: (song_id, sid, all_categories) for song_id in song_ids}
+        if not keys:
+            return {}
+        snapshots = object_cache.get_songs(list(keys.values()))
+        missing = [song_id for song_id, key in keys.items() if key not in snapshots]
+        if missing:
+            for song_id, snapshot in cls._load_snapshots(
+                missing, sid, all_categories
+            ).items():
+                snapshots[keys[song_id]] = snapshot
+                if object_cache.is_enabled():
+                    object_cache.set_song(keys[song_id], snapshot)
+
+        songs = {}
+        for live in db.c.fetch_all(
+            "SELECT r4_song_sid.*, song_verified, song_rating, song_rating_count, song_fave_count, song_request_count, song_vote_count, song_votes_seen, song_vote_share, "
+            "r4_album_sid.sid AS album_sid, album_rating, album_rating_count, album_cool, album_cool_lowest, album_cool_multiply, album_cool_override "
+            "FROM r4_song_sid "
+            "JOIN r4_songs USING (song_id) "
+            "LEFT JOIN r4_album_sid ON (r4_album_sid.album_id = r4_songs.album_id AND r4_album_sid.sid = r4_song_sid.sid) "
+            "WHERE r4_song_sid.song_id = ANY(%s) AND r4_song_sid.sid = %s",
+            (list(keys), sid),
+        ):
+            snapshot = snapshots.get(keys[live["song_id"]])
+            if snapshot:
+                songs[live["song_id"]] = cls._load_from_snapshot(snapshot, live, sid)
+        return songs
+
+    @classmethod
+    def _load_snapshots(cls, song_ids, sid, all_categories):
+        rows = db.c.fetch_all(
+            "SELECT * FROM r4_songs WHERE song_id = ANY(%s)", (song_ids,)
+        )
+        sids = {song_id: [] for song_id in song_ids}
+        for row in db.c.fetch_all(
+            "SELECT song_id, sid FROM r4_song_sid WHERE song_id = ANY(%s)",
+            (song_ids,),
+        ):
+            sids[row["song_id"]].append(row["sid"])
+        album_ids = list({row["album_id"] for row in rows if row["album_id"]})
+        albums = {}
+        if album_ids:
+            for row in db.c.fetch_all(
+                "SELECT r4_albums.* FROM r4_albums WHERE album_id = ANY(%s)",
+                (album_ids,),
+            ):
+                albums[row["album_id"]] = row
+        artists = Artist.load_rows_from_song_ids(song_ids)
+        groups = SongGroup.load_rows_from_song_ids(
+            song_ids, sid, all_categories=all_categories
+        )
+        return {
+            row["song_id"]: object_cache.SongSnapshot(
+                row,
+                sids[row["song_id"]],
+                albums.get(row["album_id"]),
+                artists[row["song_id"]],
+                groups[row["song_id"]],
+            )
+            for row in rows
+        }
+
+    @classmethod
+    def _load_from_snapshot(cls, snapshot, live, sid):
+        d = dict(snapshot.row)
+        d.update(live)
+
+        s = cls()
+        s.id = d["song_id"]
+        s.sid = sid
+        s.filename = d["song_filename"]
+        s.verified = d["song_verified"]
+        s.replay_gain = d["song_replay_gain"]
+        s.data["sids"] = list(snapshot.sids)
+        s.data["sid"] = sid
+        s.data["rank"] = None
+        s._assign_from_dict(d)
+
+        try:
+            if d["album_id"]:
+                if not snapshot.album_row or live["album_sid"] is None:
+                    raise MetadataNotFoundError(
+                        "Album ID %s for sid %s could not be found."
+                        % (d["album_id"], sid)
+                    )
+                album_row = dict(snapshot.album_row)
+                for key in (
+                    "album_rating",
+                    "album_rating_count",
+                    "album_cool",
+                    "album_cool_lowest",
+                    "album_cool_multiply",
+                    "album_cool_override",
+                ):
+                    album_row[key] = live[key]
+                s.album = Album.load_from_row(album_row, sid)
+            s.artists = Artist.load_list_from_rows(snapshot.artist_rows)
+            s.groups = SongGroup.load_list_from_rows(snapshot.group_rows)
+        except Exception as e:
+            log.exception(
+                "song", "Song ID %s failed to load, sid %s." % (s.id, sid), e
+            )
+            s.disable()
+            raise
+
+        return s
+
+    @classmethod
+    def load_from_file(cls, filename, sids, tags=None, replay_gain=None):
         """
         Produces an instance of the Song class with all album, group, and artist IDs loaded from only a filename.
         All metadata is saved to the database and updated where necessary.
+        tags and replay_gain can be precomputed (see read_tags) to skip reading the file.
         """
 
         kept_artists = []
@@ -160,7 +326,7 @@ class Song:
         else:
             s = cls()
 
-        s.load_tag_from_file(filename)
+        s.load_tag_from_file(filename, tags)
         s.save(sids)
 
         new_artists = Artist.load_list_from_tag(s.artist_tag)
@@ -189,7 +355,7 @@ class Song:
             )
             is None
         ):
-            s.replay_gain = s.get_replay_gain()
+            s.replay_gain = replay_gain or s.get_replay_gain()
             db.c.update(
                 "UPDATE r4_songs SET song_replay_gain = %s WHERE song_id = %s",
                 (s.replay_gain, s.id),
@@ -240,53 +406,24 @@ class Song:
         self.replay_gain = None
         self.fake = False
 
-    def load_tag_from_file(self, filename):
+    def load_tag_from_file(self, filename, tags=None):
         """
         Reads ID3 tags and sets object-level variables.
+        tags can be passed in if read_tags() was already run, e.g. by a scanner worker.
         """
 
-        with open(filename, "rb") as mp3file:
-            f = MP3(mp3file, translate=False)
-            self.filename = filename
-
-            if not f.tags:
-                raise PassableScanError('Song filename "%s" has no tags.' % filename)
-
-            w = f.tags.getall("TIT2")
-            if len(w) > 0 and len(str(w[0])) > 0:
-                self.data["title"] = str(w[0]).strip()
-            else:
-                raise PassableScanError(
-                    'Song filename "%s" has no title tag.' % filename
-                )
-            w = f.tags.getall("TPE1")
-            if len(w) > 0 and len(str(w[0])) > 0:
-                self.artist_tag = str(w[0])
-            else:
-                raise PassableScanError(
-                    'Song filename "%s" has no artist tag.' % filename
-                )
-            w = f.tags.getall("TALB")
-            if len(w) > 0 and len(str(w[0]).strip()) > 0:
-                self.album_tag = str(w[0]).strip()
-            else:
-                raise PassableScanError(
-                    'Song filename "%s" has no album tag.' % filename
-                )
-
-            w = f.tags.getall("TCON")
-            if len(w) > 0 and len(str(w[0])) > 0:
-                self.genre_tag = str(w[0])
-            w = f.tags.getall("COMM")
-            if len(w) > 0 and len(str(w[0])) > 0:
-                self.data["link_text"] = str(w[0]).strip()
-            w = f.tags.getall("WXXX")
-            if len(w) > 0 and len(str(w[0])) > 0:
-                self.data["url"] = str(w[0]).strip()
-            else:
-                self.data["url"] = None
-
-            self.data["length"] = int(f.info.length)
+        if tags is None:
+            tags = read_tags(filename)
+        self.filename = filename
+        self.data["title"] = tags["title"]
+        self.artist_tag = tags["artist_tag"]
+        self.album_tag = tags["album_tag"]
+        if tags["genre_tag"] is not None:
+            self.genre_tag = tags["genre_tag"]
+        if tags["link_text"] is not None:
+            self.data["link_text"] = tags["link_text"]
+        self.data["url"] = tags["url"]
+        self.data["length"] = tags["length"]
 
     def get_replay_gain(self):
         return replaygain.get_gain_for_song(self.filename)
@@ -482,17 +619,20 @@ class Song:
         if (self.sid != sid) or (not self.sid in self.data["sids"]) or sid == 0:
             return
 
-        for metadata in self.groups:
-            log.debug(
-                "song_cooldown", "Starting group cooldown on group %s" % metadata.id
-            )
-            metadata.start_cooldown(sid)
-        # Albums always have to go last since album records in the DB store cached cooldown values
-        if self.album:
-            log.debug(
-                "song_cooldown", "Starting album cooldown on album %s" % self.album.id
-            )
-            self.album.start_cooldown(sid)
+        batched = cooldown.get_apply_mode() == "batched"
+        if not batched:
+            for metadata in self.groups:
+                log.debug(
+                    "song_cooldown", "Starting group cooldown on group %s" % metadata.id
+                )
+                metadata.start_cooldown(sid)
+            # Albums always have to go last since album records in the DB store cached cooldown values
+            if self.album:
+                log.debug(
+                    "song_cooldown",
+                    "Starting album cooldown on album %s" % self.album.id,
+                )
+                self.album.start_cooldown(sid)
 
         cool_time = cooldown.cooldown_config[sid]["max_song_cool"]
         if self.data["cool_override"]:
@@ -520,10 +660,6 @@ class Song:
             "Song ID %s Station ID %s cool_time period: %s" % (self.id, sid, cool_time),
         )
         cool_time = int(cool_time + timestamp())
-        db.c.update(
-            "UPDATE r4_song_sid SET song_cool = TRUE, song_cool_end = %s WHERE song_id = %s AND sid = %s AND song_cool_end < %s",
-            (cool_time, self.id, sid, cool_time),
-        )
         self.data["cool"] = True
         self.data["cool_end"] = cool_time
 
@@ -532,9 +668,55 @@ class Song:
             sid, "cooldown_request_only_period"
         )
         self.data["request_only"] = True
-        db.c.update(
-            "UPDATE r4_song_sid SET song_request_only = TRUE, song_request_only_end = %s WHERE song_id = %s AND sid = %s AND song_request_only_end IS NOT NULL",
-            (self.data["request_only_end"], self.id, sid),
+
+        if batched:
+            self._start_cooldowns_batched(sid)
+            return
+
+        song_pool.mark_cool(
+            sid,
+            db.c.fetch_all(
+                "UPDATE r4_song_sid SET song_cool = TRUE, song_cool_end = %s WHERE song_id = %s AND sid = %s AND song_cool_end < %s RETURNING song_id, song_cool_end",
+                (self.data["cool_end"], self.id, sid, self.data["cool_end"]),
+            ),
+        )
+        song_pool.mark_request_only(
+            sid,
+            db.c.fetch_all(
+                "UPDATE r4_song_sid SET song_request_only = TRUE, song_request_only_end = %s WHERE song_id = %s AND sid = %s AND song_request_only_end IS NOT NULL RETURNING song_id, song_request_only_end",
+                (self.data["request_only_end"], self.id, sid),
+            ),
+        )
+
+    def _start_cooldowns_batched(self, sid):
+        # Same cooldowns as the group and album start_cooldown calls, with album
+        # cooldowns calculated ahead of time, applied along with the song's in one go.
+        group_cools = {}
+        if not config.has_station(
+            sid, "cooldown_enable_for_categories"
+        ) or config.get_station(sid, "cooldown_enable_for_categories"):
+            for metadata in self.groups:
+                if metadata.cool_time is not None and metadata.cool_time > 0:
+                    group_cools[metadata.id] = int(metadata.cool_time + timestamp())
+
+        album_id = None
+        album_cool_end = 0
+        if self.album:
+            album_id = self.album.id
+            cool_times = cooldown.get_album_cool_times(sid)
+            cool_rating, album_cool_time = cool_times.get(album_id, (None, None))
+            if album_cool_time is None or cool_rating != self.album.rating_precise:
+                album_cool_time = self.album.get_cool_time(sid)
+                cool_times[album_id] = (self.album.rating_precise, album_cool_time)
+            album_cool_end = int(album_cool_time + timestamp())
+            updated_album_ids[sid][album_id] = True
+
+        rows = cooldown.start_cooldowns(
+            sid, self.id, self.data["cool_end"], album_id, album_cool_end, group_cools
+        )
+        song_pool.mark_cool(sid, rows)
+        song_pool.mark_request_only(
+            sid, [row for row in rows if row["song_request_only_end"] is not None]
         )
 
     def start_election_block(self, sid, num_elections):
@@ -548,9 +730,12 @@ class Song:
         self.set_election_block(sid, "in_election", num_elections)
 
     def set_election_block(self, sid, blocked_by, block_length):
-        db.c.update(
-            "UPDATE r4_song_sid SET song_elec_blocked = TRUE, song_elec_blocked_by = %s, song_elec_blocked_num = %s WHERE song_id = %s AND sid = %s AND song_elec_blocked_num <= %s",
-            (blocked_by, block_length, self.id, sid, block_length),
+        song_pool.mark_elec_blocked(
+            sid,
+            db.c.fetch_all(
+                "UPDATE r4_song_sid SET song_elec_blocked = TRUE, song_elec_blocked_by = %s, song_elec_blocked_num = %s WHERE song_id = %s AND sid = %s AND song_elec_blocked_num <= %s RETURNING song_id, song_elec_blocked_num",
+                (blocked_by, block_length, self.id, sid, block_length),
+            ),
         )
         self.data["elec_blocked_num"] = block_length
         self.data["elec_blocked_by"] = blocked_by
@@ -577,6 +762,7 @@ class Song:
                 "UPDATE r4_songs SET song_rating = %s, song_rating_count = %s WHERE song_id = %s",
                 (self.data["rating"], potential_points, self.id),
             )
+            leaderboards.song_rating_changed(self)
 
         if not skip_album_update and self.album:
             self.album.update_rating()
@@ -668,14 +854,20 @@ class Song:
         )
 
     def load_extra_detail(self, sid):
-        self.data["rating_rank"] = db.c.fetch_var(
-            "SELECT COUNT(song_id) + 1 FROM r4_songs WHERE song_verified = TRUE AND song_rating > %s",
-            (self.data["rating"],),
-        )
-        self.data["request_rank"] = db.c.fetch_var(
-            "SELECT COUNT(song_id) + 1 FROM r4_songs WHERE song_verified = TRUE AND song_request_count > %s",
-            (self.data["request_count"],),
-        )
+        if song_ranks.is_built():
+            self.data["rating_rank"] = song_ranks.get_rating_rank(self.data["rating"])
+            self.data["request_rank"] = song_ranks.get_request_rank(
+                self.data["request_count"]
+            )
+        else:
+            self.data["rating_rank"] = db.c.fetch_var(
+                "SELECT COUNT(song_id) + 1 FROM r4_songs WHERE song_verified = TRUE AND song_rating > %s",
+                (self.data["rating"],),
+            )
+            self.data["request_rank"] = db.c.fetch_var(
+                "SELECT COUNT(song_id) + 1 FROM r4_songs WHERE song_verified = TRUE AND song_request_count > %s",
+                (self.data["request_count"],),
+            )
         self.data["rating_rank_percentile"] = (
             float(num_songs["_total"] - self.data["rating_rank"])
             / float(num_songs["_total"])
@@ -691,24 +883,15 @@ class Song:
             5, min(99, int(self.data["request_rank_percentile"]))
         )
 
-        self.data["rating_histogram"] = {}
-        histo = db.c.fetch_all(
-            "SELECT "
-            "ROUND(((song_rating_user * 10) - (CAST(song_rating_user * 10 AS SMALLINT) %% 5))) / 10 AS rating_user_rnd, "
-            "COUNT(song_rating_user) AS rating_user_count "
-            "FROM r4_song_ratings JOIN phpbb_users USING (user_id) "
-            "WHERE radio_inactive = FALSE AND song_id = %s "
-            "GROUP BY rating_user_rnd "
-            "ORDER BY rating_user_rnd",
-            (self.id,),
+        self.data["rating_histogram"] = song_ranks.get_rating_histogram(
+            self.id, self.data["rating"], self.data["rating_count"]
         )
-        for point in histo:
-            if point["rating_user_rnd"]:
-                self.data["rating_histogram"][str(point["rating_user_rnd"])] = point[
-                    "rating_user_count"
-                ]
 
-    def to_dict(self, user=None):
+    def to_dict(self, user=None, song_ratings=None, album_ratings=None):
+        """
+        song_ratings and album_ratings are optional pre-fetched results of
+        rating.get_song_ratings/get_album_ratings for the user, see BaseEvent.to_dict.
+        """
         d = {}
         d["title"] = self.data["title"]
         d["id"] = self.id
@@ -726,7 +909,11 @@ class Song:
         d["albums"] = []
         d["groups"] = []
         if self.album:
-            d["albums"] = [self.album.to_dict(user)]
+            d["albums"] = [
+                self.album.to_dict(
+                    user, album_ratings.get(self.album.id) if album_ratings else None
+                )
+            ]
         if self.artists:
             for metadata in self.artists:
                 d["artists"].append(metadata.to_dict(user))
@@ -738,7 +925,10 @@ class Song:
         d["fave"] = None
         d["rating_allowed"] = self.data["rating_allowed"]
         if user:
-            d.update(rating.get_song_rating(self.id, user.id))
+            if song_ratings and self.id in song_ratings:
+                d.update(song_ratings[self.id])
+            else:
+                d.update(rating.get_song_rating(self.id, user.id))
             if user.data["rate_anything"]:
                 d["rating_allowed"] = True
 
@@ -0,0 +1,383 @@
+import heapq
+import random
+from array import array
+from time import time as timestamp
+
+from libs import cache
+from libs import config
+from libs import db
+from libs import log
+
+# Per-station in-memory index of song eligibility, used by the backend to pick
+# random songs for elections without COUNT(*) + OFFSET queries.
+# Only the backend process loads these; everywhere else pools[sid] is missing
+# and every hook in this module is a no-op.
+pools = {}
+
+_EXISTS = 1
+_COOL = 2
+_BLOCKED = 4
+_REQUEST_ONLY = 8
+
+
+def get_mode():
+    """
+    "memory" picks from the index, "sql" ignores the index entirely,
+    "verify" picks from the index but cross-checks pool sizes against SQL.
+    """
+    if config.has("song_pool_mode") and config.get("song_pool_mode"):
+        return config.get("song_pool_mode")
+    return "memory"
+
+
+def get_pool(sid):
+    if get_mode() == "sql":
+        return None
+    pool = pools.get(sid)
+    if pool and pool.is_stale():
+        pool.load()
+    return pool
+
+
+def load(sid):
+    if get_mode() == "sql":
+        return None
+    pools[sid] = SongPool(sid)
+    pools[sid].load()
+    return pools[sid]
+
+
+def reset(sid):
+    """
+    Marks the pool as stale so it gets rebuilt from the database on next use.
+    Call this whenever a transaction that touched r4_song_sid is rolled back.
+    """
+    if sid in pools:
+        pools[sid].loaded_at = 0
+
+
+def reset_all():
+    """
+    Called when another process changed songs (admin cooldown and election block
+    edits send invalidate_objects), since those changes never reach the pool.
+    """
+    for sid in pools:
+        reset(sid)
+
+
+def mark_cool(sid, rows):
+    """
+    rows: list of dicts with song_id, song_cool_end (from UPDATE ... RETURNING)
+    """
+    if sid in pools and rows:
+        pools[sid].mark_cool(rows)
+
+
+def mark_request_only(sid, rows):
+    """
+    rows: list of dicts with song_id, song_request_only_end (from UPDATE ... RETURNING)
+    """
+    if sid in pools and rows:
+        pools[sid].mark_request_only(rows)
+
+
+def mark_elec_blocked(sid, rows):
+    """
+    rows: list of dicts with song_id, song_elec_blocked_num (from UPDATE ... RETURNING)
+    """
+    if sid in pools and rows:
+        pools[sid].mark_elec_blocked(rows)
+
+
+def reduce_blocks(sid):
+    if sid in pools:
+        pools[sid].reduce_blocks()
+
+
+def warm(sid, now=None):
+    if sid in pools:
+        pools[sid].warm(now or int(timestamp()))
+
+
+def set_albums_with_requests(sid, album_ids):
+    if sid in pools:
+        pools[sid].set_albums_with_requests(album_ids)
+
+
+class _DenseSet:
+    """
+    Set of song indexes with O(1) add, remove, and uniform random pick.
+    Positions are tracked in a shared-size array rather than a dict.
+    """
+
+    def __init__(self, size):
+        self.members = array("l")
+        self.pos = array("l", [-1]) * size
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, idx):
+        return self.pos[idx] != -1
+
+    def add(self, idx):
+        if self.pos[idx] != -1:
+            return
+        self.pos[idx] = len(self.members)
+        self.members.append(idx)
+
+    def discard(self, idx):
+        p = self.pos[idx]
+        if p == -1:
+            return
+        last = self.members.pop()
+        if last != idx:
+            self.members[p] = last
+            self.pos[last] = p
+        self.pos[idx] = -1
+
+    def pick(self):
+        return self.members[random.randint(0, len(self.members) - 1)]
+
+
+class _LengthBuckets:
+    """
+    Songs bucketed by length in seconds, each bucket a dense array, so a
+    random pick within a length window only walks the buckets in the window.
+    """
+
+    def __init__(self, size, lengths):
+        self.lengths = lengths
+        self.buckets = {}
+        self.pos = array("l", [-1]) * size
+
+    def add(self, idx):
+        if self.pos[idx] != -1:
+            return
+        bucket = self.buckets.setdefault(self.lengths[idx], array("l"))
+        self.pos[idx] = len(bucket)
+        bucket.append(idx)
+
+    def discard(self, idx):
+        p = self.pos[idx]
+        if p == -1:
+            return
+        bucket = self.buckets[self.lengths[idx]]
+        last = bucket.pop()
+        if last != idx:
+            bucket[p] = last
+            self.pos[last] = p
+        self.pos[idx] = -1
+
+    def count(self, low, high):
+        return sum(len(self.buckets.get(l, ())) for l in range(low, high + 1))
+
+    def pick(self, low, high):
+        total = self.count(low, high)
+        if not total:
+            return None
+        offset = random.randint(0, total - 1)
+        for l in range(low, high + 1):
+            bucket = self.buckets.get(l)
+            if not bucket:
+                continue
+            if offset < len(bucket):
+                return bucket[offset]
+            offset -= len(bucket)
+        return None
+
+
+class SongPool:
+    def __init__(self, sid):
+        self.sid = sid
+        self.loaded_at = 0
+        self.catalog_version = None
+        self._clear(0)
+
+    def _clear(self, size):
+        self.song_ids = array("l")
+        self.lengths = array("l")
+        self.album_ids = array("l")
+        self.flags = bytearray(size)
+        self.cool_end = array("l")
+        self.request_only_end = array("l")
+        self.elec_blocked_num = array("l")
+        self.index = {}
+        self.album_songs = {}
+        self.albums_pending = set()
+        self.blocked = set()
+        self.cool_heap = []
+        self.request_only_heap = []
+
+    def is_stale(self):
+        refresh = 3600
+        if config.has("song_pool_refresh"):
+            refresh = config.get("song_pool_refresh")
+        if self.loaded_at < (timestamp() - refresh):
+            return True
+        # the scanner added, changed, or removed songs
+        return self.catalog_version != cache.get("catalog_version")
+
+    def load(self):
+        start_time = timestamp()
+        self.catalog_version = cache.get("catalog_version")
+        rows = db.c.fetch_all(
+            "SELECT r4_song_sid.song_id, COALESCE(song_length, 0) AS song_length, r4_songs.album_id, "
+            "song_cool, song_cool_end, song_elec_blocked, song_elec_blocked_num, "
+            "song_request_only, song_request_only_end, album_requests_pending "
+            "FROM r4_song_sid "
+            "JOIN r4_songs USING (song_id) "
+            "JOIN r4_album_sid ON (r4_album_sid.album_id = r4_songs.album_id AND r4_album_sid.sid = r4_song_sid.sid) "
+            "WHERE r4_song_sid.sid = %s AND song_exists = TRUE",
+            (self.sid,),
+        )
+        self._clear(len(rows))
+        for idx, row in enumerate(rows):
+            self.song_ids.append(row["song_id"])
+            self.lengths.append(row["song_length"])
+            self.album_ids.append(row["album_id"] or 0)
+            self.cool_end.append(row["song_cool_end"] or 0)
+            self.request_only_end.append(row["song_request_only_end"] or 0)
+            self.elec_blocked_num.append(row["song_elec_blocked_num"] or 0)
+            self.index[row["song_id"]] = idx
+            self.album_songs.setdefault(row["album_id"] or 0, []).append(idx)
+            flags = _EXISTS
+            if row["song_cool"]:
+                flags |= _COOL
+                self.cool_heap.append((self.cool_end[idx], idx))
+            if row["song_elec_blocked"]:
+                flags |= _BLOCKED
+                self.blocked.add(idx)
+            if row["song_request_only"]:
+                flags |= _REQUEST_ONLY
+                if row["song_request_only_end"] is not None:
+                    self.request_only_heap.append((self.request_only_end[idx], idx))
+            self.flags[idx] = flags
+            if row["album_requests_pending"]:
+                self.albums_pending.add(row["album_id"])
+        heapq.heapify(self.cool_heap)
+        heapq.heapify(self.request_only_heap)
+
+        self.available = _DenseSet(len(rows))
+        self.eligible = _DenseSet(len(rows))
+        self.eligible_by_length = _LengthBuckets(len(rows), self.lengths)
+        for idx in range(len(rows)):
+            self._update_membership(idx)
+
+        self.loaded_at = timestamp()
+        log.debug(
+            "song_pool",
+            "SID %s: loaded %s songs (%s eligible) in %.6f"
+            % (self.sid, len(rows), len(self.eligible), timestamp() - start_time),
+        )
+
+    def _update_membership(self, idx):
+        # Mirrors the WHERE clauses in nerdwave.playlist - keep them in sync.
+        if self.flags[idx] == _EXISTS:
+            self.available.add(idx)
+            if self.album_ids[idx] in self.albums_pending:
+                self.eligible.discard(idx)
+                self.eligible_by_length.discard(idx)
+            else:
+                self.eligible.add(idx)
+                self.eligible_by_length.add(idx)
+        else:
+            self.available.discard(idx)
+            self.eligible.discard(idx)
+            self.eligible_by_length.discard(idx)
+
+    def _set_flag(self, idx, flag, on):
+        if on:
+            self.flags[idx] |= flag
+        else:
+            self.flags[idx] &= ~flag & 0xFF
+        self._update_membership(idx)
+
+    def mark_cool(self, rows):
+        for row in rows:
+            idx = self.index.get(row["song_id"])
+            if idx is None:
+                continue
+            self.cool_end[idx] = row["song_cool_end"]
+            heapq.heappush(self.cool_heap, (row["song_cool_end"], idx))
+            self._set_flag(idx, _COOL, True)
+
+    def mark_request_only(self, rows):
+        for row in rows:
+            idx = self.index.get(row["song_id"])
+            if idx is None:
+                continue
+            self.request_only_end[idx] = row["song_request_only_end"]
+            heapq.heappush(self.request_only_heap, (row["song_request_only_end"], idx))
+            self._set_flag(idx, _REQUEST_ONLY, True)
+
+    def mark_elec_blocked(self, rows):
+        for row in rows:
+            idx = self.index.get(row["song_id"])
+            if idx is None:
+                continue
+            self.elec_blocked_num[idx] = row["song_elec_blocked_num"]
+            self.blocked.add(idx)
+            self._set_flag(idx, _BLOCKED, True)
+
+    def reduce_blocks(self):
+        # Same two-step logic as nerdwave.playlist.reduce_song_blocks
+        for idx in list(self.blocked):
+            self.elec_blocked_num[idx] -= 1
+            if self.elec_blocked_num[idx] <= 0:
+                self.elec_blocked_num[idx] = 0
+                self.blocked.discard(idx)
+                self._set_flag(idx, _BLOCKED, False)
+
+    def warm(self, now):
+        # Heap entries can be outdated if a cooldown was extended; only the
+        # entry matching the current end time is allowed to warm the song.
+        while self.cool_heap and self.cool_heap[0][0] < now:
+            cool_end, idx = heapq.heappop(self.cool_heap)
+            if self.cool_end[idx] == cool_end and self.flags[idx] & _COOL:
+                self._set_flag(idx, _COOL, False)
+        while self.request_only_heap and self.request_only_heap[0][0] < now:
+            request_only_end, idx = heapq.heappop(self.request_only_heap)
+            if (
+                self.request_only_end[idx] == request_only_end
+                and self.flags[idx] & _REQUEST_ONLY
+            ):
+                self._set_flag(idx, _REQUEST_ONLY, False)
+
+    def set_albums_with_requests(self, album_ids):
+        new_pending = set(album_ids)
+        changed = new_pending.symmetric_difference(self.albums_pending)
+        self.albums_pending = new_pending
+        for album_id in changed:
+            for idx in self.album_songs.get(album_id, ()):
+                self._update_membership(idx)
+
+    def count(self, target_seconds=None, target_delta=None, ignore_requests=False):
+        if ignore_requests:
+            return len(self.available)
+        if target_seconds:
+            low, high = self._length_window(target_seconds, target_delta)
+            return self.eligible_by_length.count(low, high)
+        return len(self.eligible)
+
+    def _length_window(self, target_seconds, target_delta):
+        # SQL compares song_length >= target - delta/2 AND <= target + delta/2
+        low = target_seconds - (target_delta / 2)
+        high = target_seconds + (target_delta / 2)
+        return int(-(-low // 1)), int(high // 1)
+
+    def get_random_song_id(
+        self, target_seconds=None, target_delta=None, ignore_requests=False
+    ):
+        idx = None
+        if ignore_requests:
+            if len(self.available):
+                idx = self.available.pick()
+        elif target_seconds:
+            low, high = self._length_window(target_seconds, target_delta)
+            idx = self.eligible_by_length.pick(low, high)
+        elif len(self.eligible):
+            idx = self.eligible.pick()
+        if idx is None:
+            return None
+        return self.song_ids[idx]
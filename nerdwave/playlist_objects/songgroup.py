@@ -4,6 +4,7 @@ from libs import db
 from libs import log
 from libs import config
 
+from nerdwave.playlist_objects import song_pool
 from nerdwave.playlist_objects.metadata import AssociatedMetadata
 from nerdwave.playlist_objects.metadata import make_searchable_string
 
@@ -12,6 +13,7 @@ class SongGroup(AssociatedMetadata):
     select_by_name_query = "SELECT group_id AS id, group_name AS name, group_elec_block AS elec_block, group_cool_time AS cool_time FROM r4_groups WHERE lower(group_name) = lower(%s)"
     select_by_id_query = "SELECT group_id AS id, group_name AS name, group_elec_block AS elec_block, group_cool_time AS cool_time FROM r4_groups WHERE group_id = %s"
     select_by_song_id_query = "SELECT r4_groups.group_id AS id, r4_groups.group_name AS name, group_elec_block AS elec_block, group_cool_time AS cool_time, group_is_tag AS is_tag FROM r4_song_group JOIN r4_groups USING (group_id) WHERE song_id = %s ORDER BY group_name"
+    select_by_song_ids_query = "SELECT song_id, r4_groups.group_id AS id, r4_groups.group_name AS name, group_elec_block AS elec_block, group_cool_time AS cool_time, group_is_tag AS is_tag FROM r4_song_group JOIN r4_groups USING (group_id) WHERE song_id = ANY(%s) ORDER BY group_name"
     disassociate_song_id_query = (
         "DELETE FROM r4_song_group WHERE song_id = %s AND group_id = %s"
     )
@@ -50,6 +52,31 @@ class SongGroup(AssociatedMetadata):
             instances.append(instance)
         return instances
 
+    @classmethod
+    def load_rows_from_song_ids(cls, song_ids, sid=None, all_categories=False):
+        if not sid:
+            return super(SongGroup, cls).load_rows_from_song_ids(song_ids)
+
+        show_all_condition = (
+            "" if all_categories else "AND r4_group_sid.group_display = TRUE"
+        )
+
+        rows = {song_id: [] for song_id in song_ids}
+        for row in db.c.fetch_all(
+            "SELECT r4_song_sid.song_id, r4_groups.group_id AS id, r4_groups.group_name AS name, group_elec_block AS elec_block, group_cool_time AS cool_time, group_is_tag AS is_tag "
+            "FROM r4_song_sid "
+            "JOIN r4_song_group USING (song_id) "
+            "JOIN r4_group_sid ON (r4_song_group.group_id = r4_group_sid.group_id AND r4_group_sid.sid = %s "
+            + show_all_condition
+            + ") "
+            "JOIN r4_groups ON (r4_group_sid.group_id = r4_groups.group_id) "
+            "WHERE r4_song_sid.song_id = ANY(%s) AND r4_song_sid.sid = %s AND song_exists = TRUE "
+            "ORDER BY r4_groups.group_name",
+            (sid, list(song_ids), sid),
+        ):
+            rows[row["song_id"]].append(row)
+        return rows
+
     def associate_song_id(self, song_id, is_tag=None):
         super(SongGroup, self).associate_song_id(song_id, is_tag)
         self.reconcile_sids()
@@ -113,32 +140,44 @@ class SongGroup(AssociatedMetadata):
             % (self.id, sid, cool_time),
         )
         # Make sure to update both the if and else SQL statements if doing any updates
-        db.c.update(
-            "UPDATE r4_song_sid SET song_cool = TRUE, song_cool_end = %s "
-            "FROM r4_song_group "
-            "WHERE r4_song_sid.song_id = r4_song_group.song_id AND r4_song_group.group_id = %s "
-            "AND r4_song_sid.sid = %s AND r4_song_sid.song_exists = TRUE AND r4_song_sid.song_cool_end <= %s ",
-            (cool_end, self.id, sid, cool_end),
+        song_pool.mark_cool(
+            sid,
+            db.c.fetch_all(
+                "UPDATE r4_song_sid SET song_cool = TRUE, song_cool_end = %s "
+                "FROM r4_song_group "
+                "WHERE r4_song_sid.song_id = r4_song_group.song_id AND r4_song_group.group_id = %s "
+                "AND r4_song_sid.sid = %s AND r4_song_sid.song_exists = TRUE AND r4_song_sid.song_cool_end <= %s "
+                "RETURNING r4_song_sid.song_id, song_cool_end",
+                (cool_end, self.id, sid, cool_end),
+            ),
         )
         request_only_end = cool_end + 300
-        db.c.update(
-            "UPDATE r4_song_sid SET song_request_only = TRUE, song_request_only_end = %s "
-            "FROM r4_song_group "
-            "WHERE r4_song_sid.song_id = r4_song_group.song_id AND r4_song_group.group_id = %s "
-            "AND r4_song_sid.sid = %s AND r4_song_sid.song_exists = TRUE AND r4_song_sid.song_cool_end <= %s "
-            "AND song_request_only_end IS NOT NULL",
-            (request_only_end, self.id, sid, cool_end),
+        song_pool.mark_request_only(
+            sid,
+            db.c.fetch_all(
+                "UPDATE r4_song_sid SET song_request_only = TRUE, song_request_only_end = %s "
+                "FROM r4_song_group "
+                "WHERE r4_song_sid.song_id = r4_song_group.song_id AND r4_song_group.group_id = %s "
+                "AND r4_song_sid.sid = %s AND r4_song_sid.song_exists = TRUE AND r4_song_sid.song_cool_end <= %s "
+                "AND song_request_only_end IS NOT NULL "
+                "RETURNING r4_song_sid.song_id, song_request_only_end",
+                (request_only_end, self.id, sid, cool_end),
+            ),
         )
 
     def _start_election_block_db(self, sid, num_elections):
         # refer to song.set_election_block for base SQL
-        db.c.update(
-            "UPDATE r4_song_sid "
-            "SET song_elec_blocked = TRUE, song_elec_blocked_by = %s, song_elec_blocked_num = %s "
-            "FROM r4_song_group "
-            "WHERE r4_song_sid.song_id = r4_song_group.song_id AND "
-            "r4_song_group.group_id = %s AND r4_song_sid.sid = %s AND song_elec_blocked_num < %s",
-            ("group", num_elections, self.id, sid, num_elections),
+        song_pool.mark_elec_blocked(
+            sid,
+            db.c.fetch_all(
+                "UPDATE r4_song_sid "
+                "SET song_elec_blocked = TRUE, song_elec_blocked_by = %s, song_elec_blocked_num = %s "
+                "FROM r4_song_group "
+                "WHERE r4_song_sid.song_id = r4_song_group.song_id AND "
+                "r4_song_group.group_id = %s AND r4_song_sid.sid = %s AND song_elec_blocked_num < %s "
+                "RETURNING r4_song_sid.song_id, song_elec_blocked_num",
+                ("group", num_elections, self.id, sid, num_elections),
+            ),
         )
 
     def set_elec_block(self, num_elections):
@@ -4,6 +4,8 @@ from libs import db
 from libs import log
 from libs import cache
 from libs import config
+from nerdwave import listener_stats
+from nerdwave import song_ranks
 
 
 def rating_calculator(ratings):
@@ -36,10 +38,34 @@ def get_song_rating(song_id, user_id):
         )
         if not rating:
             rating = {"rating_user": 0, "fave": None}
-    cache.set_song_rating(song_id, user_id, rating)
+        cache.set_song_rating(song_id, user_id, rating)
     return rating
 
 
+def get_song_ratings(song_ids, user_id):
+    """
+    Bulk version of get_song_rating.  Returns a dict of song_id: rating.
+    Only songs missing from the cache are looked up in the database and written back.
+    """
+    ratings = cache.get_song_ratings(song_ids, user_id)
+    missing = [song_id for song_id in set(song_ids) if not ratings.get(song_id)]
+    if missing:
+        fetched = {
+            song_id: {"rating_user": 0, "fave": None} for song_id in missing
+        }
+        for row in db.c.fetch_all(
+            "SELECT song_id, song_rating_user AS rating_user, song_fave AS fave FROM r4_song_ratings WHERE user_id = %s AND song_id = ANY(%s)",
+            (user_id, missing),
+        ):
+            fetched[row["song_id"]] = {
+                "rating_user": row["rating_user"],
+                "fave": row["fave"],
+            }
+        cache.set_song_ratings(fetched, user_id)
+        ratings.update(fetched)
+    return ratings
+
+
 def get_album_rating(sid, album_id, user_id):
     rating = cache.get_album_rating(sid, album_id, user_id)
     if not rating:
@@ -58,10 +84,99 @@ def get_album_rating(sid, album_id, user_id):
             )
             or False
         )
-    cache.set_album_rating(sid, album_id, user_id, rating)
+        cache.set_album_rating(sid, album_id, user_id, rating)
     return rating
 
 
+def get_album_ratings(sid, album_ids, user_id):
+    """
+    Bulk version of get_album_rating.  Returns a dict of album_id: rating.
+    Only albums missing from the cache are looked up in the database and written back.
+    """
+    ratings = cache.get_album_ratings(sid, album_ids, user_id)
+    missing = [album_id for album_id in set(album_ids) if not ratings.get(album_id)]
+    if missing:
+        fetched = {}
+        for row in db.c.fetch_all(
+            "SELECT album_ids.album_id, r4_album_ratings.album_id IS NOT NULL AS has_rating, "
+            "album_rating_user AS rating_user, album_rating_complete AS rating_complete, album_fave AS fave "
+            "FROM UNNEST(%s) AS album_ids (album_id) "
+            "LEFT JOIN r4_album_ratings ON (r4_album_ratings.album_id = album_ids.album_id AND r4_album_ratings.user_id = %s AND r4_album_ratings.sid = %s) "
+            "LEFT JOIN r4_album_faves ON (r4_album_faves.album_id = album_ids.album_id AND r4_album_faves.user_id = %s)",
+            (missing, user_id, sid, user_id),
+        ):
+            if row["has_rating"]:
+                rating = {
+                    "rating_user": row["rating_user"],
+                    "rating_complete": row["rating_complete"],
+                }
+            else:
+                rating = {"rating_user": 0, "rating_complete": False}
+            rating["fave"] = row["fave"] or False
+            fetched[row["album_id"]] = rating
+        cache.set_album_ratings(sid, fetched, user_id)
+        ratings.update(fetched)
+    return ratings
+
+
+def get_album_overlay(sid, user_id):
+    """
+    A user's album ratings and faves as album_id: {rating_user, fave, rating_complete},
+    only for albums they've rated or faved, to lay over the station's shared all_albums.
+    Cached per user until they rate or fave something or the catalog changes.
+    """
+    key = "album_overlay_%s" % sid
+    catalog_version = cache.get("catalog_version")
+    cached = cache.get_user(user_id, key)
+    if cached and cached[0] == catalog_version:
+        return cached[1]
+
+    overlay = {}
+    for row in db.c.fetch_all(
+        "SELECT album_id, album_rating_user, album_rating_complete "
+        "FROM r4_album_ratings "
+        "WHERE user_id = %s AND sid = %s AND (album_rating_user IS NOT NULL OR album_rating_complete = TRUE)",
+        (user_id, sid),
+    ):
+        overlay[row["album_id"]] = {
+            "rating_user": row["album_rating_user"] or 0,
+            "fave": False,
+            "rating_complete": row["album_rating_complete"] or False,
+        }
+    for album_id in db.c.fetch_list(
+        "SELECT album_id FROM r4_album_faves WHERE user_id = %s AND album_fave = TRUE",
+        (user_id,),
+    ):
+        if album_id in overlay:
+            overlay[album_id]["fave"] = True
+        else:
+            overlay[album_id] = {"rating_user": 0, "fave": True, "rating_complete": False}
+    cache.set_user(user_id, key, (catalog_version, overlay))
+    return overlay
+
+
+def clear_album_overlays(user_id):
+    # faves apply to every station, and song ratings update albums on every station
+    for sid in config.station_ids:
+        cache.set_user(user_id, "album_overlay_%s" % sid, None)
+
+
+def get_ratings_for_songs(songs, user_id):
+    """
+    Resolves the user's ratings for a list of Song objects and their albums in bulk.
+    Returns (song_ratings, album_ratings) suitable for Song.to_dict.
+    """
+    song_ratings = get_song_ratings([song.id for song in songs], user_id)
+    album_ids_by_sid = {}
+    for song in songs:
+        if song.album:
+            album_ids_by_sid.setdefault(song.album.sid, []).append(song.album.id)
+    album_ratings = {}
+    for sid, album_ids in album_ids_by_sid.items():
+        album_ratings.update(get_album_ratings(sid, album_ids, user_id))
+    return song_ratings, album_ratings
+
+
 CLEAR_RATING_FLAG = "__clear_rating__"
 
 
@@ -113,6 +228,9 @@ def set_song_rating(sid, song_id, user_id, rating=None, fave=None):
         albums = update_album_ratings(sid, song_id, user_id)
         db.c.commit()
         cache.set_song_rating(song_id, user_id, {"rating_user": rating, "fave": fave})
+        clear_album_overlays(user_id)
+        listener_stats.clear(user_id)
+        song_ranks.clear_histogram(song_id)
         return albums
     except:
         db.c.rollback()
@@ -124,93 +242,94 @@ def clear_song_rating(sid, song_id, user_id):
 
 
 def set_song_fave(song_id, user_id, fave):
-    db.c.start_transaction()
-    exists = db.c.fetch_row(
-        "SELECT * FROM r4_song_ratings WHERE song_id = %s AND user_id = %s",
-        (song_id, user_id),
-    )
-    rating = None
-    if exists:
-        rating = exists["song_rating_user"]
-        if (
-            db.c.update(
-                "UPDATE r4_song_ratings SET song_fave = %s WHERE song_id = %s AND user_id = %s",
-                (fave, song_id, user_id),
-            )
-            == 0
-        ):
-            log.debug(
-                "rating",
-                "Failed to update record for fave song %s, fave is: %s."
-                % (song_id, fave),
-            )
-            return False
-    elif not exists and fave:
-        if (
-            db.c.update(
-                "INSERT INTO r4_song_ratings (song_id, user_id, song_fave) VALUES (%s, %s, %s)",
-                (song_id, user_id, fave),
-            )
-            == 0
-        ):
-            log.debug(
-                "rating",
-                "Failed to insert record for song fave %s, fave is: %s."
-                % (song_id, fave),
-            )
-            return False
-    else:
-        # Nothing to do!
-        return True
+    with db.c.transaction():
+        exists = db.c.fetch_row(
+            "SELECT * FROM r4_song_ratings WHERE song_id = %s AND user_id = %s",
+            (song_id, user_id),
+        )
+        rating = None
+        if exists:
+            rating = exists["song_rating_user"]
+            if (
+                db.c.update(
+                    "UPDATE r4_song_ratings SET song_fave = %s WHERE song_id = %s AND user_id = %s",
+                    (fave, song_id, user_id),
+                )
+                == 0
+            ):
+                log.debug(
+                    "rating",
+                    "Failed to update record for fave song %s, fave is: %s."
+                    % (song_id, fave),
+                )
+                return False
+        elif not exists and fave:
+            if (
+                db.c.update(
+                    "INSERT INTO r4_song_ratings (song_id, user_id, song_fave) VALUES (%s, %s, %s)",
+                    (song_id, user_id, fave),
+                )
+                == 0
+            ):
+                log.debug(
+                    "rating",
+                    "Failed to insert record for song fave %s, fave is: %s."
+                    % (song_id, fave),
+                )
+                return False
+        else:
+            # Nothing to do!
+            return True
 
-    cache.set_song_rating(song_id, user_id, {"rating_user": rating, "fave": fave})
-    db.c.commit()
+        cache.set_song_rating(
+            song_id, user_id, {"rating_user": rating, "fave": fave}
+        )
     return True
 
 
 def set_album_fave(sid, album_id, user_id, fave):
-    db.c.start_transaction()
-    exists = db.c.fetch_row(
-        "SELECT * FROM r4_album_faves WHERE album_id = %s AND user_id = %s",
-        (album_id, user_id),
-    )
-    rating = None
-    rating_complete = False
-    if not exists:
-        if (
-            db.c.update(
-                "INSERT INTO r4_album_faves (album_id, user_id, album_fave) VALUES (%s, %s, %s)",
-                (album_id, user_id, fave),
-            )
-            == 0
-        ):
-            log.debug(
-                "rating",
-                "Failed to insert record for fave %s %s, fave is: %s."
-                % ("album", album_id, fave),
-            )
-            return False
-    else:
-        if (
-            db.c.update(
-                "UPDATE r4_album_faves SET album_fave = %s WHERE album_id = %s AND user_id = %s",
-                (fave, album_id, user_id),
-            )
-            == 0
-        ):
-            log.debug(
-                "rating",
-                "Failed to update record for fave %s %s, fave is: %s."
-                % ("album", album_id, fave),
-            )
-            return False
-    cache.set_album_rating(
-        sid,
-        album_id,
-        user_id,
-        {"rating_user": rating, "fave": fave, "rating_complete": rating_complete},
-    )
-    db.c.commit()
+    with db.c.transaction():
+        exists = db.c.fetch_row(
+            "SELECT * FROM r4_album_faves WHERE album_id = %s AND user_id = %s",
+            (album_id, user_id),
+        )
+        rating = None
+        rating_complete = False
+        if not exists:
+            if (
+                db.c.update(
+                    "INSERT INTO r4_album_faves (album_id, user_id, album_fave) VALUES (%s, %s, %s)",
+                    (album_id, user_id, fave),
+                )
+                == 0
+            ):
+                log.debug(
+                    "rating",
+                    "Failed to insert record for fave %s %s, fave is: %s."
+                    % ("album", album_id, fave),
+                )
+                return False
+        else:
+            if (
+                db.c.update(
+                    "UPDATE r4_album_faves SET album_fave = %s WHERE album_id = %s AND user_id = %s",
+                    (fave, album_id, user_id),
+                )
+                == 0
+            ):
+                log.debug(
+                    "rating",
+                    "Failed to update record for fave %s %s, fave is: %s."
+                    % ("album", album_id, fave),
+                )
+                return False
+        cache.set_album_rating(
+            sid,
+            album_id,
+            user_id,
+            {"rating_user": rating, "fave": fave, "rating_complete": rating_complete},
+        )
+    clear_album_overlays(user_id)
     return True
 
 
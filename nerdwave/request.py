@@ -1,16 +1,39 @@
 from time import time as timestamp
+import psycopg2.extras
 from libs import db
 from libs import cache
 from libs import log
+from nerdwave import listener_stats
 from nerdwave import playlist
+from nerdwave.playlist_objects import song_pool
 from nerdwave.user import User
 
 LINE_SQL = "SELECT COALESCE(radio_username, username) AS username, user_id, line_expiry_tune_in, line_expiry_election, line_wait_start, line_has_had_valid FROM r4_request_line JOIN phpbb_users USING (user_id) WHERE r4_request_line.sid = %s AND radio_requests_paused = FALSE ORDER BY line_wait_start"
 
 
+# Same as LINE_SQL, but also fetches whether each user is tuned in and their top valid request
+# (see User.get_top_request_song_id) so the whole line can be evaluated without any per-user queries.
+LINE_EVALUATION_SQL = (
+    "SELECT COALESCE(radio_username, username) AS username, r4_request_line.user_id, line_expiry_tune_in, line_expiry_election, line_wait_start, line_has_had_valid, "
+    "EXISTS (SELECT 1 FROM r4_listeners WHERE r4_listeners.user_id = r4_request_line.user_id AND r4_listeners.sid = %s AND listener_purge = FALSE) AS _tuned_in, "
+    "top_request.song_id AS _song_id, top_request.album_id AS _album_id, top_request.song_title AS _song_title, top_request.album_name AS _album_name, top_request.has_album AS _has_album "
+    "FROM r4_request_line JOIN phpbb_users USING (user_id) "
+    "LEFT JOIN LATERAL ("
+    "SELECT r4_request_store.song_id, r4_songs.album_id, song_title, album_name, r4_albums.album_id IS NOT NULL AS has_album "
+    "FROM r4_request_store "
+    "JOIN r4_song_sid USING (song_id) "
+    "JOIN r4_songs USING (song_id) "
+    "LEFT JOIN r4_albums ON (r4_albums.album_id = r4_songs.album_id) "
+    "WHERE r4_request_store.user_id = r4_request_line.user_id AND r4_song_sid.sid = %s AND song_exists = TRUE AND song_cool = FALSE AND song_elec_blocked = FALSE "
+    "ORDER BY reqstor_order, reqstor_id LIMIT 1"
+    ") AS top_request ON TRUE "
+    "WHERE r4_request_line.sid = %s AND radio_requests_paused = FALSE ORDER BY line_wait_start"
+)
+
+
 def update_line(sid):
     # Get everyone in the line
-    line = db.c.fetch_all(LINE_SQL, (sid,))
+    line = db.c.fetch_all(LINE_EVALUATION_SQL, (sid, sid, sid))
     _process_line(line, sid)
 
 
@@ -24,124 +47,137 @@ def _process_line(line, sid):
     position = 1
     user_viewable_position = 1
     valid_positions = 0
+    # Changes to r4_request_line are gathered up and written once at the end
+    # user_id: [line_has_had_valid, line_expiry_election, line_expiry_tune_in], None leaves the column alone
+    line_updates = {}
+    removed_user_ids = []
+    requeue_user_ids = []
     # For each person
     for row in line:
         add_to_line = False
-        u = User(row["user_id"])
+        user_id = row["user_id"]
+        tuned_in = row.pop("_tuned_in")
+        song_id = row.pop("_song_id")
+        album_id = row.pop("_album_id")
+        song_title = row.pop("_song_title")
+        album_name = row.pop("_album_name")
+        has_album = row.pop("_has_album")
         row["song_id"] = None
         # If their time is up, remove them and don't add them to the new line
         if row["line_expiry_tune_in"] and row["line_expiry_tune_in"] <= t:
             log.debug(
                 "request_line",
                 "%s: Removed user ID %s from line for tune in timeout, expiry time %s current time %s"
-                % (sid, u.id, row["line_expiry_tune_in"], t),
+                % (sid, user_id, row["line_expiry_tune_in"], t),
             )
-            u.remove_from_request_line()
-        else:
-            tuned_in_sid = db.c.fetch_var(
-                "SELECT sid FROM r4_listeners WHERE user_id = %s AND sid = %s AND listener_purge = FALSE",
-                (u.id, sid),
-            )
-            tuned_in = True if tuned_in_sid == sid else False
-            if tuned_in:
-                # Get their top song ID
-                song_id = u.get_top_request_song_id(sid)
-                if song_id and not row["line_has_had_valid"]:
-                    row["line_has_had_valid"] = True
-                    db.c.update(
-                        "UPDATE r4_request_line SET line_has_had_valid = TRUE WHERE user_id = %s",
-                        (u.id,),
-                    )
-                if row["line_has_had_valid"]:
-                    valid_positions += 1
-                # If they have no song and their line expiry has arrived, boot 'em
-                if (
-                    not song_id
-                    and row["line_expiry_election"]
-                    and (row["line_expiry_election"] <= t)
-                ):
-                    log.debug(
-                        "request_line",
-                        "%s: Removed user ID %s from line for election timeout, expiry time %s current time %s"
-                        % (sid, u.id, row["line_expiry_election"], t),
-                    )
-                    u.remove_from_request_line()
-                    # Give them more chances if they still have requests
-                    # They'll get added to the line of whatever station they're tuned in to (if any!)
-                    if u.has_requests():
-                        u.put_in_request_line(u.get_tuned_in_sid())
-                # If they have no song and they're in 2nd or 1st, start the expiry countdown
-                elif not song_id and not row["line_expiry_election"] and position <= 2:
-                    log.debug(
-                        "request_line",
-                        "%s: User ID %s has no valid requests, beginning boot countdown."
-                        % (sid, u.id),
-                    )
-                    row["line_expiry_election"] = t + 900
-                    db.c.update(
-                        "UPDATE r4_request_line SET line_expiry_election = %s WHERE user_id = %s",
-                        ((t + 900), row["user_id"]),
-                    )
-                    add_to_line = True
-                # Keep 'em in line
-                else:
-                    log.debug(
-                        "request_line", "%s: User ID %s is in line." % (sid, u.id)
-                    )
-                    if song_id:
-                        albums_with_requests.append(
-                            db.c.fetch_var(
-                                "SELECT album_id FROM r4_songs WHERE song_id = %s",
-                                (song_id,),
-                            )
-                        )
-                        row["song"] = db.c.fetch_row(
-                            "SELECT song_id AS id, song_title AS title, album_name FROM r4_songs JOIN r4_albums USING (album_id) WHERE song_id = %s",
-                            (song_id,),
-                        )
-                    else:
-                        row["song"] = None
-                    row["song_id"] = song_id
-                    add_to_line = True
-            elif not row["line_expiry_tune_in"] or row["line_expiry_tune_in"] == 0:
+            removed_user_ids.append(user_id)
+        elif tuned_in:
+            if song_id and not row["line_has_had_valid"]:
+                row["line_has_had_valid"] = True
+                line_updates.setdefault(user_id, [None, None, None])[0] = True
+            if row["line_has_had_valid"]:
+                valid_positions += 1
+            # If they have no song and their line expiry has arrived, boot 'em
+            if (
+                not song_id
+                and row["line_expiry_election"]
+                and (row["line_expiry_election"] <= t)
+            ):
                 log.debug(
                     "request_line",
-                    "%s: User ID %s being marked as tuned out." % (sid, u.id),
+                    "%s: Removed user ID %s from line for election timeout, expiry time %s current time %s"
+                    % (sid, user_id, row["line_expiry_election"], t),
                 )
-                db.c.update(
-                    "UPDATE r4_request_line SET line_expiry_tune_in = %s WHERE user_id = %s",
-                    ((t + 600), row["user_id"]),
+                removed_user_ids.append(user_id)
+                # Give them more chances if they still have requests
+                requeue_user_ids.append(user_id)
+            # If they have no song and they're in 2nd or 1st, start the expiry countdown
+            elif not song_id and not row["line_expiry_election"] and position <= 2:
+                log.debug(
+                    "request_line",
+                    "%s: User ID %s has no valid requests, beginning boot countdown."
+                    % (sid, user_id),
                 )
+                row["line_expiry_election"] = t + 900
+                line_updates.setdefault(user_id, [None, None, None])[1] = t + 900
                 add_to_line = True
+            # Keep 'em in line
             else:
                 log.debug(
-                    "request_line",
-                    "%s: User ID %s not tuned in, waiting on expiry for action."
-                    % (sid, u.id),
+                    "request_line", "%s: User ID %s is in line." % (sid, user_id)
                 )
+                if song_id:
+                    albums_with_requests.append(album_id)
+                    if has_album:
+                        row["song"] = {
+                            "id": song_id,
+                            "title": song_title,
+                            "album_name": album_name,
+                        }
+                    else:
+                        row["song"] = None
+                else:
+                    row["song"] = None
+                row["song_id"] = song_id
                 add_to_line = True
+        elif not row["line_expiry_tune_in"] or row["line_expiry_tune_in"] == 0:
+            log.debug(
+                "request_line",
+                "%s: User ID %s being marked as tuned out." % (sid, user_id),
+            )
+            line_updates.setdefault(user_id, [None, None, None])[2] = t + 600
+            add_to_line = True
+        else:
+            log.debug(
+                "request_line",
+                "%s: User ID %s not tuned in, waiting on expiry for action."
+                % (sid, user_id),
+            )
+            add_to_line = True
         row["skip"] = not add_to_line
         row["position"] = user_viewable_position
         new_line.append(row)
-        user_positions[u.id] = user_viewable_position
+        user_positions[user_id] = user_viewable_position
         user_viewable_position = user_viewable_position + 1
         if add_to_line:
             position = position + 1
 
+    if line_updates:
+        psycopg2.extras.execute_values(
+            db.c,
+            "UPDATE r4_request_line SET "
+            "line_has_had_valid = COALESCE(v.has_had_valid, r4_request_line.line_has_had_valid), "
+            "line_expiry_election = COALESCE(v.expiry_election, r4_request_line.line_expiry_election), "
+            "line_expiry_tune_in = COALESCE(v.expiry_tune_in, r4_request_line.line_expiry_tune_in) "
+            "FROM (VALUES %s) AS v (user_id, has_had_valid, expiry_election, expiry_tune_in) "
+            "WHERE r4_request_line.user_id = v.user_id",
+            [(user_id,) + tuple(values) for user_id, values in line_updates.items()],
+            template="(%s, %s::BOOLEAN, %s::INTEGER, %s::INTEGER)",
+        )
+    if removed_user_ids:
+        db.c.update(
+            "DELETE FROM r4_request_line WHERE user_id = ANY(%s)", (removed_user_ids,)
+        )
+    # They'll get added to the line of whatever station they're tuned in to (if any!)
+    for user_id in requeue_user_ids:
+        u = User(user_id)
+        if u.has_requests():
+            u.put_in_request_line(u.get_tuned_in_sid())
+
     log.debug("request_line", "Request line valid positions: %s" % valid_positions)
     cache.set_station(sid, "request_valid_positions", valid_positions)
     cache.set_station(sid, "request_line", new_line, True)
     cache.set_station(sid, "request_user_positions", user_positions, True)
 
+    albums_with_requests = [
+        album_id for album_id in albums_with_requests if album_id is not None
+    ]
     db.c.update(
-        "UPDATE r4_album_sid SET album_requests_pending = NULL WHERE album_requests_pending = TRUE AND sid = %s",
-        (sid,),
+        "UPDATE r4_album_sid SET album_requests_pending = CASE WHEN album_id = ANY(%s) THEN TRUE ELSE NULL END "
+        "WHERE sid = %s AND (album_requests_pending = TRUE OR album_id = ANY(%s))",
+        (albums_with_requests, sid, albums_with_requests),
     )
-    for album_id in albums_with_requests:
-        db.c.update(
-            "UPDATE r4_album_sid SET album_requests_pending = TRUE WHERE album_id = %s AND sid = %s",
-            (album_id, sid),
-        )
+    song_pool.set_albums_with_requests(sid, albums_with_requests)
 
     return new_line
 
@@ -223,6 +259,7 @@ def mark_request_filled(sid, user, song, entry, line):
         "UPDATE phpbb_users SET radio_totalrequests = %s WHERE user_id = %s",
         (request_count, user.id),
     )
+    listener_stats.clear_after_commit(user.id)
     song.update_request_count(sid)
 
 
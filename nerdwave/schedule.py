@@ -7,7 +7,12 @@ import tornado.ioloop
 from backend import sync_to_front
 from nerdwave import events
 from nerdwave import playlist
+from nerdwave import catalog
+from nerdwave import leaderboards
+from nerdwave import listener_stats
 import nerdwave.playlist_objects.album
+from nerdwave.playlist_objects import object_cache
+from nerdwave.playlist_objects import song_pool
 from nerdwave import listeners
 from nerdwave import request
 from nerdwave import user
@@ -17,6 +22,7 @@ from libs import cache
 from libs import log
 
 from nerdwave.events import election
+from nerdwave.events.snapshot import ScheduleSnapshot
 
 # This is to make sure the code gets loaded and producers get registered
 import nerdwave.events.oneup
@@ -152,11 +158,110 @@ def set_upnext_crossfade(sid, crossfade):
         upnext[sid][0].use_crossfade = crossfade
 
 
+class AdvanceTimings:
+    """
+    Collects per-phase durations of post_process.  The result is published to
+    the station cache as "advance_timings" so it can be graphed or alerted on,
+    rather than only showing up as debug log lines.
+    """
+
+    def __init__(self, sid):
+        self.sid = sid
+        self.started = timestamp()
+        self.last = self.started
+        self.phases = {}
+
+    def mark(self, phase):
+        now = timestamp()
+        self.phases[phase] = round(now - self.last, 6)
+        self.last = now
+
+    def to_dict(self):
+        return {
+            "sid": self.sid,
+            "time": int(self.started),
+            "total": round(self.last - self.started, 6),
+            "phases": self.phases,
+        }
+
+    def publish(self):
+        metrics = self.to_dict()
+        cache.set_station(self.sid, "advance_timings", metrics, True)
+        log.debug(
+            "advance_timings",
+            "SID %s total %.6f %s"
+            % (
+                self.sid,
+                metrics["total"],
+                " ".join(
+                    "%s=%.6f" % (phase, duration)
+                    for phase, duration in self.phases.items()
+                ),
+            ),
+        )
+
+
+def _batched_maintenance(sid):
+    # Does the same work as warm_cooled_songs, warm_cooled_albums, _trim, trim_listeners,
+    # unlock_listeners, the voted entry reset, and reduce_song_blocks, in one round trip.
+    # Statements are executed in order, so each one sees the changes of the ones before it.
+    # If you change any of those functions, change this as well.
+    now = int(timestamp())
+    params = {
+        "sid": sid,
+        "now": now,
+        "event_age": now - config.get("trim_event_age"),
+        "election_age": now - config.get("trim_election_age"),
+        "history_length": config.get("trim_history_length"),
+    }
+    statements = [
+        # warm_cooled_songs
+        "UPDATE r4_song_sid SET "
+        "song_cool = CASE WHEN song_cool = TRUE AND song_cool_end < %(now)s THEN FALSE ELSE song_cool END, "
+        "song_request_only = CASE WHEN song_request_only = TRUE AND song_request_only_end IS NOT NULL AND song_request_only_end < %(now)s THEN FALSE ELSE song_request_only END "
+        "WHERE sid = %(sid)s AND ("
+        "(song_cool = TRUE AND song_cool_end < %(now)s) "
+        "OR (song_request_only = TRUE AND song_request_only_end IS NOT NULL AND song_request_only_end < %(now)s)"
+        ")",
+        # _trim
+        "DELETE FROM r4_schedule WHERE sched_start_actual <= %(event_age)s AND sched_type != 'OneUpProducer'",
+        "DELETE FROM r4_elections WHERE elec_start_actual <= %(election_age)s",
+        "DELETE FROM r4_song_history WHERE songhist_id <= (SELECT MAX(songhist_id) FROM r4_song_history) - %(history_length)s AND sid = %(sid)s",
+        # user.trim_listeners
+        "DELETE FROM r4_listeners WHERE sid = %(sid)s AND listener_purge = TRUE",
+        # user.unlock_listeners
+        "UPDATE r4_listeners SET "
+        "listener_lock_counter = listener_lock_counter - (CASE WHEN listener_lock = TRUE AND listener_lock_sid = %(sid)s THEN 1 ELSE 0 END), "
+        "listener_lock = (listener_lock_counter - (CASE WHEN listener_lock = TRUE AND listener_lock_sid = %(sid)s THEN 1 ELSE 0 END)) > 0 "
+        "WHERE (listener_lock = TRUE AND listener_lock_sid = %(sid)s) OR listener_lock_counter <= 0",
+        "UPDATE r4_listeners SET listener_voted_entry = NULL WHERE sid = %(sid)s",
+        # playlist.reduce_song_blocks
+        "UPDATE r4_song_sid SET "
+        "song_elec_blocked_num = GREATEST(song_elec_blocked_num - 1, 0), "
+        "song_elec_blocked = (song_elec_blocked_num - 1) > 0 "
+        "WHERE song_elec_blocked = TRUE AND sid = %(sid)s",
+    ]
+    if sid == 0:
+        db.c.update("; ".join(statements), params)
+    else:
+        # warm_cooled_albums - has to be last as only the final statement's rows come back
+        statements.append(
+            "UPDATE r4_album_sid SET album_cool = FALSE "
+            "WHERE sid = %(sid)s AND album_cool_lowest <= %(now)s AND album_cool = TRUE "
+            "RETURNING album_id"
+        )
+        for album_id in db.c.fetch_list("; ".join(statements), params):
+            nerdwave.playlist_objects.album.updated_album_ids[sid][album_id] = True
+    song_pool.warm(sid, now)
+    song_pool.reduce_blocks(sid)
+
+
 def advance_station(sid):
     db.c.start_transaction()
     try:
         log.debug("advance", "Advancing station %s." % sid)
         start_time = timestamp()
+        object_cache.check_catalog_version()
         # If we need some emergency elections here
         if len(upnext[sid]) == 0:
             manage_next(sid)
@@ -186,18 +291,22 @@ def advance_station(sid):
         )
     except:
         db.c.rollback()
+        song_pool.reset(sid)
         raise
 
 
 def post_process(sid):
+    timings = AdvanceTimings(sid)
+    committed = False
+    previous = None
     try:
-        db.c.start_transaction()
-        start_time = timestamp()
         playlist.prepare_cooldown_algorithm(sid)
         nerdwave.playlist_objects.album.clear_updated_albums(sid)
-        log.debug("post", "Playlist prepare time: %.6f" % (timestamp() - start_time,))
+        timings.mark("playlist_prepare")
 
-        start_time = timestamp()
+        # a rollback undoes the whole advance, so the in-memory schedule has to go back with it
+        previous = (current[sid], list(upnext[sid]), list(history[sid]))
+        db.c.start_transaction()
         current[sid].finish()
         for sched_id in db.c.fetch_list(
             "SELECT sched_id FROM r4_schedule WHERE sched_end < %s AND sched_used = FALSE",
@@ -206,9 +315,8 @@ def post_process(sid):
             t_evt = BaseProducer.load_producer_by_id(sched_id)
             if t_evt:
                 t_evt.finish()
-        log.debug("post", "Current finish time: %.6f" % (timestamp() - start_time,))
+        timings.mark("current_finish")
 
-        start_time = timestamp()
         last_song = current[sid].get_song()
         if last_song:
             db.c.update(
@@ -216,60 +324,74 @@ def post_process(sid):
                 (sid, last_song.id),
             )
             last_song.update_fave_count(sid, update_albums=True)
-        log.debug("post", "Last song insertion time: %s" % (timestamp() - start_time,))
+        timings.mark("last_song_insert")
 
-        start_time = timestamp()
         history[sid].insert(0, current[sid])
         while len(history[sid]) > 5:
             history[sid].pop()
-        log.debug("post", "History management: %.6f" % (timestamp() - start_time,))
+        timings.mark("history")
 
-        start_time = timestamp()
         current[sid] = upnext[sid].pop(0)
         current[sid].start_event()
-        log.debug("advance", "Current management: %.6f" % (timestamp() - start_time,))
+        timings.mark("current_start")
 
-        start_time = timestamp()
-        playlist.warm_cooled_songs(sid)
-        playlist.warm_cooled_albums(sid)
-        log.debug("advance", "Cooldown warming: %.6f" % (timestamp() - start_time,))
+        if config.has("advance_batched") and config.get("advance_batched"):
+            _batched_maintenance(sid)
+            cache.update_user_rating_acl(sid, history[sid][0].get_song().id)
+            timings.mark("batched_maintenance")
+        else:
+            playlist.warm_cooled_songs(sid)
+            playlist.warm_cooled_albums(sid)
+            timings.mark("cooldown_warming")
+
+            _trim(sid)
+            user.trim_listeners(sid)
+            cache.update_user_rating_acl(sid, history[sid][0].get_song().id)
+            user.unlock_listeners(sid)
+            db.c.update(
+                "UPDATE r4_listeners SET listener_voted_entry = NULL WHERE sid = %s",
+                (sid,),
+            )
+            timings.mark("user_management")
 
-        start_time = timestamp()
-        _trim(sid)
-        user.trim_listeners(sid)
-        cache.update_user_rating_acl(sid, history[sid][0].get_song().id)
-        user.unlock_listeners(sid)
-        db.c.update(
-            "UPDATE r4_listeners SET listener_voted_entry = NULL WHERE sid = %s", (sid,)
-        )
-        log.debug(
-            "advance",
-            "User management and trimming: %.6f" % (timestamp() - start_time,),
-        )
+            # reduce song blocks has to come first, otherwise it wll reduce blocks generated by _create_elections
+            playlist.reduce_song_blocks(sid)
+            timings.mark("song_blocks")
 
-        start_time = timestamp()
-        # reduce song blocks has to come first, otherwise it wll reduce blocks generated by _create_elections
-        playlist.reduce_song_blocks(sid)
         # update_cache updates both the line and expiry times
         # this is expensive and must be done before and after every request is filled
         # DO THIS AFTER EVERYTHING ELSE, RIGHT BEFORE NEXT MANAGEMENT, OR PEOPLE'S REQUESTS SLIP THROUGH THE CRACKS
         request.update_line(sid)
+        timings.mark("request_line")
         # add to the event list / update start times for events
         manage_next(sid)
+        timings.mark("manage_next")
+        # everything past here only reads, and API processes must see the new rows
+        # by the time they hear about the song change
+        db.c.commit()
+        committed = True
+        listener_stats.clear_pending()
+        timings.mark("commit")
         # update expire times AFTER manage_next, so people who aren't in line anymore don't see expiry times
         request.update_expire_times()
-        log.debug(
-            "advance",
-            "Request and upnext management: %.6f" % (timestamp() - start_time,),
-        )
+        timings.mark("request_expiry")
 
         update_memcache(sid)
+        timings.mark("memcache")
 
         sync_to_front.sync_frontend_all(sid)
-        db.c.commit()
+        timings.mark("sync")
     except:
         db.c.rollback()
+        song_pool.reset(sid)
+        if not committed:
+            if previous:
+                current[sid], upnext[sid], history[sid] = previous
+            leaderboards.discard_pending()
+            listener_stats.discard_pending()
         raise
+    finally:
+        timings.publish()
 
     if (
         current[sid]
@@ -454,6 +576,12 @@ def _update_schedule_memcache(sid):
     cache.set_station(sid, "sched_current", current[sid], True)
     cache.set_station(sid, "sched_next", upnext[sid], True)
     cache.set_station(sid, "sched_history", history[sid], True)
+    cache.set_station(
+        sid,
+        "sched_snapshot",
+        ScheduleSnapshot.from_events(current[sid], upnext[sid]),
+        True,
+    )
 
     sched_current_dict = current[sid].to_dict()
     cache.set_station(sid, "sched_current_dict", sched_current_dict, True)
@@ -493,14 +621,11 @@ def update_memcache(sid):
         sid, [current[sid]] + upnext[sid] + history[sid]
     )
     cache.set_station(sid, "current_listeners", listeners.get_listeners_dict(sid), True)
-    cache.set_station(sid, "album_diff", playlist.get_updated_albums_dict(sid), True)
+    album_diff = playlist.get_updated_albums_dict(sid)
+    cache.set_station(sid, "album_diff", album_diff, True)
     nerdwave.playlist_objects.album.clear_updated_albums(sid)
-    cache.set_station(sid, "all_albums", playlist.get_all_albums_list(sid), True)
-    cache.set_station(sid, "all_artists", playlist.get_all_artists_list(sid), True)
-    cache.set_station(sid, "all_groups", playlist.get_all_groups_list(sid), True)
-    cache.set_station(
-        sid, "all_groups_power", playlist.get_all_groups_for_power(sid), True
-    )
+    catalog.update(sid, album_diff)
+    leaderboards.update()
 
     potential_dj_ids = []
     if getattr(current[sid], "dj_user_id", None):
@@ -519,10 +644,10 @@ def update_memcache(sid):
 
 def update_live_voting(sid):
     live_voting = {}
-    upnext_sid = cache.get_station(sid, "sched_next")
-    if not upnext_sid:
+    sched_snapshot = cache.get_station(sid, "sched_snapshot")
+    if not sched_snapshot:
         return live_voting
-    for event in upnext_sid:
+    for event in sched_snapshot.next:
         if event.is_election:
             live_voting[event.id] = db.c.fetch_all(
                 "SELECT entry_id, entry_votes, song_id FROM r4_election_entries WHERE elec_id = %s",
@@ -533,9 +658,9 @@ def update_live_voting(sid):
 
 
 def get_elec_id_for_entry(sid, entry_id):
-    sched_next = cache.get_station(sid, "sched_next")
-    if sched_next:
-        for event in sched_next:
+    sched_snapshot = cache.get_station(sid, "sched_snapshot")
+    if sched_snapshot:
+        for event in sched_snapshot.next:
             if event.is_election and event.has_entry_id(entry_id):
                 return event.id
     return 0
@@ -0,0 +1,346 @@
+import sys
+from array import array
+from time import time as timestamp
+
+import tornado.ioloop
+
+from libs import cache
+from libs import config
+from libs import db
+from libs import log
+
+# Per-station in-memory search index, used by API processes to answer /api4/search
+# without going to Postgres.  Only built when search_mode is "index"; everywhere
+# else indexes[sid] is missing and search falls back to SQL.
+indexes = {}
+# stations whose replacement index is being built in a thread
+_rebuilding = set()
+
+
+def is_enabled():
+    return config.has("search_mode") and config.get("search_mode") == "index"
+
+
+def _get_refresh():
+    if config.has("search_index_refresh"):
+        return config.get("search_index_refresh")
+    return 3600
+
+
+def load(sid):
+    if not is_enabled():
+        return None
+    index = StationSearchIndex(sid)
+    index.catalog_version = cache.get("catalog_version")
+    index.build()
+    indexes[sid] = index
+    return index
+
+
+def get(sid):
+    return indexes.get(sid)
+
+
+def _build(sid):
+    # runs in a thread, on its own pooled connection
+    index = StationSearchIndex(sid)
+    with db.cursor() as cursor:
+        index.build(cursor)
+    return index
+
+
+def _rebuild(sid):
+    """
+    Builds a replacement index off the IOLoop.  Searches keep using the old one
+    until it's ready.
+    """
+    if sid in _rebuilding:
+        return
+    _rebuilding.add(sid)
+    # read here, memcache connections aren't shared with threads
+    catalog_version = cache.get("catalog_version")
+
+    def swap(future):
+        _rebuilding.discard(sid)
+        try:
+            index = future.result()
+            index.catalog_version = catalog_version
+            indexes[sid] = index
+        except Exception as e:
+            log.exception(
+                "search_index", "Failed to rebuild index for SID %s." % sid, e
+            )
+
+    loop = tornado.ioloop.IOLoop.current()
+    loop.add_future(loop.run_in_executor(None, _build, sid), swap)
+
+
+def update(sid, album_diff):
+    """
+    Called on every song change.  Brings cooldowns and album ratings up to date.
+    New or renamed albums in the diff, songs added or removed by the scanner
+    (catalog_version), and old indexes get a rebuild instead.
+    """
+    index = indexes.get(sid)
+    if not index:
+        return
+    try:
+        index.update(album_diff)
+    except Exception as e:
+        log.exception("search_index", "Failed to update index for SID %s." % sid, e)
+        index.stale = True
+    if (
+        index.stale
+        or index.catalog_version != cache.get("catalog_version")
+        or index.built_at < timestamp() - _get_refresh()
+    ):
+        _rebuild(sid)
+
+
+def _trigrams(s):
+    return {s[i : i + 3] for i in range(len(s) - 2)}
+
+
+class _NameIndex:
+    """
+    Searchable names with a trigram -> array of row numbers inverted index.
+    Candidates are narrowed with the rarest trigrams, then checked as substrings.
+    """
+
+    def __init__(self):
+        self.searchable = []
+        self.postings = {}
+
+    def add(self, searchable):
+        row = len(self.searchable)
+        self.searchable.append(searchable)
+        for trigram in _trigrams(searchable):
+            posting = self.postings.get(trigram)
+            if posting is None:
+                posting = array("l")
+                self.postings[trigram] = posting
+            posting.append(row)
+        return row
+
+    def find(self, s, limit, sort_key):
+        postings = []
+        for trigram in _trigrams(s):
+            posting = self.postings.get(trigram)
+            if posting is None:
+                return []
+            postings.append(posting)
+        postings.sort(key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:3]:
+            candidates.intersection_update(posting)
+            if not candidates:
+                return []
+
+        matches = []
+        word = " " + s
+        for row in candidates:
+            searchable = self.searchable[row]
+            if searchable.startswith(s):
+                rank = 0
+            elif word in searchable:
+                rank = 1
+            elif s in searchable:
+                rank = 2
+            else:
+                continue
+            matches.append((rank, sort_key(row), row))
+        matches.sort()
+        return [row for _rank, _sort, row in matches[:limit]]
+
+    def memory_size(self):
+        size = sys.getsizeof(self.searchable) + sys.getsizeof(self.postings)
+        size += sum(sys.getsizeof(s) for s in self.searchable)
+        for trigram, posting in self.postings.items():
+            size += sys.getsizeof(trigram) + sys.getsizeof(posting)
+        return size
+
+
+class StationSearchIndex:
+    def __init__(self, sid):
+        self.sid = sid
+        self.built_at = 0
+        self.stale = False
+        self.memory = 0
+        self.catalog_version = None
+
+    def build(self, cursor=None):
+        cursor = cursor or db.c
+        start_time = timestamp()
+
+        self.artist_names = _NameIndex()
+        self.artists = []
+        for row in cursor.fetch_all(
+            "SELECT DISTINCT artist_id, artist_name, artist_name_searchable "
+            "FROM r4_song_sid "
+            "JOIN r4_song_artist USING (song_id) "
+            "JOIN r4_artists USING (artist_id) "
+            "WHERE sid = %s AND song_exists = TRUE",
+            (self.sid,),
+        ):
+            self.artist_names.add(row["artist_name_searchable"])
+            self.artists.append((row["artist_id"], row["artist_name"]))
+
+        self.album_names = _NameIndex()
+        self.albums = []
+        self.album_rows = {}
+        for row in cursor.fetch_all(
+            "SELECT album_id, album_name, album_name_searchable, album_cool, CAST(ROUND(CAST(album_rating AS NUMERIC), 1) AS REAL) AS album_rating "
+            "FROM r4_album_sid "
+            "JOIN r4_albums USING (album_id) "
+            "WHERE sid = %s AND album_exists = TRUE",
+            (self.sid,),
+        ):
+            self.album_rows[row["album_id"]] = self.album_names.add(
+                row["album_name_searchable"]
+            )
+            self.albums.append(
+                [
+                    row["album_id"],
+                    row["album_name"],
+                    row["album_cool"],
+                    row["album_rating"],
+                ]
+            )
+
+        self.song_titles = _NameIndex()
+        self.songs = []
+        self.song_rows = {}
+        self.cool_song_ids = set()
+        for row in cursor.fetch_all(
+            "SELECT r4_song_sid.song_id, song_length, song_origin_sid, song_title, song_title_searchable, song_added_on, "
+            "song_url, song_link_text, CAST(ROUND(CAST(song_rating AS NUMERIC), 1) AS REAL) AS song_rating, "
+            "song_cool, song_cool_end, song_artist_parseable, r4_albums.album_name, r4_songs.album_id "
+            "FROM r4_song_sid "
+            "JOIN r4_songs ON (r4_song_sid.song_id = r4_songs.song_id) "
+            "JOIN r4_albums ON (r4_songs.album_id = r4_albums.album_id) "
+            "WHERE r4_song_sid.song_exists = TRUE AND r4_songs.song_verified = TRUE AND r4_song_sid.sid = %s",
+            (self.sid,),
+        ):
+            self.song_rows[row["song_id"]] = self.song_titles.add(
+                row["song_title_searchable"]
+            )
+            # cooldown fields are the last two and get replaced by update()
+            self.songs.append(
+                [
+                    row["song_id"],
+                    row["song_length"],
+                    row["song_origin_sid"],
+                    row["song_title"],
+                    row["song_added_on"],
+                    row["song_url"],
+                    row["song_link_text"],
+                    row["song_rating"],
+                    row["song_artist_parseable"],
+                    row["album_name"],
+                    row["album_id"],
+                    row["song_cool"],
+                    row["song_cool_end"],
+                ]
+            )
+            if row["song_cool"]:
+                self.cool_song_ids.add(row["song_id"])
+
+        self.memory = (
+            self.artist_names.memory_size()
+            + self.album_names.memory_size()
+            + self.song_titles.memory_size()
+            + sum(sys.getsizeof(r) for r in self.artists)
+            + sum(sys.getsizeof(r) for r in self.albums)
+            + sum(sys.getsizeof(r) for r in self.songs)
+        )
+        self.built_at = timestamp()
+        self.stale = False
+        log.info(
+            "search_index",
+            "SID %s: indexed %s artists, %s albums, %s songs in %.3fs, ~%.1f MB."
+            % (
+                self.sid,
+                len(self.artists),
+                len(self.albums),
+                len(self.songs),
+                self.built_at - start_time,
+                self.memory / 1048576,
+            ),
+        )
+
+    def update(self, album_diff):
+        for album in album_diff or []:
+            row = self.album_rows.get(album["id"])
+            if row is None or self.albums[row][1] != album["name"]:
+                self.stale = True
+                continue
+            self.albums[row][2] = album["cool"]
+            self.albums[row][3] = round(album["rating"] or 0, 1)
+
+        # Songs that are cool now, plus the ones that were cool last time to catch warming.
+        cool_now = db.c.fetch_all(
+            "SELECT song_id, song_cool, song_cool_end FROM r4_song_sid "
+            "WHERE sid = %s AND (song_cool = TRUE OR song_id = ANY(%s))",
+            (self.sid, list(self.cool_song_ids)),
+        )
+        self.cool_song_ids = set()
+        for row in cool_now:
+            song_row = self.song_rows.get(row["song_id"])
+            if song_row is None:
+                continue
+            self.songs[song_row][11] = row["song_cool"]
+            self.songs[song_row][12] = row["song_cool_end"]
+            if row["song_cool"]:
+                self.cool_song_ids.add(row["song_id"])
+
+    def search(self, s):
+        """
+        Same results, with the same keys, as nerdwave's SQL search for anonymous users.
+        """
+        artists = []
+        for row in self.artist_names.find(s, 50, lambda r: self.artists[r][1] or ""):
+            artist_id, name = self.artists[row]
+            artists.append({"id": artist_id, "name": name})
+
+        albums = []
+        for row in self.album_names.find(s, 50, lambda r: self.albums[r][1] or ""):
+            album_id, name, cool, rating = self.albums[row]
+            albums.append(
+                {
+                    "id": album_id,
+                    "name": name,
+                    "cool": cool,
+                    "rating": rating,
+                    "fave": False,
+                    "rating_user": 0,
+                    "rating_complete": False,
+                }
+            )
+
+        songs = []
+        for row in self.song_titles.find(
+            s, 100, lambda r: (self.songs[r][9] or "", self.songs[r][3] or "")
+        ):
+            song = self.songs[row]
+            songs.append(
+                {
+                    "id": song[0],
+                    "length": song[1],
+                    "origin_sid": song[2],
+                    "title": song[3],
+                    "added_on": song[4],
+                    "url": song[5],
+                    "link_text": song[6],
+                    "rating": song[7],
+                    "requestable": False,
+                    "cool": song[11],
+                    "cool_end": song[12],
+                    "artist_parseable": song[8],
+                    "rating_user": 0,
+                    "fave": False,
+                    "album_name": song[9],
+                    "album_id": song[10],
+                }
+            )
+
+        return artists, albums, songs
@@ -0,0 +1,206 @@
+import bisect
+from array import array
+from collections import OrderedDict
+from time import time as timestamp
+
+from libs import cache
+from libs import config
+from libs import db
+from libs import log
+
+# Sorted copies of every verified song's rating and request count, kept in each API
+# process, so /api4/song ranks a song with a binary search instead of counting
+# r4_songs twice.  Rebuilt from scratch every rank_index_max_age seconds.  In between,
+# update_all re-reads the songs in the station's current and past events, which are
+# the only songs whose rating (on song end) or request count (on song start) moves.
+
+_ratings = array("d")
+_request_counts = array("l")
+# song_id -> (rating, request_count) as currently in the arrays
+_values = {}
+_built_at = 0
+
+# song_id -> ((rating, rating_count), expires_at, histogram)
+_histograms = OrderedDict()
+
+
+def _get_max_age():
+    if config.has("rank_index_max_age"):
+        return config.get("rank_index_max_age")
+    return 3600
+
+
+def _get_histogram_cache_size():
+    if config.has("rating_histogram_cache_size"):
+        return config.get("rating_histogram_cache_size")
+    return 2000
+
+
+def _get_histogram_ttl():
+    # catches ratings made through other processes and users going inactive
+    if config.has("rating_histogram_ttl"):
+        return config.get("rating_histogram_ttl")
+    return 600
+
+
+def is_built():
+    return _built_at > 0
+
+
+def build():
+    global _ratings, _request_counts, _values, _built_at
+
+    start_time = timestamp()
+    rows = db.c.fetch_all(
+        "SELECT song_id, song_rating, song_request_count FROM r4_songs WHERE song_verified = TRUE"
+    )
+    _values = {
+        row["song_id"]: (row["song_rating"] or 0, row["song_request_count"] or 0)
+        for row in rows
+    }
+    _ratings = array("d", sorted(value[0] for value in _values.values()))
+    _request_counts = array("l", sorted(value[1] for value in _values.values()))
+    _built_at = timestamp()
+    log.debug(
+        "song_ranks",
+        "Indexed %s songs in %.3fs." % (len(_values), _built_at - start_time),
+    )
+
+
+def _remove(arr, value):
+    del arr[bisect.bisect_left(arr, value)]
+
+
+def _set_values(song_id, values):
+    old = _values.pop(song_id, None)
+    if old:
+        _remove(_ratings, old[0])
+        _remove(_request_counts, old[1])
+    if values:
+        bisect.insort(_ratings, values[0])
+        bisect.insort(_request_counts, values[1])
+        _values[song_id] = values
+
+
+def update(sid):
+    """
+    Called by API processes on update_all.  Patches in the songs that just played or
+    are playing on the station, or rebuilds everything if the index is too old.
+    """
+    if _built_at < timestamp() - _get_max_age():
+        build()
+        return
+
+    song_ids = set()
+    events = [cache.get_station(sid, "sched_current_dict")]
+    events.extend(cache.get_station(sid, "sched_history_dict") or [])
+    for event in events:
+        if event and "songs" in event:
+            song_ids.update(song["id"] for song in event["songs"])
+    if not song_ids:
+        return
+
+    rows = db.c.fetch_all(
+        "SELECT song_id, song_rating, song_request_count, song_verified FROM r4_songs WHERE song_id = ANY(%s)",
+        (list(song_ids),),
+    )
+    for row in rows:
+        if row["song_verified"]:
+            values = (row["song_rating"] or 0, row["song_request_count"] or 0)
+        else:
+            values = None
+        if _values.get(row["song_id"]) != values:
+            _set_values(row["song_id"], values)
+
+
+def get_rating_rank(rating):
+    # same as COUNT(song_id) + 1 ... WHERE song_rating > rating
+    return len(_ratings) - bisect.bisect_right(_ratings, rating) + 1
+
+
+def get_request_rank(request_count):
+    return (
+        len(_request_counts) - bisect.bisect_right(_request_counts, request_count) + 1
+    )
+
+
+def get_rating_histogram(song_id, rating, rating_count):
+    """
+    Active users' ratings of the song, rounded down to the half point.  Cached until
+    the song's rating is recalculated, someone rates it through this process, or
+    rating_histogram_ttl seconds pass.
+    """
+    version = (rating, rating_count)
+    cached = _histograms.get(song_id)
+    if cached and cached[0] == version and cached[1] > timestamp():
+        _histograms.move_to_end(song_id)
+        return cached[2]
+
+    histogram = {}
+    histo = db.c.fetch_all(
+        "SELECT "
+        "ROUND(((song_rating_user * 10) - (CAST(song_rating_user * 10 AS SMALLINT) %% 5))) / 10 AS rating_user_rnd, "
+        "COUNT(song_rating_user) AS rating_user_count "
+        "FROM r4_song_ratings JOIN phpbb_users USING (user_id) "
+        "WHERE radio_inactive = FALSE AND song_id = %s "
+        "GROUP BY rating_user_rnd "
+        "ORDER BY rating_user_rnd",
+        (song_id,),
+    )
+    for point in histo:
+        if point["rating_user_rnd"]:
+            histogram[str(point["rating_user_rnd"])] = point["rating_user_count"]
+
+    if _get_histogram_cache_size():
+        _histograms[song_id] = (
+            version,
+            timestamp() + _get_histogram_ttl(),
+            histogram,
+        )
+        _histograms.move_to_end(song_id)
+        while len(_histograms) > _get_histogram_cache_size():
+            _histograms.popitem(last=False)
+    return histogram
+
+
+def clear_histogram(song_id):
+    _histograms.pop(song_id, None)
+
+
+def check(song_ids):
+    """
+    Compares the index against the SQL ranks for the given songs.
+    Returns a list of (song_id, "rating_rank"/"request_rank", index rank, SQL rank).
+    """
+    mismatches = []
+    for song_id in song_ids:
+        row = db.c.fetch_row(
+            "SELECT song_rating, song_request_count FROM r4_songs WHERE song_id = %s",
+            (song_id,),
+        )
+        if not row:
+            continue
+        rating = row["song_rating"] or 0
+        request_count = row["song_request_count"] or 0
+        sql_rating_rank = db.c.fetch_var(
+            "SELECT COUNT(song_id) + 1 FROM r4_songs WHERE song_verified = TRUE AND song_rating > %s",
+            (rating,),
+        )
+        sql_request_rank = db.c.fetch_var(
+            "SELECT COUNT(song_id) + 1 FROM r4_songs WHERE song_verified = TRUE AND song_request_count > %s",
+            (request_count,),
+        )
+        if get_rating_rank(rating) != sql_rating_rank:
+            mismatches.append(
+                (song_id, "rating_rank", get_rating_rank(rating), sql_rating_rank)
+            )
+        if get_request_rank(request_count) != sql_request_rank:
+            mismatches.append(
+                (
+                    song_id,
+                    "request_rank",
+                    get_request_rank(request_count),
+                    sql_request_rank,
+                )
+            )
+    return mismatches
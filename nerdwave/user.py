@@ -214,7 +214,7 @@ class User:
         else:
             self.data["sid"] = sid
 
-        if (self.id > 1) and cache.get_station(sid, "sched_current"):
+        if (self.id > 1) and cache.get_station(sid, "sched_current_dict"):
             self.data["request_position"] = self.get_request_line_position(
                 self.data["sid"]
             )
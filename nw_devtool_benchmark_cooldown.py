@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+import argparse
+from time import time as timestamp
+
+import libs.config
+import libs.log
+import libs.db
+import libs.cache
+from nerdwave import playlist
+from nerdwave.playlist_objects import album
+from nerdwave.playlist_objects import cooldown
+
+parser = argparse.ArgumentParser(
+    description="Replays a day of song starts from the song history, applying cooldowns per object and batched, and rolls every start back afterwards."
+)
+parser.add_argument("--config", default=None)
+parser.add_argument("--sid", type=int, required=True)
+parser.add_argument("--days-ago", type=int, default=1)
+args = parser.parse_args()
+
+libs.config.load(args.config)
+libs.log.init()
+libs.db.connect()
+libs.cache.connect()
+
+day_end = int(timestamp()) - (args.days_ago - 1) * 86400
+song_ids = libs.db.c.fetch_list(
+    "SELECT song_id FROM r4_song_history WHERE sid = %s AND songhist_time > %s AND songhist_time <= %s ORDER BY songhist_time",
+    (args.sid, day_end - 86400, day_end),
+)
+if not song_ids:
+    raise Exception("No song history for SID %s in that day." % args.sid)
+
+playlist.prepare_cooldown_algorithm(args.sid)
+album.clear_updated_albums(args.sid)
+songs = [playlist.Song.load_from_id(song_id, args.sid) for song_id in song_ids]
+
+
+def percentile(timings, pct):
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, int(len(timings) * pct / 100))]
+
+
+def replay(mode):
+    libs.config.override("cooldown_apply_mode", mode)
+    timings = []
+    for song in songs:
+        libs.db.c.start_transaction()
+        try:
+            start = timestamp()
+            song.start_cooldown(args.sid)
+            timings.append(timestamp() - start)
+        finally:
+            libs.db.c.rollback()
+    print(
+        "%-10s %s starts  total %.3fs  p50 %.4f  p95 %.4f  p99 %.4f  max %.4f"
+        % (
+            mode,
+            len(timings),
+            sum(timings),
+            percentile(timings, 50),
+            percentile(timings, 95),
+            percentile(timings, 99),
+            max(timings),
+        )
+    )
+
+
+start = timestamp()
+cooldown.get_album_cool_times(args.sid)
+print(
+    "Calculated %s album cooldowns in %.3fs."
+    % (len(cooldown.album_cool_times[args.sid]), timestamp() - start)
+)
+replay("per_object")
+replay("batched")
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+import argparse
+import concurrent.futures
+import multiprocessing
+import os
+import tempfile
+from time import time as timestamp
+
+import libs.config
+import libs.log
+from libs import replaygain
+
+parser = argparse.ArgumentParser(
+    description="Compares replay gain from the replaygain subprocess against in-process GStreamer analysis and the on-disk gain cache, for the MP3s in a directory."
+)
+parser.add_argument("--config", default=None)
+parser.add_argument("--dir", required=True)
+parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1)
+parser.add_argument("--limit", type=int, default=50)
+args = parser.parse_args()
+
+libs.config.load(args.config)
+libs.log.init()
+libs.config.override("disable_replaygain", False)
+
+files = []
+for root, _subdirs, filenames in os.walk(args.dir, followlinks=True):
+    for filename in filenames:
+        if filename.lower().endswith(".mp3"):
+            files.append(os.path.join(root, filename))
+files = sorted(files)[: args.limit]
+if not files:
+    raise Exception("No MP3s found in %s." % args.dir)
+
+
+def run(name, jobs):
+    start_time = timestamp()
+    if jobs > 1:
+        with concurrent.futures.ProcessPoolExecutor(
+            jobs, mp_context=multiprocessing.get_context("fork")
+        ) as executor:
+            gains = list(executor.map(replaygain.get_gain_for_song, files))
+    else:
+        gains = [replaygain.get_gain_for_song(filename) for filename in files]
+    elapsed = timestamp() - start_time
+    print(
+        "%-34s %.3fs total, %.4fs per file"
+        % ("%s (%s job(s)):" % (name, jobs), elapsed, elapsed / len(files))
+    )
+    return gains
+
+
+def gain_value(gain):
+    return float(gain.split(" ")[0])
+
+
+print("%s files" % len(files))
+
+libs.config.override("replaygain_cache_dir", False)
+libs.config.override("replaygain_engine", "subprocess")
+subprocess_gains = run("Subprocess", 1)
+run("Subprocess", args.jobs)
+
+libs.config.override("replaygain_engine", "gstreamer")
+if replaygain.get_engine() != "gstreamer":
+    raise Exception("GStreamer is not available here.")
+gstreamer_gains = run("GStreamer", args.jobs)
+
+mismatches = [
+    (filename, old, new)
+    for filename, old, new in zip(files, subprocess_gains, gstreamer_gains)
+    if abs(gain_value(old) - gain_value(new)) > 0.1
+]
+print("Files differing by more than 0.1 dB: %s" % len(mismatches))
+for filename, old, new in mismatches[:10]:
+    print("  %s: %s vs %s" % (filename, old, new))
+
+with tempfile.TemporaryDirectory() as cache_dir:
+    libs.config.override("replaygain_cache_dir", cache_dir)
+    run("GStreamer, cold cache", args.jobs)
+    run("Warm cache", 1)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+import argparse
+import typing
+from time import time as timestamp
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+import tornado.httputil
+
+import libs.config
+import libs.log
+import libs.db
+import libs.cache
+import api.locale
+import api_requests.info
+from api.web import APIHandler
+from api_requests.sync import FakeRequestObject
+from nerdwave.user import User
+
+parser = argparse.ArgumentParser(
+    description="Compares the per-session cost of a full sync update against the shared broadcast payload, using listeners currently tuned in."
+)
+parser.add_argument("--config", default=None)
+parser.add_argument("--sid", type=int, required=True)
+parser.add_argument("--users", type=int, default=200)
+args = parser.parse_args()
+
+libs.config.load(args.config)
+libs.log.init()
+libs.db.connect()
+libs.cache.connect()
+api.locale.load_translations()
+
+user_ids = libs.db.c.fetch_list(
+    "SELECT user_id FROM r4_listeners WHERE sid = %s AND listener_purge = FALSE LIMIT %s",
+    (args.sid, args.users),
+)
+if not user_ids:
+    user_ids = [1]
+users = []
+for user_id in user_ids:
+    user = User(user_id)
+    user.refresh(args.sid)
+    users.append(user)
+
+
+def full_update(user):
+    handler = APIHandler(websocket=True)
+    handler.locale = api.locale.translations["en_CA"]
+    handler.request = typing.cast(
+        tornado.httputil.HTTPServerRequest, FakeRequestObject({}, {})
+    )
+    handler.sid = args.sid
+    handler.user = user
+    handler._output = {}
+    api_requests.info.attach_info_to_request(handler, live_voting=True)
+    return json.dumps(handler._output).encode("utf-8")
+
+
+start_time = timestamp()
+full_bytes = 0
+for user in users:
+    full_bytes += len(full_update(user))
+full_time = timestamp() - start_time
+
+start_time = timestamp()
+broadcast = api_requests.info.build_sync_broadcast(args.sid)
+build_time = timestamp() - start_time
+if not broadcast:
+    raise Exception("Station %s has no schedule in cache." % args.sid)
+
+start_time = timestamp()
+broadcast_bytes = 0
+for user in users:
+    broadcast_bytes += len(broadcast.render(user, live_voting=True))
+render_time = timestamp() - start_time
+
+print(
+    "Sessions: %s (%s logged in)"
+    % (len(users), len([u for u in users if not u.is_anonymous()]))
+)
+print(
+    "Full update:     %.6f per session, %.3fs total, %s bytes"
+    % (full_time / len(users), full_time, full_bytes)
+)
+print(
+    "Broadcast:       %.6f per session, %.3fs total (+%.6f build), %s bytes"
+    % (render_time / len(users), render_time, build_time, broadcast_bytes)
+)
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+
+import argparse
+from time import time as timestamp
+
+import libs.config
+import libs.log
+import libs.db
+import libs.cache
+from nerdwave import song_ranks
+
+parser = argparse.ArgumentParser(
+    description="Builds the in-memory song rank index and compares its ranks against the SQL counts /api4/song used to run."
+)
+parser.add_argument("--config", default=None)
+parser.add_argument("--sample", type=int, default=200)
+args = parser.parse_args()
+
+libs.config.load(args.config)
+libs.log.init()
+libs.db.connect()
+libs.cache.connect()
+
+start = timestamp()
+song_ranks.build()
+print("Built index in %.3fs." % (timestamp() - start))
+
+song_ids = libs.db.c.fetch_list(
+    "SELECT song_id FROM r4_songs WHERE song_verified = TRUE ORDER BY RANDOM() LIMIT %s",
+    (args.sample,),
+)
+
+mismatches = song_ranks.check(song_ids)
+for song_id, key, index_rank, sql_rank in mismatches:
+    print(
+        "Song %s: %s is %s in the index, %s in SQL."
+        % (song_id, key, index_rank, sql_rank)
+    )
+if mismatches:
+    raise SystemExit("%s mismatches." % len(mismatches))
+print("All ranks match.")
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+import argparse
+import asyncio
+import random
+from time import time as timestamp
+
+import aiohttp
+
+import libs.config
+
+parser = argparse.ArgumentParser(
+    description="Measures API latency for fast requests on their own, then mixed with slow database-bound requests.  Run against a server before and after converting endpoints to async to compare p99s."
+)
+parser.add_argument("--config", default=None)
+parser.add_argument("--sid", type=int, default=1)
+parser.add_argument("--user-id", type=int, required=True)
+parser.add_argument("--key", required=True)
+parser.add_argument("--listener-id", type=int, default=None)
+parser.add_argument("--clients", type=int, default=50)
+parser.add_argument("--duration", type=int, default=30)
+parser.add_argument(
+    "--slow-ratio",
+    type=float,
+    default=0.2,
+    help="Fraction of requests sent to slow endpoints during the mixed phase.",
+)
+args = parser.parse_args()
+
+libs.config.load(args.config)
+
+base_url = "http://%s:%s/api4/" % (
+    libs.config.get("api_url"),
+    libs.config.get("api_base_port"),
+)
+auth = {"sid": args.sid, "user_id": args.user_id, "key": args.key}
+
+fast_requests = [("info", {}), ("current_listeners", {})]
+slow_requests = [
+    ("listener", {"id": args.listener_id or args.user_id}),
+    ("playback_history", {"per_page": 100}),
+]
+
+
+def percentile(timings, pct):
+    if not timings:
+        return 0
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, int(len(timings) * pct / 100))]
+
+
+async def client(session, slow_ratio, stop_at, results):
+    while timestamp() < stop_at:
+        if slow_ratio and random.random() < slow_ratio:
+            url, data = random.choice(slow_requests)
+        else:
+            url, data = random.choice(fast_requests)
+        data = dict(auth, **data)
+        start = timestamp()
+        try:
+            async with session.post(base_url + url, data=data) as response:
+                await response.read()
+                ok = response.status == 200
+        except aiohttp.ClientError:
+            ok = False
+        timings, errors = results.setdefault(url, ([], [0]))
+        timings.append(timestamp() - start)
+        if not ok:
+            errors[0] += 1
+
+
+async def run_phase(name, slow_ratio):
+    results = {}
+    stop_at = timestamp() + args.duration
+    async with aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(total=60),
+        connector=aiohttp.TCPConnector(limit=args.clients),
+    ) as session:
+        await asyncio.gather(
+            *[client(session, slow_ratio, stop_at, results) for _ in range(args.clients)]
+        )
+
+    print(name)
+    for url, (timings, errors) in sorted(results.items()):
+        print(
+            "  %-20s %6s reqs %4s errors  p50 %.4f  p95 %.4f  p99 %.4f  max %.4f"
+            % (
+                url,
+                len(timings),
+                errors[0],
+                percentile(timings, 50),
+                percentile(timings, 95),
+                percentile(timings, 99),
+                max(timings),
+            )
+        )
+    return results
+
+
+async def main():
+    await run_phase("Fast requests only:", 0)
+    await run_phase("Mixed with slow requests:", args.slow_ratio)
+
+
+asyncio.run(main())
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+import argparse
+import pickle
+from time import time as timestamp
+
+import libs.config
+import libs.log
+import libs.cache
+
+parser = argparse.ArgumentParser(
+    description="Compares the size and unpickling time of the schedule objects against what API processes now read on every song change."
+)
+parser.add_argument("--config", default=None)
+parser.add_argument("--repeat", type=int, default=1000)
+args = parser.parse_args()
+
+libs.config.load(args.config)
+libs.log.init()
+libs.cache.connect()
+
+OBJECT_KEYS = ("sched_current", "sched_next", "sched_history")
+SNAPSHOT_KEYS = (
+    "sched_snapshot",
+    "sched_current_dict",
+    "sched_next_dict",
+    "sched_history_dict",
+)
+
+
+def measure(sid, keys):
+    total_bytes = 0
+    total_time = 0
+    for key in keys:
+        data = pickle.dumps(
+            libs.cache.get_station(sid, key), pickle.HIGHEST_PROTOCOL
+        )
+        start_time = timestamp()
+        for _ in range(args.repeat):
+            pickle.loads(data)
+        total_time += (timestamp() - start_time) / args.repeat
+        total_bytes += len(data)
+    return total_bytes, total_time
+
+
+for sid in libs.config.station_ids:
+    object_bytes, object_time = measure(sid, OBJECT_KEYS)
+    snapshot_bytes, snapshot_time = measure(sid, SNAPSHOT_KEYS)
+    print(
+        "SID %s: objects %s bytes / %.3fms, snapshot + dicts %s bytes / %.3fms"
+        % (
+            sid,
+            object_bytes,
+            object_time * 1000,
+            snapshot_bytes,
+            snapshot_time * 1000,
+        )
+    )
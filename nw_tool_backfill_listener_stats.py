@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+import argparse
+import asyncio
+from time import time as timestamp
+
+import libs.config
+import libs.log
+import libs.db
+import libs.cache
+from nerdwave import listener_stats
+
+parser = argparse.ArgumentParser(
+    description="Calculates listener profile stats for existing users and stores them in the cache, so their first profile views don't have to."
+)
+parser.add_argument("--config", default=None)
+parser.add_argument(
+    "--days",
+    type=int,
+    default=30,
+    help="Only users active in this many days.  0 for every user.",
+)
+parser.add_argument("--jobs", type=int, default=4)
+args = parser.parse_args()
+
+libs.config.load(args.config)
+libs.log.init()
+libs.db.connect()
+libs.cache.connect()
+
+if args.days:
+    user_ids = libs.db.c.fetch_list(
+        "SELECT user_id FROM phpbb_users WHERE user_id > 1 AND radio_last_active > %s ORDER BY user_id",
+        (timestamp() - args.days * 86400,),
+    )
+else:
+    user_ids = libs.db.c.fetch_list(
+        "SELECT user_id FROM phpbb_users WHERE user_id > 1 ORDER BY user_id"
+    )
+
+
+async def worker(queue, done):
+    async with libs.db.async_cursor() as cursor:
+        while queue:
+            user_id = queue.pop()
+            stats = await listener_stats.calculate(
+                cursor, user_id, libs.config.station_ids
+            )
+            libs.cache.set_user(user_id, "listener_stats", stats)
+            done[0] += 1
+            txt = "User %s / %s" % (done[0], len(user_ids))
+            txt += " " * (80 - len(txt))
+            print("\r" + txt, end="")
+
+
+async def main():
+    queue = list(reversed(user_ids))
+    done = [0]
+    start_time = timestamp()
+    await asyncio.gather(*[worker(queue, done) for _ in range(args.jobs)])
+    print()
+    print("%s users in %.1fs." % (len(user_ids), timestamp() - start_time))
+
+
+asyncio.run(main())
@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+
+import argparse
+
+from libs import config
+from libs import db
+from libs import log
+
+parser = argparse.ArgumentParser(
+    description="Adds the (album_name, album_id) index that all_albums_paginated's cursor pages on, for databases created before create_tables made it."
+)
+parser.add_argument("--config", default=None)
+args = parser.parse_args()
+
+config.load(args.config)
+log.init()
+db.connect()
+
+# same name create_idx gives it in create_tables
+db.c.update(
+    "CREATE INDEX IF NOT EXISTS r4_albums_album_name_album_id_idx ON r4_albums (album_name, album_id)"
+)
+print("Done")
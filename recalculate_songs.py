@@ -2,9 +2,11 @@
 
 import argparse
 
+from libs import cache
 from libs import config
 from libs import db
 from libs import log
+from nerdwave import leaderboards
 from nerdwave.playlist import Song
 
 if __name__ == "__main__":
@@ -16,6 +18,7 @@ if __name__ == "__main__":
     config.load(args.config)
     log.init()
     db.connect()
+    cache.connect()
 
     songs = db.c.fetch_list("SELECT song_id FROM r4_songs")
     i = 0
@@ -27,3 +30,7 @@ if __name__ == "__main__":
 
         s = Song.load_from_id(song_id)
         s.update_rating(skip_album_update=True)
+
+    # ratings aren't patched into the leaderboards one by one from here
+    leaderboards.rebuild()
+    cache.bump_generation()
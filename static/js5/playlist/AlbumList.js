@@ -61,7 +61,10 @@ var AlbumList = function (el) {
 
   API.add_callback("all_albums_paginated", function (json) {
     if (json.has_more) {
-      API.async_get("all_albums_paginated", { after: json.next });
+      API.async_get("all_albums_paginated", {
+        after: json.next,
+        cursor: json.cursor,
+      });
     }
     json.data.forEach(function (album) {
       album.name_searchable = Formatting.make_searchable_string(album.name);